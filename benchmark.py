@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Benchmarks for the stages of HachidaishuDB.
+
+Each stage is timed on subsets of the database (the first fraction of its
+poems), and its throughput and peak memory are reported. Results can be
+saved as a JSON baseline, and a later run compared against it:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+When comparing, the exit status is 1 if any stage's throughput dropped by
+more than the tolerance (20% by default)."""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from hachidaishu import HachidaishuDB, open_db
+
+BASELINE_VERSION = 1
+
+# The retokenization stages, in pipeline order, each consuming the list of
+# records produced by the previous one.
+PIPELINE = ("parse", "merge_decompositions", "map_ud", "merge_variants")
+
+
+def poem_subset(lines, fraction):
+    """Return the lines of the first `fraction` of the poems in `lines`."""
+    keys = dict.fromkeys(line[: line.find(":", 3)] for line in lines if line.strip())
+    count = max(1, round(len(keys) * fraction))
+    if count >= len(keys):
+        return list(lines)
+    stop = list(keys)[count]
+    for i, line in enumerate(lines):
+        if line.startswith(stop + ":"):
+            return lines[:i]
+    return list(lines)
+
+
+def _pipeline(text, timer, lazy=False):
+    """Run the retokenization stages on `text`, calling `timer(stage, fn)` to
+    run each one, and return the retokenized records."""
+    db = HachidaishuDB.__new__(HachidaishuDB)
+    functions = (
+        lambda _: db._read_db(io.StringIO(text), lazy=lazy),
+        db._merge_decompositions,
+        db._map_ud,
+        db._merge_variants,
+    )
+    records = None
+    for stage, function in zip(PIPELINE, functions):
+        records = timer(stage, lambda: list(function(records)))
+    return records
+
+
+def _database_stages(db, directory):
+    """Return (stage, function) pairs timing the query and output paths of
+    `db`. Each function returns the number of items it processed."""
+    poems = [(a, p) for a, ps in db._poems.items() for p in ps]
+
+    def query():
+        return sum(len(db.poem(a, p)) for a, p in poems)
+
+    def write_jsonl():
+        filename = os.path.join(directory, "benchmark.jsonl")
+        return sum(shard["records"] for shard in db.write_jsonl(filename)["shards"])
+
+    return [
+        ("query", query),
+        ("tokens", lambda: sum(1 for _ in db.tokens())),
+        ("tokens_decomposition", lambda: sum(1 for _ in db.tokens("decomposition"))),
+        ("text", lambda: len(db.text().splitlines())),
+        ("text_metadata", lambda: len(db.text(embed_metadata=True).splitlines())),
+        ("write_jsonl", write_jsonl),
+    ]
+
+
+def _peak(function):
+    """Run `function` under tracemalloc and return its result and the peak
+    memory allocated while it ran, in bytes."""
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _result(seconds, items, peak):
+    return {
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds else 0.0,
+        "peak_bytes": peak,
+    }
+
+
+def run(
+    filename="hachidai.db",
+    sizes=(0.25, 0.5, 1.0),
+    repeat=3,
+    backend="objects",
+    lazy=False,
+):
+    """Benchmark every stage on each of `sizes` (fractions of the poems of
+    `filename`), keeping the best of `repeat` timings. Peak memory is measured
+    in a separate run, as tracing slows the stages down considerably.
+
+    Throughput is in records per second, except for the tokens stages, which
+    count tokens, and the text stages, which count poems. `backend` and `lazy`
+    are passed on to HachidaishuDB."""
+    with open_db(filename) as f:
+        lines = f.readlines()
+    results = {}
+    for size in sizes:
+        text = "".join(poem_subset(lines, size))
+        times = {}
+        stages = {}
+
+        def timed(stage, function):
+            start = time.perf_counter()
+            result = function()
+            times.setdefault(stage, []).append(time.perf_counter() - start)
+            return result
+
+        def traced(stage, function):
+            result, peak = _peak(function)
+            stages[stage] = _result(min(times[stage]), len(result), peak)
+            return result
+
+        # The pipeline stages mutate their records, so each timing reruns the
+        # whole pipeline on freshly parsed records.
+        for _ in range(repeat):
+            _pipeline(text, timed, lazy)
+        _pipeline(text, traced, lazy)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hachidai.db")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            db = HachidaishuDB(path, backend=backend, lazy=lazy)
+            functions = [
+                (
+                    "load",
+                    lambda: len(HachidaishuDB(path, backend=backend, lazy=lazy).db),
+                )
+            ]
+            for stage, function in functions + _database_stages(db, directory):
+                for _ in range(repeat):
+                    items = timed(stage, function)
+                stages[stage] = _result(min(times[stage]), items, _peak(function)[1])
+        results[str(size)] = stages
+    return {
+        "version": BASELINE_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "database": os.fspath(filename),
+        "backend": backend,
+        "lazy": lazy,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Return (size, stage, throughput, baseline throughput) for every stage
+    whose throughput is more than `tolerance` below that of `baseline`."""
+    regressions = []
+    for size, stages in baseline["results"].items():
+        for stage, expected in stages.items():
+            current = results["results"].get(size, {}).get(stage)
+            if current is None:
+                continue
+            rate, expected_rate = (
+                current["items_per_second"],
+                expected["items_per_second"],
+            )
+            if rate < expected_rate * (1 - tolerance):
+                regressions.append((size, stage, rate, expected_rate))
+    return regressions
+
+
+def report(results, baseline=None, file=sys.stdout):
+    """Print a table of `results`, with the change relative to `baseline`."""
+    print(
+        f"{'size':>6} {'stage':<22} {'items':>9} {'seconds':>9} {'items/s':>12} "
+        f"{'peak MiB':>9}" + (f" {'change':>8}" if baseline else ""),
+        file=file,
+    )
+    for size, stages in results["results"].items():
+        for stage, result in stages.items():
+            line = (
+                f"{size:>6} {stage:<22} {result['items']:>9} {result['seconds']:>9.4f} "
+                f"{result['items_per_second']:>12.0f} "
+                f"{result['peak_bytes'] / 2**20:>9.1f}"
+            )
+            expected = (baseline or {}).get("results", {}).get(size, {}).get(stage)
+            if expected and expected["items_per_second"]:
+                change = result["items_per_second"] / expected["items_per_second"] - 1
+                line += f" {change:>+8.1%}"
+            print(line, file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("database", nargs="?", default="hachidai.db")
+    parser.add_argument(
+        "--sizes",
+        default="0.25,0.5,1",
+        help="comma-separated fractions of the poems to run on (default: %(default)s)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timings per stage")
+    parser.add_argument("--backend", choices=("objects", "columnar"), default="objects")
+    parser.add_argument("--lazy", action="store_true", help="load with lazy tokens")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative drop in throughput (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [float(size) for size in args.sizes.split(",")]
+    results = run(args.database, sizes, args.repeat, args.backend, args.lazy)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("version") != BASELINE_VERSION:
+            parser.error(f"{args.compare} is not a version {BASELINE_VERSION} baseline")
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for size, stage, rate, expected_rate in regressions:
+            print(
+                f"Regression: {stage} at size {size}: {rate:.0f} items/s "
+                f"(baseline {expected_rate:.0f})",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
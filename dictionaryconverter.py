@@ -1,3 +1,5 @@
+import hashlib
+
 chasenid2pos = {
     "00": "？",
     "01": "名詞",
@@ -415,3 +417,101 @@ def unidic2ud_map(orth, tag, next_tag):
 
     # apply tag uni-gram mapping
     return TAG_MAP[tag], None
+
+
+# Compiled forms of the tables above, derived once at import.
+
+# chasen_id -> (IPAdic POS, English IPAdic POS, UniDic POS), replacing the
+# chasenid2pos -> chasenid2pos_en -> ipadic2unidic chain of lookups. IDs whose
+# chain does not resolve are left out, so looking them up still fails.
+CHASEN_POS = {
+    chasen_id: (ipa_pos, chasenid2pos_en[chasen_id], ipadic2unidic[ipa_pos])
+    for chasen_id, ipa_pos in chasenid2pos.items()
+    if chasen_id in chasenid2pos_en and ipa_pos in ipadic2unidic
+}
+
+# Integer codes for every UniDic tag the UD tables know about.
+UNIDIC_TAGS = tuple(
+    dict.fromkeys(
+        [*ipadic2unidic.values(), *TAG_MAP, *TAG_ORTH_MAP]
+        + [tag for bigram in TAG_BIGRAM_MAP for tag in bigram]
+    )
+)
+UNIDIC_CODES = {tag: code for code, tag in enumerate(UNIDIC_TAGS)}
+
+# Code-indexed unigram and orth tables, None where a tag has no entry.
+UD_UNIGRAM = [TAG_MAP.get(tag) for tag in UNIDIC_TAGS]
+UD_ORTH = [TAG_ORTH_MAP.get(tag) for tag in UNIDIC_TAGS]
+
+
+def _ud_pair(tag, next_tag):
+    current_pos, next_pos = TAG_BIGRAM_MAP.get((tag, next_tag), (None, None))
+    if current_pos is None:
+        current_pos = TAG_MAP.get(tag)
+    return None if current_pos is None else (current_pos, next_pos)
+
+
+# The bigram table with the unigram fallback applied: the (current_pos,
+# next_pos) result for tag code c followed by tag code n is found at
+# c * (len(UNIDIC_TAGS) + 1) + n, where n = len(UNIDIC_TAGS) stands for no
+# next tag (or one the tables do not know). None marks tags without UD POS.
+UD_BIGRAM = [
+    _ud_pair(tag, next_tag) for tag in UNIDIC_TAGS for next_tag in (*UNIDIC_TAGS, None)
+]
+# The TAG_BIGRAM_MAP key behind each entry of UD_BIGRAM, or None.
+UD_BIGRAM_RULES = [
+    (tag, next_tag) if (tag, next_tag) in TAG_BIGRAM_MAP else None
+    for tag in UNIDIC_TAGS
+    for next_tag in (*UNIDIC_TAGS, None)
+]
+
+
+def unidic2ud_map_batch(orths, tags, next_tags, rules=None):
+    """Map a sequence of tokens to UD POS in one pass over the compiled tables.
+
+    `orths`, `tags` and `next_tags` are parallel sequences of the arguments of
+    unidic2ud_map(), and the result is the list of (current_pos, next_pos)
+    tuples it would return for each, including the KeyError for tags without
+    a UD mapping.
+
+    If `rules` is a list, the TAG_BIGRAM_MAP key that decided each mapping, or
+    None if no bigram rule applied, is appended to it."""
+    codes = UNIDIC_CODES
+    get_code = codes.get
+    none = len(UNIDIC_TAGS)
+    stride = none + 1
+    result = []
+    append = result.append
+    for orth, tag, next_tag in zip(orths, tags, next_tags):
+        code = codes[tag]
+        orth_map = UD_ORTH[code]
+        if orth_map is not None and orth in orth_map:
+            append((orth_map[orth], None))
+            if rules is not None:
+                rules.append(None)
+            continue
+        index = code * stride + get_code(next_tag, none)
+        mapped = UD_BIGRAM[index]
+        if mapped is None:
+            raise KeyError(tag)
+        append(mapped)
+        if rules is not None:
+            rules.append(UD_BIGRAM_RULES[index])
+    return result
+
+
+def mapping_digest():
+    """Return a hex digest identifying the current contents of the POS mapping
+    tables. Any edit to one of the tables above yields a different digest."""
+    h = hashlib.sha256()
+    for table in (
+        chasenid2pos,
+        chasenid2pos_en,
+        ipadic2unidic,
+        TAG_MAP,
+        TAG_ORTH_MAP,
+        TAG_BIGRAM_MAP,
+    ):
+        h.update(repr(table).encode("utf-8"))
+    return h.hexdigest()
+
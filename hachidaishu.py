@@ -1,17 +1,57 @@
 #!/usr/bin/env python
 
+import argparse
+import atexit
+import bz2
+import contextlib
+import csv
+import datetime
+import gc
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import mmap
+import os
+import pickle
 import re
+import secrets
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+from bisect import bisect_left
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import asdict, astuple, dataclass, field, fields
 from enum import Enum
-from itertools import groupby
+from itertools import chain, groupby, islice, repeat
+from multiprocessing import (
+    active_children,
+    parent_process,
+    resource_tracker,
+    shared_memory,
+)
+from operator import attrgetter
 from typing import List
 
+try:
+    import numpy as np
+except ImportError:  # NumPy is only required by the columnar backend.
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows frees shared memory with its last handle instead.
+    fcntl = None
+
 from dictionaryconverter import (
-    unidic2ud_map,
-    chasenid2pos,
-    chasenid2pos_en,
-    ipadic2unidic,
+    unidic2ud_map_batch,
+    CHASEN_POS,
+    mapping_digest,
 )
 
 Anthology = Enum(
@@ -19,6 +59,35 @@ Anthology = Enum(
     "Kokinshu Gosenshu Shuishu Goshuishu Kin’yoshu Shikashu Senzaishu Shinkokinshu",
 )
 
+# Bump whenever the snapshot layout or the retokenization logic changes, so that
+# stale snapshot files are rebuilt instead of loaded.
+SNAPSHOT_VERSION = 3
+SNAPSHOT_MAGIC = b"HACHIDAISHU-SNAPSHOT\n"
+
+# Binary corpus files (see ColumnarStore.save()).
+CORPUS_VERSION = 1
+CORPUS_MAGIC = b"HACHIDAISHU-CORPUS\n"
+
+# Substring index files (see SubstringIndex.save()).
+SUBSTRING_VERSION = 1
+SUBSTRING_MAGIC = b"HACHIDAISHU-SUBSTRINGS\n"
+
+
+def open_db(filename):
+    """Open a database file for reading as text.
+
+    Files ending in .gz, .xz or .bz2 are decompressed transparently, "-" reads
+    from standard input, and an already open text file object is used as is
+    (it is not closed afterwards)."""
+    if filename == "-":
+        return contextlib.nullcontext(sys.stdin)
+    if not isinstance(filename, (str, os.PathLike)):
+        return contextlib.nullcontext(filename)
+    opener = {".gz": gzip.open, ".xz": lzma.open, ".bz2": bz2.open}.get(
+        os.path.splitext(filename)[1], open
+    )
+    return opener(filename, "rt", encoding="utf-8")
+
 
 @dataclass
 class Token:
@@ -35,93 +104,2506 @@ class Token:
     kanji: str
     kanji_reading: str
 
-    def __post_init__(self):
-        self.ipa_pos = chasenid2pos[self.chasen_id]
-        self.ipa_en_pos = chasenid2pos_en[self.chasen_id]
-        self.unidic_pos = ipadic2unidic[self.ipa_pos]
-        self.ud_pos = None
+    def __post_init__(self):
+        self.ipa_pos, self.ipa_en_pos, self.unidic_pos = CHASEN_POS[self.chasen_id]
+        self.ud_pos = None
+
+    def __repr__(self):
+        return f"{self.surface}/{self.unidic_pos}/{self.ud_pos}/{self.lemma}"
+
+    def __iter__(self):
+        return iter(astuple(self))
+
+    def to_json(self):
+        return dict(zip(TOKEN_FIELDS, _token_values(self)))
+
+
+TOKEN_FIELDS = tuple(f.name for f in fields(Token))
+# Equivalent to, but much faster than, dataclasses.astuple() for Tokens, whose
+# fields are all strings or None.
+_token_values = attrgetter(*TOKEN_FIELDS)
+
+
+class _LazyPOS:
+    """A POS attribute of LazyToken, looked up in CHASEN_POS on each access."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __get__(self, token, owner=None):
+        if token is None:
+            return self
+        return CHASEN_POS[token.chasen_id][self.index]
+
+
+class _LazyReading:
+    """A reading attribute of LazyToken. The first access splits the readings
+    into the token's attributes, which hide this descriptor from then on."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, token, owner=None):
+        if token is None:
+            return self
+        token.lemma_reading, token.kanji, token.kanji_reading = token._readings.split(
+            " "
+        )
+        del token._readings
+        return getattr(token, self.name)
+
+
+class LazyToken(Token):
+    """A Token that resolves its POS attributes from CHASEN_POS on access
+    rather than storing them, and keeps `readings` ("lemma_reading kanji
+    kanji_reading", the end of its database row) unsplit until one of them is
+    first accessed. It has the same attribute values and compares equal to
+    the corresponding Token. See HachidaishuDB(lazy=True)."""
+
+    ipa_pos = _LazyPOS(0)
+    ipa_en_pos = _LazyPOS(1)
+    unidic_pos = _LazyPOS(2)
+    lemma_reading = _LazyReading()
+    kanji = _LazyReading()
+    kanji_reading = _LazyReading()
+
+    def __init__(self, token_type, bg_id, chasen_id, surface, lemma, readings):
+        self.token_type = token_type
+        self.bg_id = bg_id
+        self.chasen_id = chasen_id
+        self.surface = surface
+        self.lemma = lemma
+        self._readings = readings
+        self.ud_pos = None
+
+    def __eq__(self, other):
+        if isinstance(other, Token):
+            return _token_values(self) == _token_values(other)
+        return NotImplemented
+
+
+def _token_key(token):
+    """Return a key that is equal for two tokens if and only if all their
+    fields are (the POS fields follow from chasen_id). Unlike _token_values(),
+    it leaves the readings of a LazyToken unsplit."""
+    readings = token.__dict__.get("_readings")
+    if readings is None:
+        readings = f"{token.lemma_reading} {token.kanji} {token.kanji_reading}"
+    return (
+        token.token_type,
+        token.bg_id,
+        token.chasen_id,
+        token.ud_pos,
+        token.surface,
+        token.lemma,
+        readings,
+    )
+
+
+@dataclass
+class Decomposition:
+    tokens: List[Token]
+    decomposition_type: str
+
+    def __getitem__(self, index: int) -> Token:
+        return self.tokens[index]
+
+    def __iter__(self):
+        return iter(astuple(self))
+
+
+@dataclass
+class HachidaishuRecord:
+    anthology: Anthology
+    poem: int
+    serial: int
+    segments: List[Decomposition]
+
+    def __iter__(self):
+        return iter(astuple(self)[:3] + astuple(self.token()))
+
+    def keys(self):
+        return [f.name for f in fields(self)][:3] + [
+            f.name for f in fields(self.token())
+        ]
+
+    def to_json(self):
+        return {
+            "anthology": self.anthology.name,
+            "poem": self.poem,
+        } | self.token().to_json()
+
+    def token(self):
+        """Return the canonical decomposition (always one token), ignoring any alternative variants."""
+        return self.segments[0][0]
+
+    def decompositions(self):
+        """Return a list containing the alternative decompositions of segment record."""
+        return self.segments
+
+
+def _record_to_tuple(record):
+    return (
+        record.anthology.value,
+        record.poem,
+        record.serial,
+        tuple(
+            (
+                decomposition.decomposition_type,
+                tuple(_token_values(token) for token in decomposition.tokens),
+            )
+            for decomposition in record.segments
+        ),
+    )
+
+
+def _token_from_tuple(values):
+    token = Token.__new__(Token)
+    token.__dict__.update(zip(TOKEN_FIELDS, values))
+    return token
+
+
+def _record_from_tuple(row):
+    anthology, poem, serial, segments = row
+    return HachidaishuRecord(
+        Anthology(anthology),
+        poem,
+        serial,
+        [
+            Decomposition(
+                [_token_from_tuple(values) for values in tokens], decomposition_type
+            )
+            for decomposition_type, tokens in segments
+        ],
+    )
+
+
+class Vocabulary:
+    """Interned string table assigning consecutive integer codes to values.
+    None is not stored and is always encoded as -1."""
+
+    def __init__(self, strings=()):
+        self.strings: list[str] = list(strings)
+        self.index: dict[str, int] = {s: i for i, s in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code: int) -> str | None:
+        return self.strings[code] if code >= 0 else None
+
+    def add(self, s: str | None) -> int:
+        if s is None:
+            return -1
+        code = self.index.get(s)
+        if code is None:
+            code = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return code
+
+    def code(self, s: str | None) -> int:
+        """Return the code of `s`, raising KeyError if it is not in the table."""
+        return -1 if s is None else self.index[s]
+
+
+class ColumnarStore:
+    """Integer-coded, column-oriented representation of retokenized records.
+
+    Every Token field is stored as an int32 code into a per-field Vocabulary.
+    Records, decomposition segments and tokens are kept in parallel arrays:
+
+    - record level: `anthology`, `poem`, `serial` and `record_segments`, the
+      offsets of each record's segments (record i owns segments
+      record_segments[i]:record_segments[i + 1]);
+    - segment level: `segment_type` (code into `segment_types`),
+      `segment_record` and `segment_tokens` offsets into the token columns;
+    - token level: one code column per Token field in `codes`, plus
+      `token_record` and `token_segment` giving each token's membership.
+
+    The store behaves as a read-only sequence of HachidaishuRecord objects,
+    which are created on demand from the columns. Changes made to these views
+    are not written back.
+    """
+
+    def __init__(
+        self,
+        vocabularies,
+        codes,
+        anthology,
+        poem,
+        serial,
+        record_segments,
+        segment_type,
+        segment_types,
+        segment_record,
+        segment_tokens,
+        token_record,
+        token_segment,
+    ):
+        self.vocabularies: dict[str, Vocabulary] = vocabularies
+        self.codes: dict = codes
+        self.anthology = anthology
+        self.poem = poem
+        self.serial = serial
+        self.record_segments = record_segments
+        self.segment_type = segment_type
+        self.segment_types: Vocabulary = segment_types
+        self.segment_record = segment_record
+        self.segment_tokens = segment_tokens
+        self.token_record = token_record
+        self.token_segment = token_segment
+
+    @classmethod
+    def from_records(cls, records):
+        if np is None:
+            raise ImportError("The columnar backend requires NumPy.")
+        vocabularies = {name: Vocabulary() for name in TOKEN_FIELDS}
+        adders = [vocabularies[name].add for name in TOKEN_FIELDS]
+        codes = [[] for _ in TOKEN_FIELDS]
+        segment_types = Vocabulary()
+        anthology, poem, serial = [], [], []
+        record_segments, segment_type, segment_record, segment_tokens = [0], [], [], [0]
+        token_record, token_segment = [], []
+        for i, record in enumerate(records):
+            anthology.append(record.anthology.value)
+            poem.append(record.poem)
+            serial.append(record.serial)
+            for segment in record.segments:
+                s = len(segment_type)
+                segment_type.append(segment_types.add(segment.decomposition_type))
+                segment_record.append(i)
+                for token in segment.tokens:
+                    for column, add, name in zip(codes, adders, TOKEN_FIELDS):
+                        column.append(add(getattr(token, name)))
+                    token_record.append(i)
+                    token_segment.append(s)
+                segment_tokens.append(len(token_record))
+            record_segments.append(len(segment_type))
+        return cls(
+            vocabularies,
+            {
+                name: np.array(column, dtype=np.int32)
+                for name, column in zip(TOKEN_FIELDS, codes)
+            },
+            np.array(anthology, dtype=np.uint8),
+            np.array(poem, dtype=np.int32),
+            np.array(serial, dtype=np.int32),
+            np.array(record_segments, dtype=np.int64),
+            np.array(segment_type, dtype=np.int32),
+            segment_types,
+            np.array(segment_record, dtype=np.int32),
+            np.array(segment_tokens, dtype=np.int64),
+            np.array(token_record, dtype=np.int32),
+            np.array(token_segment, dtype=np.int32),
+        )
+
+    # Array columns besides the token codes, as stored by save().
+    ARRAYS = (
+        "anthology",
+        "poem",
+        "serial",
+        "record_segments",
+        "segment_type",
+        "segment_record",
+        "segment_tokens",
+        "token_record",
+        "token_segment",
+    )
+
+    def save(self, filename):
+        """Write the store to `filename` in the binary corpus format.
+
+        The file starts with CORPUS_MAGIC, followed by the length of a JSON
+        header as a little-endian uint64 and the header itself. The header
+        gives the dtype, offset and length of every array column ("codes.<field>"
+        for token fields) and the offset, size and length of every string
+        table (one per token field, plus "segment_types"), relative to the
+        start of the data section that follows, aligned to 8 bytes. Columns are
+        stored as little-endian arrays and string tables as newline-separated
+        UTF-8, as no database field contains whitespace."""
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            for chunk in self._chunks():
+                f.write(chunk)
+        os.replace(tmp, filename)
+
+    def _chunks(self):
+        """Return the contents of a corpus file for the store (see save()) as a
+        list of bytes objects."""
+        columns = {f"codes.{name}": self.codes[name] for name in TOKEN_FIELDS}
+        columns.update((name, getattr(self, name)) for name in self.ARRAYS)
+        tables = {name: self.vocabularies[name] for name in TOKEN_FIELDS}
+        tables["segment_types"] = self.segment_types
+
+        header = {"version": CORPUS_VERSION, "arrays": {}, "strings": {}}
+        blobs = []
+        offset = 0
+        for name, column in columns.items():
+            column = column.astype(column.dtype.newbyteorder("<"), copy=False)
+            header["arrays"][name] = [column.dtype.str, offset, len(column)]
+            blobs.append(column.tobytes())
+            offset += -(-len(blobs[-1]) // 8) * 8
+        for name, vocabulary in tables.items():
+            data = "\n".join(vocabulary.strings).encode("utf-8")
+            header["strings"][name] = [offset, len(data), len(vocabulary)]
+            blobs.append(data)
+            offset += -(-len(data) // 8) * 8
+        header = json.dumps(header).encode("utf-8")
+        start = len(CORPUS_MAGIC) + 8 + len(header)
+        chunks = [
+            CORPUS_MAGIC,
+            struct.pack("<Q", len(header)),
+            header,
+            bytes(-start % 8),
+        ]
+        for blob in blobs:
+            chunks += [blob, bytes(-len(blob) % 8)]
+        return chunks
+
+    @classmethod
+    def open(cls, filename):
+        """Open a file written by save() as a memory-mapped store.
+
+        The array columns are read-only NumPy views into the mapping, so
+        opening takes constant time and processes mapping the same file share
+        its pages through the page cache; only the string tables are decoded."""
+        if np is None:
+            raise ImportError("The columnar backend requires NumPy.")
+        with open(filename, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(buffer, filename)
+
+    @classmethod
+    def from_buffer(cls, buffer, source="buffer"):
+        """Create a store viewing `buffer`, which holds the contents of a
+        corpus file (see save()). The arrays are not copied, and are read-only
+        if `buffer` is. `source` names the buffer in error messages."""
+        if np is None:
+            raise ImportError("The columnar backend requires NumPy.")
+        if bytes(buffer[: len(CORPUS_MAGIC)]) != CORPUS_MAGIC:
+            raise ValueError(f"{source} is not a Hachidaishu corpus file.")
+        (length,) = struct.unpack_from("<Q", buffer, len(CORPUS_MAGIC))
+        start = len(CORPUS_MAGIC) + 8
+        header = json.loads(bytes(buffer[start : start + length]))
+        if header["version"] != CORPUS_VERSION:
+            raise ValueError(
+                f"{source} has corpus format version {header['version']}, "
+                f"expected {CORPUS_VERSION}."
+            )
+        start += length + -(start + length) % 8
+
+        def column(name):
+            dtype, offset, count = header["arrays"][name]
+            return np.frombuffer(
+                buffer, dtype=dtype, count=count, offset=start + offset
+            )
+
+        def table(name):
+            offset, size, count = header["strings"][name]
+            data = bytes(buffer[start + offset : start + offset + size]).decode("utf-8")
+            return Vocabulary(data.split("\n") if count else ())
+
+        return cls(
+            {name: table(name) for name in TOKEN_FIELDS},
+            {name: column(f"codes.{name}") for name in TOKEN_FIELDS},
+            column("anthology"),
+            column("poem"),
+            column("serial"),
+            column("record_segments"),
+            column("segment_type"),
+            table("segment_types"),
+            column("segment_record"),
+            column("segment_tokens"),
+            column("token_record"),
+            column("token_segment"),
+        )
+
+    def __len__(self):
+        return len(self.anthology)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.record(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return self.record(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by the array columns (excluding vocabularies)."""
+        arrays = list(self.codes.values()) + [
+            getattr(self, name) for name in self.ARRAYS
+        ]
+        return sum(a.nbytes for a in arrays)
+
+    def canonical_mask(self):
+        """Return a boolean array selecting the canonical token of each record
+        (first token of its first decomposition)."""
+        mask = np.zeros(len(self.token_record), dtype=bool)
+        mask[self.segment_tokens[self.record_segments[:-1]]] = True
+        return mask
+
+    def record_keys(self):
+        """Return (anthology, poem, serial) tuples for all records."""
+        return zip(self.anthology.tolist(), self.poem.tolist(), self.serial.tolist())
+
+    def token(self, t: int) -> Token:
+        """Create a Token view of token row `t`."""
+        return _token_from_tuple(
+            tuple(
+                self.vocabularies[name][int(self.codes[name][t])]
+                for name in TOKEN_FIELDS
+            )
+        )
+
+    def tokens(self, rows):
+        """Yield Token views of the token rows in the integer array `rows`,
+        decoding their columns in bulk."""
+        for k in range(0, len(rows), 8192):
+            chunk = rows[k : k + 8192]
+            columns = [
+                map(
+                    self.vocabularies[name].__getitem__,
+                    self.codes[name][chunk].tolist(),
+                )
+                for name in TOKEN_FIELDS
+            ]
+            for values in zip(*columns):
+                yield _token_from_tuple(values)
+
+    @staticmethod
+    def record_rows(ranges):
+        """Return the record rows in `ranges`, a list of [start, stop) pairs."""
+        return np.concatenate(
+            [np.arange(start, stop) for start, stop in ranges]
+            or [np.empty(0, np.int64)]
+        )
+
+    def token_rows(self, ranges, mode="default"):
+        """Return the token rows of the records in `ranges`: the canonical token
+        of each record with mode="default", or all of their tokens with
+        mode="decomposition"."""
+        if mode == "default":
+            return self.segment_tokens[self.record_segments[self.record_rows(ranges)]]
+        bounds = self.segment_tokens[self.record_segments]
+        return self.record_rows(
+            [(bounds[start], bounds[stop]) for start, stop in ranges]
+        )
+
+    def record(self, i: int) -> HachidaishuRecord:
+        """Create a HachidaishuRecord view of record row `i`."""
+        start, stop = self.record_segments[i], self.record_segments[i + 1]
+        return HachidaishuRecord(
+            Anthology(int(self.anthology[i])),
+            int(self.poem[i]),
+            int(self.serial[i]),
+            [
+                Decomposition(
+                    [
+                        self.token(t)
+                        for t in range(
+                            self.segment_tokens[s], self.segment_tokens[s + 1]
+                        )
+                    ],
+                    self.segment_types[int(self.segment_type[s])],
+                )
+                for s in range(start, stop)
+            ],
+        )
+
+
+class InvertedIndex:
+    """Posting lists from Token field values to token occurrences.
+
+    Every token of every decomposition is numbered in database order; for each
+    token number t, `token_record[t]`, `token_decomposition[t]` and
+    `token_position[t]` give the record index, the index of the decomposition
+    within the record and the position of the token within the decomposition.
+    `postings[field][value]` lists the token numbers whose `field` equals
+    `value`. The canonical token of a record is the one at decomposition 0,
+    position 0."""
+
+    FIELDS = ("surface", "lemma", "lemma_reading", "kanji_reading", "bg_id")
+
+    def __init__(self, records, fields=FIELDS):
+        self.fields = tuple(fields)
+        self.token_record = array("i")
+        self.token_decomposition = array("i")
+        self.token_position = array("i")
+        self.postings: dict[str, dict[str, array]] = {f: {} for f in self.fields}
+        if isinstance(records, ColumnarStore):
+            self._index_columns(records)
+        else:
+            self._index_records(records)
+
+    def _index_records(self, records):
+        t = 0
+        for r, record in enumerate(records):
+            for d, decomposition in enumerate(record.segments):
+                for p, token in enumerate(decomposition.tokens):
+                    self.token_record.append(r)
+                    self.token_decomposition.append(d)
+                    self.token_position.append(p)
+                    for name in self.fields:
+                        postings = self.postings[name]
+                        value = getattr(token, name)
+                        if value not in postings:
+                            postings[value] = array("i")
+                        postings[value].append(t)
+                    t += 1
+
+    def _index_columns(self, store):
+        tokens = np.arange(len(store.token_record), dtype=np.int32)
+        self.token_record.frombytes(store.token_record.astype(np.int32).tobytes())
+        self.token_decomposition.frombytes(
+            (store.token_segment - store.record_segments[store.token_record])
+            .astype(np.int32)
+            .tobytes()
+        )
+        self.token_position.frombytes(
+            (tokens - store.segment_tokens[store.token_segment])
+            .astype(np.int32)
+            .tobytes()
+        )
+        for name in self.fields:
+            codes = store.codes[name]
+            order = np.argsort(codes, kind="stable").astype(np.int32)
+            sorted_codes = codes[order]
+            starts = np.flatnonzero(np.diff(sorted_codes)) + 1
+            vocabulary = store.vocabularies[name]
+            postings = self.postings[name]
+            for chunk in np.split(order, starts):
+                if len(chunk):
+                    value = vocabulary[int(codes[chunk[0]])]
+                    postings[value] = array("i", chunk.tobytes())
+
+    def occurrences(self, field, value, mode="default"):
+        """Return (record index, decomposition, position) triples for tokens
+        whose `field` equals `value`, in database order. With mode="default"
+        only canonical tokens are considered, with mode="decomposition" all
+        decompositions are."""
+        result = []
+        for t in self.postings[field].get(value, ()):
+            d, p = self.token_decomposition[t], self.token_position[t]
+            if mode == "default" and (d or p):
+                continue
+            result.append((self.token_record[t], d, p))
+        return result
+
+
+@dataclass
+class ConcordanceLine:
+    """A keyword-in-context hit: `token` at position `position` of
+    decomposition `decomposition` in record `record`, with the canonical tokens
+    of up to `width` preceding and following records of the same poem."""
+
+    anthology: Anthology
+    poem: int
+    serial: int
+    record: int
+    decomposition: int
+    position: int
+    left: List[Token]
+    token: Token
+    right: List[Token]
+
+    def __str__(self):
+        left = " ".join(t.surface for t in self.left)
+        right = " ".join(t.surface for t in self.right)
+        return (
+            f"{self.anthology.name}:{self.poem}\t{left} [{self.token.surface}] {right}"
+        )
+
+
+@dataclass
+class SubstringMatch:
+    """An occurrence of a substring in the text of a poem: it starts `offset`
+    characters into the canonical token at `position` of the poem (counting
+    from 0), which belongs to record `record`, and ends in the token before
+    position `stop`."""
+
+    anthology: Anthology
+    poem: int
+    record: int
+    position: int
+    stop: int
+    offset: int
+
+
+def _suffix_array(text):
+    """Return the suffix array of the integer array `text`, by prefix doubling:
+    suffixes are sorted by their first 2k characters, given the ranks of their
+    first k characters, until all ranks are distinct."""
+    n = len(text)
+    rank = np.unique(text, return_inverse=True)[1].astype(np.int64)
+    order = np.argsort(rank, kind="stable")
+    k = 1
+    while n and rank.max() < n - 1:
+        # Suffixes shorter than k + 1 characters sort first among equals.
+        following = np.zeros(n, dtype=np.int64)
+        following[: n - k] = rank[k:] + 1
+        keys = rank * (n + 1) + following
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        rank[order] = np.cumsum(np.diff(sorted_keys, prepend=sorted_keys[:1]) != 0)
+        k *= 2
+    return order
+
+
+def _write_arrays(filename, magic, header, arrays):
+    """Write `header` (a JSON object) and `arrays` (a dict of NumPy arrays) to
+    `filename` in the layout of corpus files (see ColumnarStore.save()), after
+    `magic`. The header gains an "arrays" entry locating the arrays."""
+    header = dict(header, arrays={})
+    blobs = []
+    offset = 0
+    for name, values in arrays.items():
+        values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+        header["arrays"][name] = [values.dtype.str, offset, len(values)]
+        blobs.append(values.tobytes())
+        offset += -(-len(blobs[-1]) // 8) * 8
+    header = json.dumps(header).encode("utf-8")
+    start = len(magic) + 8 + len(header)
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(bytes(-start % 8))
+        for blob in blobs:
+            f.write(blob)
+            f.write(bytes(-len(blob) % 8))
+    os.replace(tmp, filename)
+
+
+def _open_arrays(filename, magic, version):
+    """Memory-map a file written by _write_arrays() and return its header and
+    read-only views of its arrays."""
+    with open(filename, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[: len(magic)] != magic:
+        raise ValueError(f"{filename} is not a {magic.decode().strip()} file.")
+    (length,) = struct.unpack_from("<Q", buffer, len(magic))
+    start = len(magic) + 8
+    header = json.loads(buffer[start : start + length])
+    if header["version"] != version:
+        raise ValueError(
+            f"{filename} has format version {header['version']}, expected {version}."
+        )
+    start += length + -(start + length) % 8
+    arrays = {
+        name: np.frombuffer(buffer, dtype=dtype, count=count, offset=start + offset)
+        for name, (dtype, offset, count) in header["arrays"].items()
+    }
+    return header, arrays
+
+
+class SubstringIndex:
+    """Suffix array over the text of every poem in one token `field`, for
+    finding substrings across token boundaries (e.g. kakekotoba or hidden
+    names in kana readings).
+
+    The text of a poem is the concatenation of its canonical tokens' values,
+    and the poems are joined by NUL characters, so that matches never span
+    two poems. Searching takes O(m log n) time for a pattern of m characters
+    in a text of n; every occurrence is mapped back to its poem and token
+    positions. Build an index with from_store(), and save() it to open() it
+    later without rebuilding."""
+
+    ARRAYS = (
+        "text",
+        "suffixes",
+        "token_starts",
+        "token_records",
+        "poem_tokens",
+        "anthology",
+        "poem",
+    )
+
+    def __init__(
+        self,
+        field,
+        text,
+        suffixes,
+        token_starts,
+        token_records,
+        poem_tokens,
+        anthology,
+        poem,
+    ):
+        self.field = field
+        self.text = text  # int32 code points
+        self.suffixes = suffixes  # start offsets of the sorted suffixes of text
+        self.token_starts = token_starts  # text offset of each canonical token
+        self.token_records = token_records  # record index of each canonical token
+        self.poem_tokens = (
+            poem_tokens  # first token of each poem, and the number of tokens
+        )
+        self.anthology = anthology  # anthology number of each poem
+        self.poem = poem  # poem number of each poem
+
+    @classmethod
+    def from_store(cls, store, field="surface"):
+        """Build the index of `field` over the records of a ColumnarStore."""
+        tokens = np.flatnonzero(store.canonical_mask())
+        token_records = store.token_record[tokens]
+        anthology = store.anthology[token_records]
+        poem = store.poem[token_records]
+        starts = np.ones(len(tokens), dtype=bool)
+        starts[1:] = (anthology[1:] != anthology[:-1]) | (poem[1:] != poem[:-1])
+        poem_tokens = np.append(np.flatnonzero(starts), len(tokens))
+
+        # Code points of the token values, with a NUL after each poem's last.
+        strings = store.vocabularies[field].strings + [""]  # None is coded -1.
+        codes = store.codes[field][tokens]
+        lengths = np.array([len(string) for string in strings], dtype=np.int64)[codes]
+        lengths[poem_tokens[1:] - 1] += 1
+        token_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        points = [
+            ord(c)
+            for c in "\0".join(
+                "".join(strings[c] for c in codes[lo:hi].tolist())
+                for lo, hi in zip(poem_tokens[:-1].tolist(), poem_tokens[1:].tolist())
+            )
+        ]
+        if len(poem_tokens) > 1:
+            points.append(0)
+        text = np.array(points, dtype=np.int32)
+        dtype = np.int32 if len(text) < 2**31 else np.int64
+        return cls(
+            field,
+            text,
+            _suffix_array(text).astype(dtype),
+            token_starts,
+            token_records.astype(np.int64),
+            poem_tokens.astype(np.int64),
+            anthology[starts],
+            poem[starts],
+        )
+
+    def __len__(self):
+        return len(self.text)
+
+    def _range(self, pattern):
+        """Return the [lo, hi) range of the suffixes starting with `pattern`."""
+        if not pattern or "\0" in pattern:
+            raise ValueError("The pattern must be a non-empty string without NUL.")
+        key = [ord(c) for c in pattern]
+        m = len(key)
+        text, suffixes = self.text, self.suffixes
+        lo, hi = 0, len(suffixes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = int(suffixes[mid])
+            if text[start : start + m].tolist() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        first, hi = lo, len(suffixes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = int(suffixes[mid])
+            if text[start : start + m].tolist() <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return first, lo
+
+    def count(self, pattern):
+        """Return the number of occurrences of `pattern`."""
+        lo, hi = self._range(pattern)
+        return hi - lo
+
+    def search(self, pattern, match="substring"):
+        """Return a SubstringMatch for every occurrence of `pattern`, in
+        database order. With match="prefix" only occurrences starting at the
+        start of a token are returned, and with match="exact" only those
+        that also end at the end of a token."""
+        if match not in ("substring", "prefix", "exact"):
+            raise ValueError(f"Unknown match: {match}")
+        lo, hi = self._range(pattern)
+        offsets = np.sort(self.suffixes[lo:hi].astype(np.int64))
+        # The last of several tokens starting at an offset is the nonempty one.
+        first = np.searchsorted(self.token_starts, offsets, "right") - 1
+        last = (
+            np.searchsorted(self.token_starts, offsets + len(pattern) - 1, "right") - 1
+        )
+        offset = offsets - self.token_starts[first]
+        keep = np.ones(len(offsets), dtype=bool)
+        if match != "substring":
+            keep &= offset == 0
+        if match == "exact":
+            ends = np.append(self.token_starts[1:], len(self.text))
+            # A poem's last token is followed by the NUL separator.
+            ends[self.poem_tokens[1:] - 1] -= 1
+            keep &= offsets + len(pattern) == ends[last]
+        first, last, offset = first[keep], last[keep], offset[keep]
+        poems = np.searchsorted(self.poem_tokens, first, "right") - 1
+        return [
+            SubstringMatch(Anthology(a), p, r, t - s, u - s + 1, o)
+            for a, p, r, t, u, s, o in zip(
+                self.anthology[poems].tolist(),
+                self.poem[poems].tolist(),
+                self.token_records[first].tolist(),
+                first.tolist(),
+                last.tolist(),
+                self.poem_tokens[poems].tolist(),
+                offset.tolist(),
+            )
+        ]
+
+    def save(self, filename):
+        """Write the index to `filename`, in the layout of corpus files (see
+        ColumnarStore.save()) with SUBSTRING_MAGIC."""
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        _write_arrays(
+            filename,
+            SUBSTRING_MAGIC,
+            {"version": SUBSTRING_VERSION, "field": self.field},
+            arrays,
+        )
+
+    @classmethod
+    def open(cls, filename):
+        """Open an index written by save(), memory-mapped like
+        ColumnarStore.open()."""
+        header, arrays = _open_arrays(filename, SUBSTRING_MAGIC, SUBSTRING_VERSION)
+        return cls(header["field"], *(arrays[name] for name in cls.ARRAYS))
+
+
+@dataclass(frozen=True)
+class SemanticCategory:
+    """Decoded Bunruigoihyo (WLSP) classification of a bg_id.
+
+    For `BG-02-1527-01-0102`, word_class is 2 (用), division 1, item 1527,
+    paragraph 1 and subparagraph 102; its classification number is "2.1527".
+    Components that are not numeric (as the `JP` in the Hachidaishu-specific
+    `CH-JP-0000-00-0000`) are -1."""
+
+    word_class: int
+    division: int
+    item: int
+    paragraph: int
+    subparagraph: int
+
+    def label(self, level="item"):
+        """Return the label of this category at hierarchy `level` (one of
+        SemanticIndex.LEVELS): "2", "2.1", "2.15", "2.1527", "2.1527-01" or
+        "2.1527-01-0102"."""
+        if level == "class":
+            return f"{self.word_class}"
+        if level == "division":
+            return f"{self.word_class}.{self.division}"
+        if level == "section":
+            return f"{self.word_class}.{self.item // 100:02}"
+        if level == "item":
+            return f"{self.word_class}.{self.item:04}"
+        if level == "paragraph":
+            return f"{self.label()}-{self.paragraph:02}"
+        if level == "subparagraph":
+            return f"{self.label()}-{self.paragraph:02}-{self.subparagraph:04}"
+        raise ValueError(f"Unknown level: {level}")
+
+
+def decode_bg_id(bg_id):
+    """Decode a bg_id string such as `BG-02-1527-01-0102` into a
+    SemanticCategory."""
+    word_class, item, paragraph, subparagraph = (
+        int(part) if part.isdigit() else -1
+        for part in (bg_id.split("-") + [""] * 4)[1:5]
+    )
+    return SemanticCategory(
+        word_class,
+        item // 1000 if item >= 0 else -1,
+        item,
+        paragraph,
+        subparagraph,
+    )
+
+
+def _category_range(code):
+    """Return the [low, high) sort key range covered by a classification number
+    prefix such as "1", "1.5", "1.527", "1.5270", "1.5270-01" or
+    "1.5270-01-0102"."""
+    word_class, _, rest = code.partition(".")
+    word_class = int(word_class)
+    if not rest:
+        return (word_class,), (word_class + 1,)
+    digits, *parts = rest.split("-")
+    scale = 10 ** (4 - len(digits))
+    item = int(digits) * scale
+    if not parts:
+        return (word_class, item), (word_class, item + scale)
+    low = (word_class, item) + tuple(int(part) for part in parts)
+    return low, low[:-1] + (low[-1] + 1,)
+
+
+class SemanticIndex:
+    """Hierarchical index over the Bunruigoihyo categories of all tokens.
+
+    Built on top of the bg_id postings of an InvertedIndex. Each distinct bg_id
+    is decoded once into the integer columns `word_class`, `division`, `item`,
+    `paragraph` and `subparagraph`, sorted by classification so that a
+    classification number prefix (such as "1.5" for nature) or a range of
+    classification numbers maps to a contiguous run of bg_ids. Occurrences and
+    counts per hierarchy level are then read off the posting lists."""
+
+    LEVELS = ("class", "division", "section", "item", "paragraph", "subparagraph")
+
+    def __init__(self, inverted_index):
+        self.inverted_index = inverted_index
+        postings = inverted_index.postings["bg_id"]
+        categories = sorted(
+            ((decode_bg_id(bg_id), bg_id) for bg_id in postings),
+            key=lambda c: self._key(c[0]),
+        )
+        self.bg_ids = [bg_id for _, bg_id in categories]
+        self.categories = [category for category, _ in categories]
+        self.keys = [self._key(category) for category in self.categories]
+        for name in (f.name for f in fields(SemanticCategory)):
+            setattr(
+                self,
+                name,
+                array("i", (getattr(category, name) for category in self.categories)),
+            )
+        decomposition = inverted_index.token_decomposition
+        position = inverted_index.token_position
+        self.postings = [postings[bg_id] for bg_id in self.bg_ids]
+        self.canonical_postings = [
+            array("i", (t for t in ts if not (decomposition[t] or position[t])))
+            for ts in self.postings
+        ]
+
+    @staticmethod
+    def _key(category):
+        return (
+            category.word_class,
+            category.item,
+            category.paragraph,
+            category.subparagraph,
+        )
+
+    def _span(self, start, stop=None):
+        """Return the [lo, hi) slice of self.bg_ids under classification prefix
+        `start`, or from `start` through `stop` when `stop` is given."""
+        low, high = _category_range(start)
+        if stop is not None:
+            _, high = _category_range(stop)
+        lo = bisect_left(self.keys, low)
+        return lo, max(lo, bisect_left(self.keys, high))
+
+    def _token_ranges(self, records):
+        """Translate [start, stop) record ranges into token number ranges."""
+        token_record = self.inverted_index.token_record
+        return [
+            (bisect_left(token_record, start), bisect_left(token_record, stop))
+            for start, stop in records
+        ]
+
+    def bg_ids_under(self, start, stop=None):
+        """Return the bg_ids under classification prefix `start`, or from
+        `start` through `stop`."""
+        lo, hi = self._span(start, stop)
+        return self.bg_ids[lo:hi]
+
+    def occurrences(self, start, stop=None, mode="default", records=None):
+        """Return (record index, decomposition, position) triples of tokens
+        under classification prefix `start` (e.g. "1.5"), or from `start`
+        through `stop` (e.g. "1.50", "1.52"), in database order. `records` may
+        restrict the search to a list of [start, stop) record ranges."""
+        lo, hi = self._span(start, stop)
+        postings = (self.canonical_postings if mode == "default" else self.postings)[
+            lo:hi
+        ]
+        ranges = (
+            self._token_ranges(records) if records is not None else [(0, sys.maxsize)]
+        )
+        tokens = sorted(
+            t
+            for ts in postings
+            for a, b in ranges
+            for t in ts[bisect_left(ts, a) : bisect_left(ts, b)]
+        )
+        ix = self.inverted_index
+        return [
+            (ix.token_record[t], ix.token_decomposition[t], ix.token_position[t])
+            for t in tokens
+        ]
+
+    def counts(self, level="division", prefix=None, mode="default", records=None):
+        """Return a Counter of tokens per category label at hierarchy `level`,
+        optionally only under classification `prefix` and within the record
+        ranges `records`."""
+        if level not in self.LEVELS:
+            raise ValueError(f"Unknown level: {level}")
+        lo, hi = self._span(prefix) if prefix else (0, len(self.bg_ids))
+        postings = self.canonical_postings if mode == "default" else self.postings
+        ranges = self._token_ranges(records) if records is not None else None
+        counts = Counter()
+        for i in range(lo, hi):
+            ts = postings[i]
+            if ranges is None:
+                n = len(ts)
+            else:
+                n = sum(bisect_left(ts, b) - bisect_left(ts, a) for a, b in ranges)
+            if n:
+                counts[self.categories[i].label(level)] += n
+        return counts
+
+
+@dataclass
+class FrequencyTable:
+    """Token counts of feature values, in descending order of frequency."""
+
+    counts: "np.ndarray"
+    labels: list
+
+    def most_common(self, n=None):
+        """Return (label, count) pairs like Counter.most_common()."""
+        return list(zip(self.labels[:n], self.counts[:n].tolist()))
+
+
+@dataclass
+class ContingencyTable:
+    """Counts of feature values (columns) per anthology (rows). `counts` is a
+    dense NumPy array or, if requested, a SciPy CSR matrix."""
+
+    counts: object
+    rows: list
+    columns: list
+
+
+@dataclass
+class DocumentTermMatrix:
+    """Counts of feature values (columns) per poem or anthology (rows), e.g.
+    for topic models. `matrix` is a SciPy CSR matrix whose rows are aligned
+    with `rows`, (Anthology, poem) pairs or Anthologies in database order,
+    and whose columns are aligned with `columns`, the feature values in order
+    of first occurrence. Counts are integers, or float weights with
+    mode="decomposition"."""
+
+    matrix: object
+    rows: list
+    columns: list
+
+
+def _csr_matrix(feature):
+    """Return scipy.sparse.csr_matrix for `feature`, raising an ImportError
+    naming the feature if SciPy is not installed. SciPy is optional, and is
+    only imported when first needed as importing it takes a while."""
+    try:
+        from scipy.sparse import csr_matrix
+    except ImportError as e:
+        raise ImportError(f"{feature} requires SciPy (pip install scipy).") from e
+    return csr_matrix
+
+
+def _ud_pos_tags(ud_pos):
+    """Return the set of UD POS tags selected by `ud_pos` (a tag or a
+    collection of tags), or None to select all tokens."""
+    if ud_pos is None:
+        return None
+    return {ud_pos} if isinstance(ud_pos, str) else set(ud_pos)
+
+
+def build_document_term_matrix(
+    records, feature="lemma", rows="poem", mode="default", level="division", ud_pos=None
+):
+    """Build a DocumentTermMatrix from `records` in a single pass, keeping only
+    the matrix being built in memory, so that `records` may be a stream:
+
+        build_document_term_matrix(HachidaishuDB.stream("hachidai.db"), "lemma")
+
+    The records must be in database order. Rows are poems (`rows="poem"`) or
+    anthologies (`rows="anthology"`). `feature` and `level` are as for
+    HachidaishuDB.frequencies(); with `ud_pos` only tokens with one of these
+    UD POS tags (e.g. ("NOUN", "VERB")) are counted. With mode="decomposition"
+    the tokens of all alternative decompositions of a record are counted, each
+    weighted by one over the number of decompositions, so that every record
+    has a total weight of one analysis."""
+    if rows not in ("poem", "anthology"):
+        raise ValueError(f"Unknown rows: {rows}")
+    if mode not in ("default", "decomposition"):
+        raise ValueError(f"Unknown mode: {mode}")
+    features = (feature,) if isinstance(feature, str) else tuple(feature)
+    for name in features:
+        if name != "bg_category" and name not in TOKEN_FIELDS:
+            raise ValueError(f"Unknown feature: {name}")
+    tags = _ud_pos_tags(ud_pos)
+    categories = {}
+
+    def value(token, name):
+        if name != "bg_category":
+            return getattr(token, name)
+        if token.bg_id not in categories:
+            categories[token.bg_id] = decode_bg_id(token.bg_id).label(level)
+        return categories[token.bg_id]
+
+    def label(token):
+        if len(features) == 1:
+            return value(token, features[0])
+        return tuple(value(token, name) for name in features)
+
+    columns = {}
+    row_keys = []
+    seen = set()
+    indptr = array("q", [0])
+    indices = array("q")
+    data = array("q" if mode == "default" else "d")
+    if rows == "poem":
+        key = attrgetter("anthology", "poem")
+    else:
+        key = attrgetter("anthology")
+    for row, group in groupby(records, key=key):
+        if row in seen:
+            raise ValueError(f"The records of {row} are not contiguous.")
+        seen.add(row)
+        counts = Counter()
+        for record in group:
+            if mode == "default":
+                weighted = [(record.token(), 1)]
+            else:
+                weight = 1 / len(record.segments)
+                weighted = [
+                    (token, weight)
+                    for decomposition in record.segments
+                    for token in decomposition.tokens
+                ]
+            for token, weight in weighted:
+                if tags is None or token.ud_pos in tags:
+                    counts[columns.setdefault(label(token), len(columns))] += weight
+        row_keys.append(row)
+        for column in sorted(counts):
+            indices.append(column)
+            data.append(counts[column])
+        indptr.append(len(indices))
+
+    csr_matrix = _csr_matrix("build_document_term_matrix()")
+    matrix = csr_matrix(
+        (np.frombuffer(data, dtype=data.typecode), indices, indptr),
+        shape=(len(row_keys), len(columns)),
+    )
+    return DocumentTermMatrix(matrix, row_keys, list(columns))
+
+
+@dataclass
+class NgramTable:
+    """N-gram counts with association scores.
+
+    `labels[i]` is the tuple of feature values of the i-th n-gram, `counts[i]`
+    its frequency and `scores[measure][i]` its association score. Scores
+    measure the association between the first n-1 items and the last item of
+    the n-gram (the plain bigram measures for n=2)."""
+
+    labels: list
+    counts: "np.ndarray"
+    scores: dict
+
+    def ranked(self, measure="count", n=None):
+        """Return the `n` highest ranked (label, count, score) triples by
+        `measure` ("count", "pmi", "log_likelihood" or "t_score")."""
+        values = self.counts if measure == "count" else self.scores[measure]
+        order = np.argsort(-values, kind="stable")[:n]
+        return [(self.labels[i], int(self.counts[i]), float(values[i])) for i in order]
+
+
+class NgramEngine:
+    """Counts n-grams of canonical tokens without crossing poem boundaries.
+
+    The canonical token sequence of the whole database is encoded once as
+    integer codes of one Token `feature` (positions in database order, with the
+    anthology and a running poem number per position). N-grams are packed into
+    int64 keys in mixed radix, compacting the keys with np.unique whenever the
+    next radix would overflow, so any n is supported."""
+
+    MEASURES = ("pmi", "log_likelihood", "t_score")
+
+    def __init__(self, store, feature="lemma"):
+        mask = store.canonical_mask()
+        records = store.token_record[mask]
+        self.feature = feature
+        self.vocabulary = store.vocabularies[feature]
+        self.codes = store.codes[feature][mask].astype(np.int64)
+        self.anthology = store.anthology[records]
+        poem = store.poem[records]
+        starts = np.ones(len(records), dtype=bool)
+        starts[1:] = (self.anthology[1:] != self.anthology[:-1]) | (
+            poem[1:] != poem[:-1]
+        )
+        self.poem = np.cumsum(starts)
+
+    def _keys(self, n):
+        """Return the start positions of all n-grams within a poem and their
+        packed keys."""
+        positions = np.flatnonzero(
+            self.poem[n - 1 :] == self.poem[: len(self.poem) - n + 1]
+        )
+        radix = len(self.vocabulary) + 1
+        keys = np.zeros(len(positions), dtype=np.int64)
+        for k in range(n):
+            if keys.size and int(keys.max()) >= np.iinfo(np.int64).max // radix:
+                keys = np.unique(keys, return_inverse=True)[1].astype(np.int64)
+            keys = keys * radix + self.codes[positions + k] + 1
+        return positions, keys
+
+    def table(self, n=2, min_count=1, anthology=None):
+        """Return an NgramTable of n-grams occurring at least `min_count` times,
+        optionally counted within `anthology` only."""
+        if n < 2:
+            raise ValueError("n must be at least 2")
+        positions, keys = self._keys(n)
+        if n > 2:
+            prefix_positions, prefix_keys = self._keys(n - 1)
+            prefix_keys = prefix_keys[np.searchsorted(prefix_positions, positions)]
+        else:
+            prefix_keys = self.codes[positions]
+        last = self.codes[positions + n - 1]
+        if anthology:
+            selected = self.anthology[positions] == _anthology_value(anthology)
+            positions, keys = positions[selected], keys[selected]
+            prefix_keys, last = prefix_keys[selected], last[selected]
+
+        _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        _, prefix_inverse, prefix_counts = np.unique(
+            prefix_keys, return_inverse=True, return_counts=True
+        )
+        row_prefix = prefix_counts[prefix_inverse[first]]
+        row_last = np.bincount(last + 1)[last[first] + 1]
+
+        keep = counts >= min_count
+        first, counts = first[keep], counts[keep]
+        scores = _association_scores(
+            counts.astype(np.float64),
+            row_prefix[keep].astype(np.float64),
+            row_last[keep].astype(np.float64),
+            float(len(keys)),
+        )
+        starts = positions[first]
+        labels = [
+            tuple(
+                self.vocabulary[code] for code in self.codes[start : start + n].tolist()
+            )
+            for start in starts.tolist()
+        ]
+        return NgramTable(labels, counts, scores)
+
+
+def _association_scores(o11, r1, c1, n):
+    """Return PMI, log-likelihood (G²) and t-score arrays from the observed
+    frequencies `o11` of n-grams, the frequencies `r1` of their prefixes, `c1`
+    of their last items and the total number of n-grams `n`."""
+    e11 = r1 * c1 / n
+    observed = (o11, r1 - o11, c1 - o11, n - r1 - c1 + o11)
+    expected = (e11, r1 * (n - c1) / n, (n - r1) * c1 / n, (n - r1) * (n - c1) / n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_likelihood = 2 * sum(
+            np.where(o > 0, o * np.log(o / e), 0.0) for o, e in zip(observed, expected)
+        )
+        return {
+            "pmi": np.log2(o11 / e11),
+            "log_likelihood": log_likelihood,
+            "t_score": (o11 - e11) / np.sqrt(o11),
+        }
+
+
+def _mix64(x):
+    """The splitmix64 finalizer, applied elementwise to a uint64 array."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@dataclass
+class SimilarPoems:
+    """Pairs of similar poems with their estimated Jaccard similarity, in
+    descending order of similarity. Row i pairs poem (anthology[i, 0],
+    poem[i, 0]) with poem (anthology[i, 1], poem[i, 1])."""
+
+    anthology: "np.ndarray"
+    poem: "np.ndarray"
+    scores: "np.ndarray"
+
+    def __len__(self):
+        return len(self.scores)
+
+    def pairs(self, n=None):
+        """Return the `n` most similar pairs as ((anthology, poem), (anthology,
+        poem), similarity) tuples."""
+        return [
+            ((Anthology(a), p), (Anthology(b), q), score)
+            for (a, b), (p, q), score in zip(
+                self.anthology[:n].tolist(),
+                self.poem[:n].tolist(),
+                self.scores[:n].tolist(),
+            )
+        ]
+
+
+class SimilarityIndex:
+    """MinHash signatures of the poems, with locality-sensitive hashing to find
+    pairs of similar poems without comparing every pair.
+
+    A poem is the set of its shingles: runs of `shingle` consecutive canonical
+    tokens' `feature`, or with `characters=True` runs of `shingle` characters
+    of the concatenated feature values (e.g. feature="kanji_reading" for the
+    kana text of the poem). Each poem gets a signature of `num_perm` MinHash
+    values, and the fraction of signature values two poems share estimates the
+    Jaccard similarity of their shingle sets.
+
+    The signatures are cut into `bands` bands, and poems agreeing on a whole
+    band become a candidate pair, so that pairs of similarity s are found with
+    probability 1 - (1 - s**r)**bands, r = num_perm / bands. Similarities above
+    about (1 / bands)**(1 / r) (0.42 by default) are found almost surely; more
+    bands find less similar pairs at the cost of more candidates. Poems too
+    short to have a shingle are left out."""
+
+    def __init__(
+        self,
+        store,
+        feature="lemma",
+        shingle=2,
+        characters=False,
+        num_perm=128,
+        bands=32,
+        seed=0,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.feature = feature
+        self.shingle = shingle
+        self.characters = characters
+        self.num_perm = num_perm
+        self.bands = bands
+
+        mask = store.canonical_mask()
+        records = store.token_record[mask]
+        anthology = store.anthology[records]
+        poem = store.poem[records]
+        starts = np.ones(len(records), dtype=bool)
+        starts[1:] = (anthology[1:] != anthology[:-1]) | (poem[1:] != poem[:-1])
+        first = np.flatnonzero(starts)
+        self.anthology = anthology[first]
+        self.poem = poem[first]
+        units = store.codes[feature][mask].astype(np.int64)
+        unit_poem = np.cumsum(starts) - 1
+        if characters:
+            # Replace each token by the code points of its value (None, coded
+            # -1, has none).
+            strings = store.vocabularies[feature].strings
+            lengths = np.array(
+                [len(string) for string in strings] + [0], dtype=np.int64
+            )
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            points = np.array([ord(c) for c in "".join(strings)], dtype=np.int64)
+            counts = lengths[units]
+            ends = np.cumsum(counts)
+            within = np.arange(ends[-1] if len(ends) else 0) - np.repeat(
+                ends - counts, counts
+            )
+            units = points[np.repeat(offsets[units], counts) + within]
+            unit_poem = np.repeat(unit_poem, counts)
+
+        # Shingle hashes, in poem order.
+        positions = np.flatnonzero(
+            unit_poem[shingle - 1 :] == unit_poem[: len(unit_poem) - shingle + 1]
+        )
+        hashes = np.zeros(len(positions), dtype=np.uint64)
+        for k in range(shingle):
+            hashes = _mix64(hashes ^ units[positions + k].astype(np.uint64))
+        shingle_poem = unit_poem[positions]
+
+        # MinHash by multiply-shift hashing of the shingle hashes, in chunks
+        # of whole poems to bound the (shingles, num_perm) intermediate.
+        rng = np.random.default_rng(seed)
+        a = rng.integers(0, 2**63, num_perm, dtype=np.uint64) * np.uint64(
+            2
+        ) + np.uint64(1)
+        b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+        poem_starts = np.flatnonzero(np.diff(shingle_poem, prepend=-1))
+        self.indexed = shingle_poem[poem_starts]
+        self.signatures = np.empty((len(self.indexed), num_perm), dtype=np.uint32)
+        chunk = max(1, (1 << 22) // num_perm)
+        lo = 0
+        while lo < len(poem_starts):
+            hi = int(np.searchsorted(poem_starts, poem_starts[lo] + chunk, "right"))
+            hi = max(hi, lo + 1)
+            begin = poem_starts[lo]
+            end = poem_starts[hi] if hi < len(poem_starts) else len(hashes)
+            values = ((hashes[begin:end, None] * a + b) >> np.uint64(32)).astype(
+                np.uint32
+            )
+            self.signatures[lo:hi] = np.minimum.reduceat(
+                values, poem_starts[lo:hi] - begin
+            )
+            lo = hi
+
+        # Per band, the band hash of every indexed poem in sorted order.
+        self._band_keys = np.empty((bands, len(self.indexed)), dtype=np.uint64)
+        self._band_order = np.empty((bands, len(self.indexed)), dtype=np.int64)
+        for band in range(bands):
+            keys = self._band_hash(self.signatures, band)
+            order = np.argsort(keys, kind="stable")
+            self._band_keys[band] = keys[order]
+            self._band_order[band] = order
+
+    def _band_hash(self, signatures, band):
+        rows = self.num_perm // self.bands
+        keys = np.full(len(signatures), band, dtype=np.uint64)
+        for column in range(band * rows, (band + 1) * rows):
+            keys = _mix64(keys ^ signatures[:, column].astype(np.uint64))
+        return keys
+
+    def _candidates(self):
+        """Return the (i, j) index pairs, i < j, of the indexed poems sharing a
+        band, each pair once."""
+        n = len(self.indexed)
+        packed = []
+        for keys, order in zip(self._band_keys, self._band_order):
+            # Pair every poem of a bucket with the later poems of the bucket.
+            bucket_starts = np.flatnonzero(
+                np.diff(keys, prepend=keys[:1] ^ np.uint64(1))
+            )
+            sizes = np.diff(np.append(bucket_starts, n))
+            bucket_starts, sizes = bucket_starts[sizes > 1], sizes[sizes > 1]
+            if not len(sizes):
+                continue
+            members = np.repeat(bucket_starts, sizes) + (
+                np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            )
+            later = np.repeat(bucket_starts + sizes, sizes) - members - 1
+            left = np.repeat(members, later)
+            ends = np.cumsum(later)
+            right = left + 1 + np.arange(ends[-1]) - np.repeat(ends - later, later)
+            i, j = order[left], order[right]
+            packed.append(np.minimum(i, j) * n + np.maximum(i, j))
+        if not packed:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        packed = np.unique(np.concatenate(packed))
+        return packed // n, packed % n
+
+    def _scores(self, i, j):
+        """Return the estimated Jaccard similarities of indexed poems i and j."""
+        scores = np.empty(len(i), dtype=np.float64)
+        step = max(1, (1 << 22) // self.num_perm)
+        for lo in range(0, len(i), step):
+            hi = lo + step
+            equal = self.signatures[i[lo:hi]] == self.signatures[j[lo:hi]]
+            scores[lo:hi] = equal.mean(axis=1)
+        return scores
+
+    def _result(self, i, j, scores, threshold):
+        keep = scores >= threshold
+        i, j, scores = i[keep], j[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")
+        i, j = self.indexed[i[order]], self.indexed[j[order]]
+        return SimilarPoems(
+            np.stack([self.anthology[i], self.anthology[j]], axis=1),
+            np.stack([self.poem[i], self.poem[j]], axis=1),
+            scores[order],
+        )
+
+    def pairs(self, threshold=0.5, anthology=None, source=None, same_anthology=False):
+        """Return the SimilarPoems of candidate pairs with an estimated
+        similarity of at least `threshold`.
+
+        Each pair is (poem, source poem), the source poem coming first in the
+        database. By default only pairs across anthologies are returned, each
+        pairing a later poem with its possible source in an earlier anthology
+        (e.g. honkadori: anthology="Shinkokinshu", source="Kokinshu"); with
+        `same_anthology=True` pairs of poems within one anthology are included
+        as well. `anthology` and `source` restrict the anthologies of the two
+        poems."""
+        i, j = self._candidates()
+        # Indexed poems are in database order, so j is the later poem.
+        later, earlier = (
+            self.anthology[self.indexed[j]],
+            self.anthology[self.indexed[i]],
+        )
+        keep = np.ones(len(i), dtype=bool)
+        if not same_anthology:
+            keep &= later != earlier
+        if anthology:
+            keep &= later == _anthology_value(anthology)
+        if source:
+            keep &= earlier == _anthology_value(source)
+        i, j = i[keep], j[keep]
+        return self._result(j, i, self._scores(j, i), threshold)
+
+    def similar(self, anthology, poem, threshold=0.5):
+        """Return the SimilarPoems pairing the given poem with each poem whose
+        estimated similarity to it is at least `threshold`."""
+        matches = np.flatnonzero(
+            (self.anthology[self.indexed] == _anthology_value(anthology))
+            & (self.poem[self.indexed] == poem)
+        )
+        if not len(matches):
+            return self._result(
+                *(np.zeros(0, dtype=np.int64),) * 2, np.zeros(0), threshold
+            )
+        q = matches[0]
+        others = []
+        for band in range(self.bands):
+            key = self._band_hash(self.signatures[q : q + 1], band)[0]
+            keys = self._band_keys[band]
+            lo, hi = np.searchsorted(keys, key, "left"), np.searchsorted(
+                keys, key, "right"
+            )
+            others.append(self._band_order[band][lo:hi])
+        others = np.unique(np.concatenate(others))
+        others = others[others != q]
+        i = np.full(len(others), q)
+        return self._result(i, others, self._scores(i, others), threshold)
+
+
+def _anthology_value(anthology):
+    """Return the number of an Anthology, its number or its name."""
+    if isinstance(anthology, str):
+        return Anthology[anthology].value
+    return Anthology(anthology).value
+
+
+# Escapes applied by lxml when serialising text and attribute values.
+_XML_TEXT_ESCAPES = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#13;"}
+)
+_XML_ATTRIBUTE_ESCAPES = str.maketrans(
+    {
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "\n": "&#10;",
+        "\t": "&#9;",
+        "\r": "&#13;",
+    }
+)
+
+
+def _tei_header(characters, tokens, poems, anthologies, date):
+    """Return the TEI root start tag and teiHeader of the TEI encoding, as
+    created in Hachidaishu_WLSP_TEI_Conversion.ipynb."""
+    return f"""\
+<TEI xmlns="http://www.tei-c.org/ns/1.0" xml:lang="ja">
+  <teiHeader>
+    <fileDesc>
+      <titleStmt>
+        <title>Hachidaishu dataset</title>
+        <author>
+          <persName>
+            <forename>Hilofumi</forename>
+            <surname>Yamamoto</surname>
+          </persName>
+        </author>
+        <author>
+          <persName>
+            <forename>Bor</forename>
+            <surname>Hodošček</surname>
+          </persName>
+        </author>
+      </titleStmt>
+      <editionStmt>
+        <edition n="1">1st edition</edition>
+        <respStmt>
+          <resp>Encoded by</resp>
+          <persName>
+            <forename>Bor</forename>
+            <surname>Hodošček</surname>
+          </persName>
+        </respStmt>
+      </editionStmt>
+      <extent>
+        <measure unit="characters" quantity="{characters}">{characters:,} characters</measure>
+        <measure unit="morphemes" quantity="{tokens}">{tokens:,} morphemes</measure>
+        <measure unit="poems" quantity="{poems}">{poems:,} poems</measure>
+        <measure unit="anthologies" quantity="{anthologies}">{anthologies:,} anthologies</measure>
+      </extent>
+      <publicationStmt>
+        <publisher>Bor Hodošček and Hilofumi Yamamoto</publisher>
+        <availability>
+          <licence>
+            <ab>CC BY-SA 4.0<ref target="https://creativecommons.org/licenses/by-sa/4.0/"> Licence</ref></ab>
+          </licence>
+        </availability>
+        <date when="{date}"/>
+      </publicationStmt>
+      <sourceDesc>
+        <listBibl>
+          <head>Works consulted in creating the original Hachidaishu database.</head>
+          <bibl>「新編国歌大観CD-ROM版」（1996）『新編国歌大観』編集委員会監修</bibl>
+          <bibl>中村他（1999）「国文学研究資料館編集二十一代集データベース」</bibl>
+          <bibl>新日本古典文学大系本二十一代集</bibl>
+          <bibl>久保田（1979）『新潮日本古典集成の新古今集』</bibl>
+          <bibl>ヴァージニア大学日本語テキストイニシアティブ監修</bibl>
+        </listBibl>
+      </sourceDesc>
+    </fileDesc>
+    <encodingDesc>
+      <projectDesc>
+        <p>This is a conversion of the space-delimited database format of the Hachidaishu dataset into TEI format. The original Chasen IPAdic POS tags were automatically converted into UniDic POS tags, then into Universal Dependencies POS tags. Word List by Semantic Principle (WLSP) entries were (partially) updated from the floppy disk edition to the newest 1.1 version.</p>
+      </projectDesc>
+      <classDecl>
+        <taxonomy xml:id="NDC">
+          <bibl>
+            <title>Nippon Decimal Classification</title>
+            <edition>9</edition>
+            <ptr target="https://ndc.datasearch.jp/"/>
+          </bibl>
+        </taxonomy>
+      </classDecl>
+    </encodingDesc>
+    <profileDesc>
+      <langUsage>
+        <language ident="ja">Japanese (ca. 905-1205)</language>
+      </langUsage>
+      <textClass>
+        <classCode scheme="#NDC">911</classCode>
+        <classCode scheme="http://www.wikidata.org/entity/">Q30038136</classCode>
+      </textClass>
+    </profileDesc>
+    <revisionDesc status="published">
+      <listChange>
+        <change when="{date}" who="Bor Hodošček">upload to repo</change>
+      </listChange>
+    </revisionDesc>
+  </teiHeader>
+"""
+
+
+def _tei_w(token, indent):
+    """Return the <w> element of `token`. The msd attribute follows the
+    notebook's format_token(), without the WLSP2 mapping, which requires
+    external resources."""
+    xs = token.bg_id.split("-")
+    msd = (
+        f"UPosTag={token.ud_pos}|IPAPosTag={token.ipa_pos}"
+        f"|UniDicPosTag={token.unidic_pos}|LemmaReading={token.lemma_reading}"
+        f"|Kanji={token.kanji}|KanjiReading={token.kanji_reading}"
+        f"|WLSPH={xs[1][1]}.{xs[2]}"
+    )
+    return (
+        f'{indent}<w pos="{token.ipa_en_pos.translate(_XML_ATTRIBUTE_ESCAPES)}"'
+        f' lemma="{token.lemma.translate(_XML_ATTRIBUTE_ESCAPES)}"'
+        f' msd="{msd.translate(_XML_ATTRIBUTE_ESCAPES)}">'
+        f"{token.surface.translate(_XML_TEXT_ESCAPES)}</w>\n"
+    )
+
+
+def _tei_poem(poem, records):
+    """Return the <lg> element of a poem."""
+    parts = [f'        <lg type="waka" n="{poem}">\n          <l>\n']
+    for record in records:
+        decompositions = record.decompositions()
+        if len(decompositions) == 1:  # no variants
+            parts.append(_tei_w(decompositions[0][0], "            "))
+            continue
+        parts.append("            <app>\n")
+        for decomposition in decompositions:
+            if not decomposition.tokens:
+                parts.append("              <rdg/>\n")
+                continue
+            parts.append("              <rdg>\n")
+            for token in decomposition.tokens:
+                parts.append(_tei_w(token, "                "))
+            parts.append("              </rdg>\n")
+        parts.append("            </app>\n")
+    parts.append("          </l>\n        </lg>\n")
+    return "".join(parts)
+
+
+def _tei_counts(records):
+    """Return the (characters, tokens, poems, anthologies) counts of the TEI
+    extent, which the notebook takes from canonical tokens and from runs of
+    records with the same poem number and anthology, respectively."""
+    characters = tokens = poems = anthologies = 0
+    poem = anthology = None
+    for record in records:
+        characters += len(record.token().surface)
+        tokens += 1
+        if record.poem != poem:
+            poems += 1
+            poem = record.poem
+        if record.anthology != anthology:
+            anthologies += 1
+            anthology = record.anthology
+    return characters, tokens, poems, anthologies
+
+
+def _write_tei(records, f, counts, date):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write(_tei_header(*counts, date))
+    f.write("  <text>\n    <body>\n")
+    for anthology, poems in groupby(records, key=lambda r: r.anthology):
+        name = anthology.name.translate(_XML_ATTRIBUTE_ESCAPES)
+        f.write(f'      <div type="anthology" n="{name}">\n')
+        for poem, xs in groupby(poems, key=lambda r: r.poem):
+            f.write(_tei_poem(poem, xs))
+        f.write("      </div>\n")
+    f.write("    </body>\n  </text>\n</TEI>\n")
+
+
+def _poem_text(key, surfaces, delimiter=" ", embed_metadata=False):
+    """Return the line of HachidaishuDB.text() for the poem with (anthology,
+    poem) `key` and the canonical token `surfaces`."""
+    text = delimiter.join(surfaces)
+    if embed_metadata:
+        return f"{key[0]} {key[1]} {text}"
+    return text
+
+
+def _jsonl_lines(rows, decompositions=False):
+    """Yield the JSON line of each record tuple (see _record_to_tuple()) in
+    `rows`. Lines are identical to json.dumps(record.to_json(),
+    ensure_ascii=False), to which `decompositions` adds a "decompositions"
+    list of all segments as serialised by dataclasses.asdict().
+
+    Tokens recur throughout the corpus, so the JSON of each distinct token is
+    computed once and reused."""
+    names = {a.value: json.dumps(a.name, ensure_ascii=False) for a in Anthology}
+    fragments = {}
+
+    def fragment(token):
+        # The token's members without the enclosing braces.
+        f = fragments.get(token)
+        if f is None:
+            f = fragments[token] = json.dumps(
+                dict(zip(TOKEN_FIELDS, token)), ensure_ascii=False
+            )[1:-1]
+        return f
+
+    for anthology, poem, _, segments in rows:
+        line = (
+            f'{{"anthology": {names[anthology]}, "poem": {poem}, '
+            f"{fragment(segments[0][1][0])}"
+        )
+        if decompositions:
+            line += ', "decompositions": [{}]'.format(
+                ", ".join(
+                    '{{"tokens": [{}], "decomposition_type": {}}}'.format(
+                        ", ".join("{" + fragment(token) + "}" for token in tokens),
+                        json.dumps(decomposition_type, ensure_ascii=False),
+                    )
+                    for decomposition_type, tokens in segments
+                )
+            )
+        yield line + "}\n"
+
+
+def _write_jsonl_shard(path, rows, decompositions):
+    """Worker for HachidaishuDB.write_jsonl(): write the JSON lines of `rows`
+    to `path` and return their record count, size in bytes and SHA-256."""
+    data = "".join(_jsonl_lines(rows, decompositions)).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(rows), len(data), hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class StageStats:
+    """Wall time and memory of one load stage. `peak_bytes` is the peak of the
+    memory allocated during the stage, on top of what was allocated before,
+    or None if memory was not traced."""
+
+    seconds: float
+    records: int
+    peak_bytes: int | None = None
+
+
+@dataclass
+class LoadStats:
+    """Statistics of a HachidaishuDB load (see the `instrument` argument).
+
+    `stages` maps stage names to StageStats, in the order they ran. The
+    counters describe retokenization, and stay zero if the database was read
+    from a snapshot: `lines` read, `decompositions_merged` (rows merged into
+    the record of the preceding row with the same serial), `ud_bigram_rules`
+    (times each TAG_BIGRAM_MAP rule decided a UD POS), `variant_markers`
+    (poems by number of ＊/イ markers found when their variants were
+    processed), and `records_dropped` by variant processing.
+
+    Memory is only measured while tracemalloc is tracing, which slows stages
+    down several times over; it can be started for the load only with
+    `trace_memory`. Each of `hooks` is called as hook(stage, stage_stats) when
+    a stage ends, and as hook("load", load_stats) when the load is complete."""
+
+    stages: dict = field(default_factory=dict)
+    lines: int = 0
+    decompositions_merged: int = 0
+    ud_bigram_rules: Counter = field(default_factory=Counter)
+    variant_markers: Counter = field(default_factory=Counter)
+    records_dropped: int = 0
+    records: int = 0
+    snapshot: bool = False
+    hooks: list = field(default_factory=list, repr=False, compare=False)
+    trace_memory: bool = field(default=False, repr=False, compare=False)
+
+    @property
+    def seconds(self):
+        return sum(stage.seconds for stage in self.stages.values())
+
+    @property
+    def variant_groups_merged(self):
+        """Poems whose variants were merged (three markers)."""
+        return self.variant_markers[3]
+
+    @property
+    def variant_groups_skipped(self):
+        """Poems with markers whose variants were not processed (not two or
+        three markers)."""
+        return sum(
+            n for markers, n in self.variant_markers.items() if markers not in (2, 3)
+        )
+
+    def measure(self, stage, function, records=len):
+        """Run `function` as load stage `stage`, recording its StageStats, and
+        return its result. `records(result)` is the number of records the
+        stage produced."""
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        peak = None
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            result = function()
+        finally:
+            seconds = time.perf_counter() - start
+            if tracemalloc.is_tracing():
+                peak = tracemalloc.get_traced_memory()[1] - allocated
+            if started:
+                tracemalloc.stop()
+        self.stages[stage] = StageStats(seconds, records(result), peak)
+        for hook in self.hooks:
+            hook(stage, self.stages[stage])
+        return result
+
+    def add(self, other):
+        """Add the counters of `other` to these."""
+        self.lines += other.lines
+        self.decompositions_merged += other.decompositions_merged
+        self.ud_bigram_rules.update(other.ud_bigram_rules)
+        self.variant_markers.update(other.variant_markers)
+        self.records_dropped += other.records_dropped
+
+    def to_json(self):
+        return {
+            "stages": {name: asdict(stage) for name, stage in self.stages.items()},
+            "seconds": self.seconds,
+            "lines": self.lines,
+            "decompositions_merged": self.decompositions_merged,
+            "ud_bigram_rules": [
+                [tag, next_tag, n]
+                for (tag, next_tag), n in self.ud_bigram_rules.most_common()
+            ],
+            "variant_markers": {
+                str(k): n for k, n in sorted(self.variant_markers.items())
+            },
+            "variant_groups_merged": self.variant_groups_merged,
+            "variant_groups_skipped": self.variant_groups_skipped,
+            "records_dropped": self.records_dropped,
+            "records": self.records,
+            "snapshot": self.snapshot,
+        }
+
+
+def _measure(stats, stage, function, records=len):
+    """Run `function` as a load stage measured by `stats`, if it is given (see
+    LoadStats.measure())."""
+    if stats is None:
+        return function()
+    return stats.measure(stage, function, records)
+
+
+def _shard_bounds(lines, n):
+    """Return line offsets splitting `lines` into at most `n` shards of similar
+    size. Shards only start at a poem boundary whose first serial differs from
+    the preceding line, so no decomposition group is split across shards."""
+    bounds = [0]
+    for target in range(len(lines) // n, len(lines), max(len(lines) // n, 1)):
+        i = max(target, bounds[-1] + 1)
+        while i < len(lines):
+            prev_id = lines[i - 1].split(" ", 1)[0].split(":")
+            id = lines[i].split(" ", 1)[0].split(":")
+            if id[:2] != prev_id[:2] and int(id[2]) != int(prev_id[2]):
+                bounds.append(i)
+                break
+            i += 1
+    bounds.append(len(lines))
+    return sorted(set(bounds))
+
+
+def _presets_next_poem(e, following):
+    """Return whether UD mapping of `e` set the UD POS of `following`, the first
+    record of another poem (see HachidaishuDB._iter_retokenize())."""
+    return following.segments[0].tokens[0].ud_pos is not None and (
+        e.anthology,
+        e.poem,
+    ) != (following.anthology, following.poem)
+
+
+def _load_shard(text, instrument=False):
+    """Worker for HachidaishuDB._load_parallel(): parse a shard and map UD POS
+    for all but its last record. Records are returned as tuples, together with
+    the keys of the shard's noisy poems (see HachidaishuDB._iter_retokenize())
+    and, if `instrument` is true, the shard's LoadStats counters."""
+    db = HachidaishuDB.__new__(HachidaishuDB)
+    noisy = set()
+    stats = LoadStats() if instrument else None
+    records = list(
+        db._merge_decompositions(db._read_db(io.StringIO(text)), noisy, stats)
+    )
+    db._map_records_ud(list(zip(records, records[1:])), noisy, stats)
+    return [_record_to_tuple(record) for record in records], noisy, stats
+
+
+def _poem_key(row):
+    """Return the (anthology, poem) key of a hachidai.db row."""
+    anthology, poem, _ = row.split(":", 2)
+    return int(anthology), int(poem)
+
+
+def _digested(rows, digests):
+    """Pass `rows` through, updating `digests` with a running digest of the
+    rows of each (anthology, poem) key. Trailing whitespace is ignored."""
+    for prefix, group in groupby(rows, key=lambda row: row[: row.find(":", 3)]):
+        poem_rows = []
+        for row in group:
+            poem_rows.append(row.rstrip() + "\n")
+            yield row
+        key = _poem_key(poem_rows[0])
+        h = digests.get(key)
+        if h is None:
+            h = digests[key] = hashlib.blake2b(digest_size=16)
+        h.update("".join(poem_rows).encode())
+
+
+def _poem_digests(rows):
+    """Return a dict mapping the (anthology, poem) keys of `rows`, in order of
+    appearance, to a digest of the rows of each poem."""
+    digests = {}
+    for _ in _digested(rows, digests):
+        pass
+    return {key: h.digest() for key, h in digests.items()}
+
+
+def _poem_rows(filename, keys):
+    """Return a dict mapping those of `keys` present in `filename` to their rows."""
+    found = {}
+    with open_db(filename) as f:
+        for row in f:
+            key = _poem_key(row)
+            if key in keys:
+                found.setdefault(key, []).append(row)
+    return found
+
+
+def _apply_rows(rows, changes):
+    """Return `rows` with each row in `changes` replacing the row with the same
+    id and token type, or inserted in serial and token type order."""
+
+    def ident(row):
+        id, token_type = row.split(" ", 2)[:2]
+        return int(id.rsplit(":", 1)[1]), token_type
+
+    rows = list(rows)
+    for change in changes:
+        key = ident(change)
+        idents = [ident(row) for row in rows]
+        if key in idents:
+            rows[idents.index(key)] = change
+        else:
+            rows.insert(bisect_left(idents, key), change)
+    return rows
+
+
+@dataclass
+class HachidaishuDB:
+    db: List[HachidaishuRecord] = field(repr=False)
+
+    def __init__(
+        self,
+        filename="hachidai.db",
+        cache=None,
+        backend="objects",
+        workers=None,
+        instrument=False,
+        hooks=(),
+        lazy=False,
+    ):
+        """Load and retokenize the database in `filename`.
+
+        If `cache` is True, the retokenized database is stored in a compiled
+        snapshot next to `filename` (`filename + ".snapshot"`); a path may be
+        given instead to choose the snapshot location. Subsequent loads read
+        the snapshot directly as long as neither `filename` nor the mapping
+        tables in dictionaryconverter.py have changed, otherwise the snapshot
+        is rebuilt.
+
+        `filename` may also name a .gz/.xz/.bz2-compressed database, "-" for
+        standard input, or be an open text file object (see open_db()).
+
+        With `backend="columnar"` the records are kept in a ColumnarStore of
+        integer-coded NumPy arrays instead of a list of HachidaishuRecord
+        objects; records and tokens are then created on demand when accessed.
+
+        If `workers` is greater than 1, parsing and retokenization are spread
+        over that many processes (see _load_parallel()). The result is
+        identical to a serial load.
+
+        If `instrument` is true or `hooks` are given, the load is measured stage
+        by stage and its statistics are kept in self.stats, a LoadStats (which
+        also describes the hooks); otherwise self.stats is None. The stages
+        then run one after the other rather than as a stream. With
+        `instrument="memory"` the memory of each stage is traced as well, at a
+        considerable cost in speed.
+
+        If `lazy` is true, tokens parsed from the database resolve their POS
+        attributes (ipa_pos, ipa_en_pos and unidic_pos) from CHASEN_POS on
+        access instead of storing them, and keep lemma_reading, kanji and
+        kanji_reading as the unsplit end of their row until first accessed
+        (see LazyToken). Rows are also parsed with fewer steps, which makes
+        loading about 15% faster and the loaded records about 14% smaller than
+        in the default mode. Tokens read from a snapshot or retokenized by
+        workers are complete either way. Attribute values are the same in both
+        modes.
+        """
+        if backend not in ("objects", "columnar"):
+            raise ValueError(f"Unknown backend: {backend}")
+        if cache and (filename == "-" or not isinstance(filename, (str, os.PathLike))):
+            raise ValueError("A snapshot cache requires a database file path.")
+        stats = self.stats = (
+            LoadStats(hooks=list(hooks), trace_memory=instrument == "memory")
+            if instrument or hooks
+            else None
+        )
+        self._lazy = lazy
+        if not cache:
+            self.db = self._load(filename, workers, stats, lazy)
+        else:
+            snapshot = os.fspath(filename) + ".snapshot" if cache is True else cache
+            key = self._snapshot_key(filename)
+            loaded = _measure(
+                stats,
+                "snapshot",
+                lambda: self._load_snapshot(snapshot, key),
+                lambda loaded: len(loaded[0]) if loaded else 0,
+            )
+            if loaded is None:
+                self.db = self._load(filename, workers, stats, lazy)
+                _measure(
+                    stats,
+                    "write_snapshot",
+                    lambda: self._write_snapshot(
+                        snapshot, key, self.db, self._digests, self._noisy
+                    ),
+                    lambda _: len(self.db),
+                )
+            else:
+                self.db, self._digests, self._noisy = loaded
+                if stats is not None:
+                    stats.snapshot = True
+        # Source of the rows of unmodified poems for update().
+        if isinstance(filename, (str, os.PathLike)) and filename != "-":
+            self._source = filename
+        else:
+            self._source = None
+        self._overrides = {}
+        if backend == "columnar":
+            self.db = _measure(
+                stats, "columnar", lambda: ColumnarStore.from_records(self.db)
+            )
+        _measure(stats, "index", self._build_index, lambda _: len(self.db))
+        if stats is not None:
+            stats.records = len(self.db)
+            for hook in stats.hooks:
+                hook("load", stats)
+
+    def __getitem__(self, index):
+        return self.db[index]
+
+    def __iter__(self):
+        for record in self.db:
+            yield record
+
+    def columns(self):
+        return self.db[0].keys()
+
+    @classmethod
+    def stream(cls, filename="hachidai.db", stats=None, lazy=False):
+        """Yield fully retokenized records from `filename` without loading the
+        whole database into memory.
+
+        Records are produced in database order, one poem at a time, and are
+        identical to those of HachidaishuDB(filename); use
+        `groupby(records, key=lambda r: (r.anthology, r.poem))` to consume them
+        poem by poem. `filename` accepts the same inputs as the constructor,
+        including compressed files and "-" for standard input.
+
+        If a LoadStats is given as `stats`, its counters are updated as the
+        records are produced (stages are not timed, as they are interleaved).
+        `lazy` is as for the constructor."""
+        db = cls.__new__(cls)
+        yield from db._iter_retokenize(db._read_db(filename, lazy=lazy), stats=stats)
+
+    def _load(self, filename, workers=None, stats=None, lazy=False):
+        """Load and retokenize `filename`, recording the digest of each poem's
+        rows in self._digests and the noisy poems in self._noisy for update().
+        If a LoadStats is given as `stats`, the stages are run one at a time
+        and measured. `lazy` is as for the constructor."""
+        if workers and workers > 1:
+            return self._load_parallel(filename, workers, stats)
+        digests = {}
+        self._noisy = set()
+        if stats is None:
+            records = self._retokenize(
+                self._read_db(filename, digests, lazy), self._noisy
+            )
+        else:
+            records = stats.measure(
+                "parse", lambda: list(self._read_db(filename, digests, lazy))
+            )
+            for stage, function in (
+                ("merge_decompositions", self._merge_decompositions),
+                ("map_ud", self._map_ud),
+                ("merge_variants", self._merge_variants),
+            ):
+                records = stats.measure(
+                    stage, lambda: list(function(records, self._noisy, stats))
+                )
+        self._digests = {key: h.digest() for key, h in digests.items()}
+        return records
+
+    def _load_parallel(self, filename, workers, stats=None):
+        """Load `filename` using a pool of `workers` processes.
+
+        The database is split into shards at poem boundaries. Each worker parses
+        its shard, merges decompositions and maps UD POS for every record except
+        the shard's last one, whose next record lives in the following shard.
+        Those seam records are mapped here. If one of them sets the UD POS of
+        the next shard's first token (as _map_record_ud() does for some tag
+        bigrams), that shard's UD mapping is redone with the preset value.
+        Variant processing then runs over the concatenated shards, which is a
+        single linear pass."""
+
+        def read():
+            with open_db(filename) as f:
+                lines = f.read().splitlines(keepends=True)
+            self._digests = _poem_digests(lines)
+            return lines
+
+        lines = _measure(stats, "read", read)
+        bounds = _shard_bounds(lines, workers * 4)
+        texts = ["".join(lines[start:stop]) for start, stop in zip(bounds, bounds[1:])]
+        del lines
+        noisy = set()
+        shard_stats = []
+
+        def run_workers():
+            shards = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for rows, shard_noisy, counters in executor.map(
+                    _load_shard, texts, repeat(stats is not None)
+                ):
+                    shards.append([_record_from_tuple(row) for row in rows])
+                    noisy.update(shard_noisy)
+                    shard_stats.append(counters)
+            return shards
+
+        shards = _measure(
+            stats, "workers", run_workers, lambda shards: sum(map(len, shards))
+        )
+        texts.clear()
+
+        def map_seams():
+            if not shards:  # An empty database.
+                return []
+            for k, shard in enumerate(shards[:-1]):
+                following = shards[k + 1][0]
+                token = following.segments[0].tokens[0]
+                ud_pos, token.ud_pos = token.ud_pos, None
+                self._map_record_ud(shard[-1], following, stats)
+                if token.ud_pos is None:
+                    token.ud_pos = ud_pos
+                else:  # Redo the next shard as if it had been mapped in sequence.
+                    # Shards start at poem boundaries, so its poem is noisy. Keys
+                    # the worker found noisy are kept, as over-reporting is safe.
+                    noisy.add((following.anthology.value, following.poem))
+                    preset = token.ud_pos
+                    for record in shards[k + 1]:
+                        for decomposition in record.segments:
+                            for t in decomposition.tokens:
+                                t.ud_pos = None
+                    token.ud_pos = preset
+                    # Count the rules of the redone mapping instead.
+                    if stats is not None:
+                        shard_stats[k + 1].ud_bigram_rules = Counter()
+                    self._map_records_ud(
+                        list(zip(shards[k + 1], shards[k + 1][1:])),
+                        noisy,
+                        shard_stats[k + 1],
+                    )
+            self._map_record_ud(shards[-1][-1], None, stats)
+            return list(chain.from_iterable(shards))
+
+        records = _measure(stats, "seams", map_seams)
+        if stats is not None:
+            for counters in shard_stats:
+                stats.add(counters)
+        records = _measure(
+            stats,
+            "merge_variants",
+            lambda: list(self._merge_variants(records, noisy, stats)),
+        )
+        self._noisy = noisy
+        return records
+
+    def update(self, rows):
+        """Apply changed or added database rows, retokenizing only the poems
+        they belong to.
+
+        Each of `rows` is a line in hachidai.db format. It replaces the row with
+        the same id and token type of its poem, or is inserted among the poem's
+        rows by serial and token type if there is none; rows of a poem not yet
+        in the database add that poem in (anthology, poem) order. The remaining
+        rows of the affected poems are read from the file the database was
+        loaded from, which must not have been changed since (use update_from()
+        to load the changes of an edited file instead).
 
-    def __repr__(self):
-        return f"{self.surface}/{self.unidic_pos}/{self.ud_pos}/{self.lemma}"
+        The result is identical to loading the updated file from scratch."""
+        if self._digests is None:
+            raise ValueError(
+                "A database opened with open_binary() or from shared memory "
+                "cannot be updated."
+            )
+        changes = {}
+        for row in rows:
+            if row.strip():
+                changes.setdefault(_poem_key(row), []).append(row.rstrip("\n") + "\n")
+        order = list(self._digests)
+        for key in sorted(changes.keys() - self._digests.keys()):
+            order.insert(bisect_left(order, key), key)
 
-    def __iter__(self):
-        return iter(astuple(self))
+        def poem_rows(keys):
+            found = {key: self._overrides[key] for key in keys & self._overrides.keys()}
+            missing = keys - found.keys() - (changes.keys() - self._digests.keys())
+            if missing:
+                if self._source is None:
+                    raise ValueError(
+                        "Incremental updates require a database loaded from a "
+                        "file path."
+                    )
+                from_source = _poem_rows(self._source, missing)
+                for key, lines in from_source.items():
+                    if _poem_digests(lines)[key] != self._digests[key]:
+                        raise ValueError(
+                            f"{self._source} has changed since it was loaded; "
+                            "use update_from()."
+                        )
+                found.update(from_source)
+            for key in keys & changes.keys():
+                found[key] = _apply_rows(found.get(key, []), changes[key])
+            return found
 
-    def to_json(self):
-        return asdict(self)
+        overrides = self._splice(order, set(changes), poem_rows)
+        self._overrides.update(overrides)
 
+    def update_from(self, filename):
+        """Bring the database up to date with a new version of its file.
 
-@dataclass
-class Decomposition:
-    tokens: List[Token]
-    decomposition_type: str
+        `filename` is compared poem by poem with the rows the database was
+        built from, and only poems that were changed, added or moved, as well as
+        neighbouring poems whose retokenization depends on them, are parsed and
+        retokenized. `filename` accepts the same inputs as the constructor, but
+        is read more than once, so it cannot be standard input or a file object.
 
-    def __getitem__(self, index: int) -> Token:
-        return self.tokens[index]
+        The result is identical to HachidaishuDB(filename)."""
+        if self._digests is None:
+            raise ValueError(
+                "A database opened with open_binary() or from shared memory "
+                "cannot be updated."
+            )
+        if filename == "-" or not isinstance(filename, (str, os.PathLike)):
+            raise ValueError("update_from() requires a database file path.")
+        with open_db(filename) as f:
+            digests = _poem_digests(f)
+        changed = {
+            key for key, digest in digests.items() if self._digests.get(key) != digest
+        }
+        self._splice(list(digests), changed, lambda keys: _poem_rows(filename, keys))
+        self._source = filename
+        self._overrides = {}
 
-    def __iter__(self):
-        return iter(astuple(self))
+    def _splice(self, order, changed, poem_rows):
+        """Retokenize the poems in `changed` and splice them into self.db.
 
+        `order` lists the (anthology, poem) keys of the updated database in
+        order, and `poem_rows(keys)` returns a dict with the rows of the given
+        poems. Retokenization is not independent between poems (see
+        _iter_retokenize()), so each changed poem is retokenized in a window
+        that starts at the closest preceding poem that is not noisy, and
+        extends up to the first following poem that is noisy neither before
+        nor after the update. Outside of these windows the pipeline state, and
+        hence every record, is the same as before.
 
-@dataclass
-class HachidaishuRecord:
-    anthology: Anthology
-    poem: int
-    serial: int
-    segments: List[Decomposition]
+        Returns a dict with the rows of the changed poems."""
+        old_order = list(self._digests)
+        predecessors = dict(zip(old_order[1:], old_order))
+        dirty = {i for i, key in enumerate(order) if key in changed}
+        # Poems following a different poem than before are affected as well, as
+        # is a new last poem, whose variants are then no longer processed.
+        dirty.update(
+            i
+            for i, key in enumerate(order)
+            if predecessors.get(key) != (order[i - 1] if i else None)
+        )
+        if order and (not old_order or order[-1] != old_order[-1]):
+            dirty.add(len(order) - 1)
 
-    def __iter__(self):
-        return iter(astuple(self)[:3] + astuple(self.token()))
+        def quiet(i):
+            return i not in dirty and order[i] not in self._noisy
 
-    def keys(self):
-        return [f.name for f in fields(self)][:3] + [
-            f.name for f in fields(self.token())
-        ]
+        def first_start(lo):
+            start = max(lo - 1, 0)
+            while start > 0 and not quiet(start):
+                start -= 1
+            return start
 
-    def to_json(self):
-        return {
-            "anthology": self.anthology.name,
-            "poem": self.poem,
-        } | self.token().to_json()
+        def quiet_after(lo, margin):
+            return list(
+                islice((i for i in range(lo + 1, len(order)) if quiet(i)), margin)
+            )
 
-    def token(self):
-        """Return the canonical decomposition (always one token), ignoring any alternative variants."""
-        return self.segments[0][0]
+        # Read the rows of all windows in one pass, assuming they need no
+        # widening beyond the first few quiet poems.
+        wanted = set()
+        for lo in dirty:
+            candidates = quiet_after(lo, 4)
+            stop = candidates[-1] + 1 if len(candidates) == 4 else len(order)
+            wanted.update(order[first_start(lo) : stop])
+        cache = poem_rows(wanted)
 
-    def decompositions(self):
-        """Return a list containing the alternative decompositions of segment record."""
-        return self.segments
+        def retokenize(start, stop, noisy):
+            keys = order[start:stop]
+            missing = set(keys) - cache.keys()
+            if missing:
+                cache.update(poem_rows(missing))
+            text = "".join(chain.from_iterable(cache.get(key, []) for key in keys))
+            poems = {}
+            records = self._read_db(io.StringIO(text), lazy=self._lazy)
+            for record in self._retokenize(records, noisy):
+                poems.setdefault((record.anthology.value, record.poem), []).append(
+                    record
+                )
+            return poems
 
+        retokenized = {}
+        noisy = {key for key in order if key in self._noisy}
+        end = 0
+        for lo in sorted(dirty):
+            if lo < end:
+                continue
+            start = first_start(lo)
+            margin = 4
+            while True:
+                candidates = quiet_after(lo, margin)
+                stop = candidates[-1] + 1 if len(candidates) == margin else len(order)
+                window_noisy = set()
+                poems = retokenize(start, stop, window_noisy)
+                end = next(
+                    (i for i in candidates if order[i] not in window_noisy), len(order)
+                )
+                if end < len(order) or stop == len(order):
+                    break
+                margin *= 2
+            for key in order[start:end]:
+                retokenized[key] = poems.get(key, [])
+                if key in window_noisy:
+                    noisy.add(key)
+                else:
+                    noisy.discard(key)
 
-@dataclass
-class HachidaishuDB:
-    db: List[HachidaishuRecord] = field(repr=False)
+        records = self.db if isinstance(self.db, list) else list(self.db)
+        updated = []
+        for key in order:
+            if key in retokenized:
+                updated.extend(retokenized[key])
+            else:
+                updated.extend(
+                    r for start, stop in self._index[key] for r in records[start:stop]
+                )
+        self.db = (
+            updated
+            if isinstance(self.db, list)
+            else ColumnarStore.from_records(updated)
+        )
+        new_rows = {key: cache[key] for key in order if key in changed}
+        self._digests = {
+            key: (
+                _poem_digests(new_rows[key])[key]
+                if key in new_rows
+                else self._digests[key]
+            )
+            for key in order
+        }
+        self._noisy = noisy
+        self._build_index()
+        return new_rows
 
-    def __init__(self, filename="hachidai.db"):
-        self.db = self._retokenize(self._read_db(filename))
+    def _retokenize(self, db, noisy=None):
+        records = list(self._iter_retokenize(db, noisy))
+        # logger.info(f"records: {len(records)}")
+        return records
 
-    def __getitem__(self, index):
-        return self.db[index]
+    def _iter_retokenize(self, db, noisy=None, stats=None):
+        """Retokenize the entries of `db` as a stream.
 
-    def __iter__(self):
-        for record in self.db:
-            yield record
+        Decomposition merging, UD mapping and variant processing are chained
+        generators that only look ahead by one record, so memory is bounded by
+        the size of the poem currently being processed.
 
-    def columns(self):
-        return self.db[0].keys()
+        If a `noisy` set is given, the stages add to it the (anthology, poem)
+        key of every poem whose first row does not find the pipeline in the
+        state it starts from: the row is merged into the previous poem's last
+        record, that record presets the UD POS of its first token, or variant
+        processing of the previous poem is pending or skips into it. All other
+        poems would be retokenized the same way if the database started there,
+        which is what update() relies on.
+
+        If a LoadStats is given as `stats`, the stages update its counters."""
+        return self._merge_variants(
+            self._map_ud(self._merge_decompositions(db, noisy, stats), noisy, stats),
+            noisy,
+            stats,
+        )
 
-    def _retokenize(self, db):
-        records: list[HachidaishuRecord] = []
+    def _merge_decompositions(self, db, noisy=None, stats=None):
+        record = None
         serial = None
         token_type = None
         for entry in db:
+            if stats is not None:
+                stats.lines += 1
             entry_type = entry.segments[
                 0
             ].decomposition_type  # initially, only one decomposition per record
             if (
                 serial == entry.serial
             ):  # tokens with same serial are decomposition variants to be added to existing decomposition segment
-                prev_decomp = records[-1].segments
+                if noisy is not None and (entry.anthology, entry.poem) != (
+                    record.anthology,
+                    record.poem,
+                ):
+                    noisy.add((entry.anthology.value, entry.poem))
+                if stats is not None:
+                    stats.decompositions_merged += 1
+                prev_decomp = record.segments
                 # decomposition variants are grouped by their type (A-E) and can represent groups of tokens themselves
                 if (
                     entry_type == token_type
@@ -130,13 +2612,50 @@ class HachidaishuDB:
                 else:  # add to new segment in previous token
                     prev_decomp.extend(entry.segments)
             else:  # new record
-                records.append(entry)
+                if record is not None:
+                    yield record
+                record = entry
 
             serial = entry.serial
             token_type = entry_type
+        if record is not None:
+            yield record
 
-        # Map UniDic POS to Universal Dependencies
-        for i, e in enumerate(records):
+    def _map_ud(self, records, noisy=None, stats=None):
+        """Map UniDic POS to Universal Dependencies, looking ahead by one record.
+        Records are mapped in batches (see _map_records_ud())."""
+        pairs = []
+        e = None
+        for e_following in records:
+            if e is not None:
+                pairs.append((e, e_following))
+                if len(pairs) == 1024:
+                    self._map_records_ud(pairs, noisy, stats)
+                    yield from (record for record, _ in pairs)
+                    pairs = []
+            e = e_following
+        if e is not None:
+            pairs.append((e, None))
+        self._map_records_ud(pairs, noisy, stats)
+        yield from (record for record, _ in pairs)
+
+    def _map_record_ud(self, e, following, stats=None):
+        self._map_records_ud([(e, following)], stats=stats)
+
+    def _map_records_ud(self, pairs, noisy=None, stats=None):
+        """Map UD POS for each (record, following record) pair in turn.
+
+        The tags of all tokens still without UD POS are looked up in a single
+        unidic2ud_map_batch() call first. This gives the same result as mapping
+        record by record, because a token's mapping only depends on its own and
+        its next token's tags; a token's UD POS is only ever preset by the
+        previous record, which is checked again when the results are applied.
+        If `noisy` is given, the keys of poems whose first token was preset by
+        the previous poem are added to it, and if `stats` is given, the bigram
+        rules deciding the UD POS of tokens are counted in it."""
+        pending = []
+        surfaces, tags, next_tags = [], [], []
+        for e, following in pairs:
             for decomposition in e.segments:
                 for j, token in enumerate(decomposition.tokens):
                     if token.ud_pos:  # UD POS already set, skip to next.
@@ -148,26 +2667,81 @@ class HachidaishuDB:
                         e_next = decomposition.tokens[j + 1]
                     else:  # Next token is outside decomposition in next record, and
                         if (
-                            i + 1 < len(records) and e.poem == records[i + 1].poem
+                            following is not None and e.poem == following.poem
                         ):  # there is a next token in the same poem.
                             # Here we choose the first token from the possible compositions of the next token to compare against.
                             # TODO This should be against all first tokens of all decomposition in next record!
-                            e_next = records[i + 1].segments[0].tokens[0]
+                            e_next = following.segments[0].tokens[0]
                         else:  # there is no next token.
                             e_next = None
-                    new_pos, next_new_pos = unidic2ud_map(
-                        token.surface,
-                        token.unidic_pos,
-                        e_next.unidic_pos if e_next else None,
+                    pending.append((token, e_next, e, following))
+                    surfaces.append(token.surface)
+                    # As token.unidic_pos, without resolving it on lazy tokens.
+                    tags.append(CHASEN_POS[token.chasen_id][2])
+                    next_tags.append(
+                        CHASEN_POS[e_next.chasen_id][2] if e_next else None
                     )
-                    token.ud_pos = new_pos
-                    if e_next and next_new_pos:
-                        records[i + 1].segments[0].tokens[0].ud_pos = next_new_pos
+        rules = None if stats is None else []
+        try:
+            mapped = unidic2ud_map_batch(surfaces, tags, next_tags, rules)
+        except KeyError:
+            # A tag without UD mapping is only an error if its token has not
+            # been preset by the time it is reached, so map one by one instead.
+            mapped = None
+        for k, (token, e_next, e, following) in enumerate(pending):
+            if token.ud_pos:  # Preset by the previous record.
+                continue
+            if mapped is None:
+                rules = None if stats is None else []
+                ((new_pos, next_new_pos),) = unidic2ud_map_batch(
+                    surfaces[k : k + 1], tags[k : k + 1], next_tags[k : k + 1], rules
+                )
+                rule = rules and rules[0]
+            else:
+                new_pos, next_new_pos = mapped[k]
+                rule = rules and rules[k]
+            if rule:
+                stats.ud_bigram_rules[rule] += 1
+            token.ud_pos = new_pos
+            if e_next and next_new_pos and following is not None:
+                following.segments[0].tokens[0].ud_pos = next_new_pos
+                if noisy is not None and _presets_next_poem(e, following):
+                    noisy.add((following.anthology.value, following.poem))
+
+    def _merge_variants(self, records, noisy=None, stats=None, process_variants=None):
+        """Process ＊/イ variant markers poem by poem.
 
+        Variants of a poem are processed once the first record of the next poem
+        is seen. This reproduces the original whole-list implementation exactly,
+        which kept enumerating the list while _process_variants deleted records
+        from it: the `skip` records following the one that triggered processing
+        are not scanned for markers, and that record's own markers keep its
+        pre-deletion index.
+
+        `process_variants` replaces _process_variants() (for checking it against
+        the original implementation in tests/test_variants.py)."""
+        process_variants = process_variants or self._process_variants
+        buffer: list[HachidaishuRecord] = []
         current_poem = None
         variant_indices: list[tuple[int, int]] = []
+        skip = 0
+        previous = None
 
-        for i, record in enumerate(records):
+        for record in records:
+            if noisy is not None:
+                first = previous is None or (record.anthology, record.poem) != (
+                    previous.anthology,
+                    previous.poem,
+                )
+                if first and (skip or record.poem == current_poem):
+                    noisy.add((record.anthology.value, record.poem))
+                previous = record
+            if skip:
+                skip -= 1
+                buffer.append(record)
+                continue
+
+            i = len(buffer)
             if record.poem != current_poem:
                 # As possible future work, we could add a check for the number of variant indices
                 # and do type-based processing based on that.
@@ -176,54 +2750,70 @@ class HachidaishuDB:
                 # elif len(variant_indices) not in [2, 3]:
                 #     ...
                 if len(variant_indices) in [2, 3]:
-                    self._process_variants(records, variant_indices)
+                    process_variants(buffer, variant_indices)
+                    skip = i - len(buffer)
+                    if skip and noisy is not None:
+                        noisy.add((record.anthology.value, record.poem))
+                if variant_indices and stats is not None:
+                    stats.variant_markers[len(variant_indices)] += 1
+                    stats.records_dropped += skip
+                yield from buffer
+                buffer = []
+                i = skip
                 current_poem = record.poem
                 variant_indices = []
 
+            buffer.append(record)
             for j, token in enumerate(record.segments[0].tokens):
                 if token.surface.startswith("＊") or token.surface.startswith("イ"):
                     variant_indices.append((i, j))
 
-        # logger.info(f"records: {len(records)}")
-        return records
+        yield from buffer
 
     def _process_variants(self, records, variant_indices):
+        """Merge the variant records of a poem into the records they are
+        variants of, and remove the ＊ markers, the variants and the records
+        left without tokens from `records`.
+
+        This gives the same result as the original implementation (kept in
+        tests/test_variants.py), but deletions only touch a list of the
+        surviving positions, `records` is compacted once at the end, and tokens
+        are deduplicated by their field values instead of by list scans
+        comparing dataclasses."""
+        alive = list(range(len(records)))
         for k in range(len(variant_indices) - 3, -1, -3):
             begin_original, begin_variant, end_variant = variant_indices[k : k + 3]
 
             variant_count = end_variant[0] - begin_variant[0] - 1
 
             original_start_index = begin_original[0] + 1
-            variant_tokens = records[
-                begin_variant[0] + 1 : begin_variant[0] + 1 + variant_count
-            ]
-
-            for original_record, variant_record in zip(
-                records[original_start_index : original_start_index + variant_count],
-                variant_tokens,
+            for i, v in zip(
+                alive[original_start_index : original_start_index + variant_count],
+                alive[begin_variant[0] + 1 : begin_variant[0] + 1 + variant_count],
             ):
-                if original_record.segments and variant_record.segments:
-                    for original_segment, variant_segment in zip(
-                        original_record.segments, variant_record.segments
+                for original_segment, variant_segment in zip(
+                    records[i].segments, records[v].segments
+                ):
+                    if (
+                        original_segment.decomposition_type
+                        == variant_segment.decomposition_type
                     ):
-                        if (
-                            original_segment.decomposition_type
-                            == variant_segment.decomposition_type
-                        ):
-                            original_segment.tokens.extend(
-                                token
-                                for token in variant_segment.tokens
-                                if token not in original_segment.tokens
-                            )
+                        tokens = original_segment.tokens
+                        seen = set(map(_token_key, tokens))
+                        for token in variant_segment.tokens:
+                            key = _token_key(token)
+                            if key not in seen:
+                                seen.add(key)
+                                tokens.append(token)
 
             # Remove the ＊ and variant tokens at the end
-            del records[begin_variant[0] : begin_variant[0] + 2 + variant_count]
-            del records[begin_original[0]]
+            del alive[begin_variant[0] : begin_variant[0] + 2 + variant_count]
+            del alive[begin_original[0]]
 
         records[:] = [
-            record
-            for record in records
-            if all(segment.tokens for segment in record.segments)
+            records[i]
+            for i in alive
+            if all(segment.tokens for segment in records[i].segments)
         ]
 
     def __process_variants(self, records, variant_indices):
@@ -322,9 +2912,34 @@ class HachidaishuDB:
             #     f"Cleaned poem: {' '.join([r.token().surface for r in records if r.poem == poem_id and r.anthology == anthology])}"
             # )
 
-    def _read_db(self, filename="hachidai.db"):
-        with open(filename) as f:
-            for row in f.readlines():
+    def _read_db(self, filename="hachidai.db", digests=None, lazy=False):
+        """Parse the rows of `filename` into single-token records. If a
+        `digests` dict is given, a running digest of the rows of each poem is
+        kept in it (see _digested()). If `lazy` is true, the tokens are
+        LazyTokens."""
+        # Anthologies by their field in row ids, avoiding an Enum lookup per row.
+        anthologies = {f"{a.value:02d}": a for a in Anthology}
+        with open_db(filename) as f:
+            for row in f if digests is None else _digested(f, digests):
+                if lazy:
+                    id, token_type, bg_id, chasen_id, surface, lemma, readings = (
+                        row.rstrip().split(" ", 6)
+                    )
+                    if readings.count(" ") != 2:
+                        raise ValueError(f"Malformed row: {row!r}")
+                    anthology, poem, serial = id.split(":")
+                    if "〈" in surface or "〉" in surface:
+                        surface = re.sub(r"[〈〉]", "", surface)
+                    token = LazyToken(
+                        token_type, bg_id, chasen_id, surface, lemma, readings
+                    )
+                    yield HachidaishuRecord(
+                        anthologies.get(anthology) or Anthology(int(anthology)),
+                        int(poem),
+                        int(serial),
+                        [Decomposition([token], token_type[0])],
+                    )
+                    continue
                 fields = row.rstrip().split(" ")
                 (
                     id,
@@ -357,24 +2972,139 @@ class HachidaishuDB:
                     [Decomposition([token], decomposition_type)],
                 )
 
+    @staticmethod
+    def _snapshot_key(filename):
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return {
+            "version": SNAPSHOT_VERSION,
+            "source": h.hexdigest(),
+            "mappings": mapping_digest(),
+        }
+
+    @staticmethod
+    def _load_snapshot(snapshot, key):
+        """Return the records stored in `snapshot`, or None if the file is
+        missing, unreadable, corrupt or was built from different inputs. The
+        caller then rebuilds the snapshot, replacing the file."""
+        try:
+            with open(snapshot, "rb") as f:
+                if f.readline() != SNAPSHOT_MAGIC or pickle.load(f) != key:
+                    return None
+                digest = f.read(hashlib.sha256().digest_size)
+                payload = f.read()
+            # Pickle has no integrity check of its own: a damaged payload may
+            # fail in many ways or, worse, load different values.
+            if hashlib.sha256(payload).digest() != digest:
+                return None
+            rows, digests, noisy = pickle.loads(payload)
+            return [_record_from_tuple(row) for row in rows], digests, noisy
+        except Exception:
+            return None
+
+    @staticmethod
+    def _write_snapshot(snapshot, key, records, digests, noisy):
+        # Records are stored as plain tuples rather than pickled dataclasses, so
+        # that snapshots do not depend on the module the classes were loaded from
+        # (e.g. `__main__` when run as a script).
+        rows = [_record_to_tuple(record) for record in records]
+        payload = pickle.dumps((rows, digests, noisy), protocol=pickle.HIGHEST_PROTOCOL)
+        tmp = f"{snapshot}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(hashlib.sha256(payload).digest())
+            f.write(payload)
+        os.replace(tmp, snapshot)
+
+    def _build_index(self):
+        """Build the primary index mapping (anthology,), (anthology, poem) and
+        (anthology, poem, serial) keys to the [start, stop) record ranges they
+        occupy in self.db. Keys normally map to a single contiguous range; should
+        a key reappear later in the database, an additional range is added."""
+        index: dict[tuple, list[list[int]]] = {}
+        poems: dict[int, dict[int, None]] = {}  # anthology -> poems in corpus order
+        if isinstance(self.db, ColumnarStore):
+            # Find the runs of equal keys at each level with NumPy.
+            n = len(self.db)
+            columns = (self.db.anthology, self.db.poem, self.db.serial)
+            changed = np.zeros(max(n - 1, 0), dtype=bool)
+            for level, column in enumerate(columns, 1):
+                if not n:
+                    break
+                changed |= column[1:] != column[:-1]
+                starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+                keys = list(zip(*(c[starts].tolist() for c in columns[:level])))
+                bounds = starts.tolist() + [n]
+                for key, start, stop in zip(keys, bounds, bounds[1:]):
+                    index.setdefault(key, []).append([start, stop])
+                if level == 2:
+                    for a, p in keys:
+                        poems.setdefault(a, {})[p] = None
+        else:
+            prev = (None, None, None)
+            keys = ((r.anthology.value, r.poem, r.serial) for r in self.db)
+            for i, key in enumerate(keys):
+                for level in range(1, 4):
+                    if key[:level] == prev[:level]:
+                        index[key[:level]][-1][1] = i + 1
+                    else:
+                        index.setdefault(key[:level], []).append([i, i + 1])
+                poems.setdefault(key[0], {})[key[1]] = None
+                prev = key
+        self._index = index
+        self._poems = poems
+        # Derived indexes are rebuilt on demand.
+        self._inverted_index = None
+        self._semantic_index = None
+        self._columnar = None
+        self._ngram_engines = None
+        self._similarity_indexes = None
+        self._substring_indexes = None
+
+    def _ranges(self, anthology=None, poem=None, serial=None):
+        """Return the sorted record ranges matching the query arguments."""
+        if not (anthology or poem or serial):
+            return [(0, len(self.db))]
+        anthologies = [_anthology_value(anthology)] if anthology else list(self._poems)
+        if poem or serial:
+            keys = [
+                (a, p) + ((serial,) if serial else ())
+                for a in anthologies
+                for p in ([poem] if poem else self._poems.get(a, ()))
+            ]
+        else:
+            keys = [(a,) for a in anthologies]
+        return sorted(
+            (start, stop) for key in keys for start, stop in self._index.get(key, ())
+        )
+
     def query(self, anthology=None, poem=None, serial=None):
-        for record in self:
-            if anthology and record.anthology != Anthology(anthology):
-                continue
-            if poem and record.poem != poem:
-                continue
-            if serial and record.serial != serial:
-                continue
-            yield record
+        for start, stop in self._ranges(anthology, poem, serial):
+            yield from self.db[start:stop]
+
+    def poem(self, anthology, poem):
+        """Return the list of records making up `poem` in `anthology`."""
+        return [
+            record
+            for start, stop in self._ranges(anthology, poem)
+            for record in self.db[start:stop]
+        ]
 
     def tokens(self, mode="default", anthology=None, poem=None, serial=None):
+        if isinstance(self.db, ColumnarStore):
+            if mode in ("default", "decomposition"):
+                ranges = self._ranges(anthology, poem, serial)
+                yield from self.db.tokens(self.db.token_rows(ranges, mode))
+            return
         for record in self.query(anthology, poem, serial):
             if mode == "default":
                 yield record.token()
             elif mode == "decomposition":
                 for token_seq in record.decompositions():
-                    for token in token_seq:
-                        yield token
+                    yield from token_seq.tokens
 
     def text(
         self,
@@ -384,35 +3114,1070 @@ class HachidaishuDB:
         serial=None,
         embed_metadata=False,
     ):
+        return "\n".join(
+            self.text_lines(delimiter, anthology, poem, serial, embed_metadata)
+        )
+
+    def text_lines(
+        self,
+        delimiter=" ",
+        anthology=None,
+        poem=None,
+        serial=None,
+        embed_metadata=False,
+    ):
+        """Yield the lines of text() one poem at a time."""
+        if isinstance(self.db, ColumnarStore):
+            # Read the surfaces straight from the columns.
+            ranges = self._ranges(anthology, poem, serial)
+            records = self.db.record_rows(ranges)
+            surfaces = map(
+                self.db.vocabularies["surface"].__getitem__,
+                self.db.codes["surface"][self.db.token_rows(ranges)].tolist(),
+            )
+            keys = zip(
+                map(Anthology, self.db.anthology[records].tolist()),
+                self.db.poem[records].tolist(),
+            )
+            for key, poem in groupby(zip(keys, surfaces), key=lambda x: x[0]):
+                poem_surfaces = (surface for _, surface in poem)
+                yield _poem_text(key, poem_surfaces, delimiter, embed_metadata)
+            return
         by_poem = groupby(
             self.query(anthology=anthology, poem=poem, serial=serial),
             key=lambda r: (r.anthology, r.poem),
         )
-        return "\n".join(
-            f"{' '.join(str(info) for info in _poem_info) + ' ' if embed_metadata else ''}{delimiter.join(record.token().surface for record in poem)}"
-            for _poem_info, poem in by_poem
+        for key, poem in by_poem:
+            surfaces = (record.token().surface for record in poem)
+            yield _poem_text(key, surfaces, delimiter, embed_metadata)
+
+    def inverted_index(self):
+        """Return the InvertedIndex of this database, building it on first use."""
+        if getattr(self, "_inverted_index", None) is None:
+            self._inverted_index = InvertedIndex(self.db)
+        return self._inverted_index
+
+    def occurrences(self, value, field="lemma", mode="default", anthology=None):
+        """Return (record index, decomposition, position) triples of tokens
+        whose `field` equals `value`, optionally restricted to `anthology`.
+        `mode` selects canonical tokens only ("default") or all decompositions
+        ("decomposition"), as in tokens()."""
+        hits = self.inverted_index().occurrences(field, value, mode)
+        if anthology:
+            ranges = self._ranges(anthology)
+            hits = [h for h in hits if any(a <= h[0] < b for a, b in ranges)]
+        return hits
+
+    def concordance(
+        self, value, field="lemma", width=5, mode="default", anthology=None
+    ):
+        """Return a ConcordanceLine for every occurrence of `value` in `field`,
+        with up to `width` canonical tokens of context on each side taken from
+        the same poem."""
+        lines = []
+        for r, d, p in self.occurrences(value, field, mode, anthology):
+            record = self.db[r]
+            for start, stop in self._index[(record.anthology.value, record.poem)]:
+                if start <= r < stop:
+                    break
+            lines.append(
+                ConcordanceLine(
+                    record.anthology,
+                    record.poem,
+                    record.serial,
+                    r,
+                    d,
+                    p,
+                    [e.token() for e in self.db[max(start, r - width) : r]],
+                    record.segments[d][p],
+                    [e.token() for e in self.db[r + 1 : min(stop, r + 1 + width)]],
+                )
+            )
+        return lines
+
+    def substring_index(self, field="surface"):
+        """Return the SubstringIndex of `field` (e.g. "surface",
+        "lemma_reading" or "kanji_reading"), building it on first use."""
+        if getattr(self, "_substring_indexes", None) is None:
+            self._substring_indexes = {}
+        if field not in self._substring_indexes:
+            self._substring_indexes[field] = SubstringIndex.from_store(
+                self.columnar(), field
+            )
+        return self._substring_indexes[field]
+
+    def search(self, pattern, field="surface", match="substring"):
+        """Return a SubstringMatch for every occurrence of `pattern` in the
+        text of the poems in `field`, which may span several tokens; see
+        SubstringIndex.search()."""
+        return self.substring_index(field).search(pattern, match)
+
+    def semantic_index(self):
+        """Return the SemanticIndex of this database, building it on first use."""
+        if getattr(self, "_semantic_index", None) is None:
+            self._semantic_index = SemanticIndex(self.inverted_index())
+        return self._semantic_index
+
+    def semantic_occurrences(self, start, stop=None, mode="default", anthology=None):
+        """Return (record index, decomposition, position) triples of tokens whose
+        bg_id falls under classification prefix `start` (or from `start` through
+        `stop`), optionally restricted to `anthology`. For example,
+        `db.semantic_occurrences("1.5", anthology=Anthology.Shinkokinshu)`."""
+        records = self._ranges(anthology) if anthology else None
+        return self.semantic_index().occurrences(start, stop, mode, records)
+
+    def semantic_counts(
+        self, level="division", prefix=None, mode="default", anthology=None
+    ):
+        """Return token counts per Bunruigoihyo category at hierarchy `level`
+        (see SemanticIndex.LEVELS), optionally under `prefix` and restricted to
+        `anthology`."""
+        records = self._ranges(anthology) if anthology else None
+        return self.semantic_index().counts(level, prefix, mode, records)
+
+    def columnar(self):
+        """Return the records as a ColumnarStore, converting and caching them
+        on first use if the database uses the object backend."""
+        if isinstance(self.db, ColumnarStore):
+            return self.db
+        if getattr(self, "_columnar", None) is None:
+            self._columnar = ColumnarStore.from_records(self.db)
+        return self._columnar
+
+    def publish_shared(self, name=None):
+        """Publish the retokenized database in shared memory, for processes to
+        attach to by name; see SharedCorpus.publish()."""
+        return SharedCorpus.publish(self, name)
+
+    def save_binary(self, filename):
+        """Save the retokenized database to `filename` in the binary corpus
+        format (see ColumnarStore.save()), to be opened with open_binary()."""
+        self.columnar().save(filename)
+
+    @classmethod
+    def open_binary(cls, filename):
+        """Open a corpus file written by save_binary().
+
+        The file is memory-mapped rather than read (see ColumnarStore.open()),
+        so this is nearly instant and the corpus is shared between processes
+        that open it. The database uses the columnar backend and supports the
+        same queries as a loaded one, but cannot be updated."""
+        return cls._from_store(ColumnarStore.open(filename))
+
+    @classmethod
+    def attach_shared(cls, name):
+        """Return the read-only database published in shared memory as `name`
+        by publish_shared(); see SharedCorpus.attach()."""
+        return SharedCorpus.attach(name).db
+
+    @classmethod
+    def _from_store(cls, store):
+        """Return a read-only database over the ColumnarStore `store`."""
+        db = cls.__new__(cls)
+        db.db = store
+        db._digests = db._noisy = db._source = db.stats = None
+        db._lazy = False
+        db._overrides = {}
+        db._build_index()
+        return db
+
+    def _feature_keys(self, store, features, level):
+        """Encode the feature(s) of every token as one int64 key per token and
+        return the keys with a function decoding keys into labels."""
+        columns, vocabularies = [], []
+        for feature in features:
+            if feature == "bg_category":
+                labels = Vocabulary()
+                mapping = np.array(
+                    [
+                        labels.add(decode_bg_id(bg_id).label(level))
+                        for bg_id in store.vocabularies["bg_id"].strings
+                    ],
+                    dtype=np.int32,
+                )
+                columns.append(mapping[store.codes["bg_id"]])
+                vocabularies.append(labels)
+            elif feature in TOKEN_FIELDS:
+                columns.append(store.codes[feature])
+                vocabularies.append(store.vocabularies[feature])
+            else:
+                raise ValueError(f"Unknown feature: {feature}")
+        # Mixed-radix encoding; codes are shifted by one so that None (-1) is 0.
+        radices = [len(v) + 1 for v in vocabularies]
+        keys = np.zeros(len(store.token_record), dtype=np.int64)
+        for column, radix in zip(columns, radices):
+            keys = keys * radix + column + 1
+
+        def decode(keys):
+            digits = []
+            for radix in reversed(radices):
+                keys, digit = np.divmod(keys, radix)
+                digits.append(digit - 1)
+            decoded = [
+                [vocabulary[code] for code in column.tolist()]
+                for vocabulary, column in zip(vocabularies, reversed(digits))
+            ]
+            return decoded[0] if len(decoded) == 1 else list(zip(*decoded))
+
+        return keys, decode
+
+    def _token_mask(self, store, mode="default", anthology=None):
+        if mode == "default":
+            mask = store.canonical_mask()
+        elif mode == "decomposition":
+            mask = np.ones(len(store.token_record), dtype=bool)
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+        if anthology:
+            mask &= store.anthology[store.token_record] == _anthology_value(anthology)
+        return mask
+
+    def frequencies(
+        self, feature="surface", mode="default", anthology=None, level="division"
+    ):
+        """Return a FrequencyTable of `feature` over the tokens of the database
+        or of `anthology`.
+
+        `feature` is a Token field name (e.g. "surface", "lemma", "ud_pos",
+        "unidic_pos"), "bg_category" for the Bunruigoihyo category of bg_id at
+        hierarchy `level` (see SemanticIndex.LEVELS), or a tuple of these, in
+        which case labels are tuples. With mode="decomposition" the tokens of
+        all alternative decompositions are counted as well."""
+        store = self.columnar()
+        features = (feature,) if isinstance(feature, str) else tuple(feature)
+        keys, decode = self._feature_keys(store, features, level)
+        values, counts = np.unique(
+            keys[self._token_mask(store, mode, anthology)], return_counts=True
+        )
+        order = np.argsort(-counts, kind="stable")
+        return FrequencyTable(counts[order], decode(values[order]))
+
+    def crosstab(
+        self, feature="surface", mode="default", level="division", sparse=False
+    ):
+        """Return an anthology × `feature` ContingencyTable of token counts.
+
+        `feature`, `mode` and `level` are as for frequencies(). Columns cover
+        every feature value observed in the database. With `sparse=True` the
+        counts are returned as a scipy.sparse CSR matrix."""
+        store = self.columnar()
+        features = (feature,) if isinstance(feature, str) else tuple(feature)
+        keys, decode = self._feature_keys(store, features, level)
+        mask = self._token_mask(store, mode)
+        columns, column_index = np.unique(keys[mask], return_inverse=True)
+        rows, row_index = np.unique(
+            store.anthology[store.token_record[mask]], return_inverse=True
+        )
+        shape = (len(rows), len(columns))
+        if sparse:
+            csr_matrix = _csr_matrix("crosstab(sparse=True)")
+            counts = csr_matrix(
+                (np.ones(len(row_index), dtype=np.int64), (row_index, column_index)),
+                shape=shape,
+            )
+        else:
+            counts = np.bincount(
+                row_index * shape[1] + column_index, minlength=shape[0] * shape[1]
+            ).reshape(shape)
+        return ContingencyTable(
+            counts, [Anthology(int(a)) for a in rows], decode(columns)
+        )
+
+    def document_term_matrix(
+        self,
+        feature="lemma",
+        rows="poem",
+        mode="default",
+        level="division",
+        ud_pos=None,
+        anthology=None,
+    ):
+        """Return a DocumentTermMatrix of `feature` per poem or anthology of the
+        database or of `anthology`, computed from the columnar store in one
+        vectorized pass rather than by querying every poem.
+
+        The arguments are as for build_document_term_matrix(), which builds
+        the same matrix from streamed records for corpora that do not fit in
+        memory."""
+        if rows not in ("poem", "anthology"):
+            raise ValueError(f"Unknown rows: {rows}")
+        store = self.columnar()
+        features = (feature,) if isinstance(feature, str) else tuple(feature)
+        keys, decode = self._feature_keys(store, features, level)
+        mask = self._token_mask(store, mode, anthology)
+        tags = _ud_pos_tags(ud_pos)
+        if tags is not None:
+            # Codes of None (-1) index the final False.
+            selected = [s in tags for s in store.vocabularies["ud_pos"].strings] + [
+                False
+            ]
+            mask &= np.array(selected, dtype=bool)[store.codes["ud_pos"]]
+
+        # Row of every record, numbering poems or anthologies in database order.
+        starts = np.ones(len(store.anthology), dtype=bool)
+        starts[1:] = store.anthology[1:] != store.anthology[:-1]
+        if rows == "poem":
+            starts[1:] |= store.poem[1:] != store.poem[:-1]
+        if anthology:
+            selected = store.anthology == _anthology_value(anthology)
+        else:
+            selected = np.ones(len(store.anthology), dtype=bool)
+        starts &= selected
+        record_rows = np.cumsum(starts) - 1
+        if rows == "poem":
+            row_keys = [
+                (Anthology(a), p)
+                for a, p in zip(
+                    store.anthology[starts].tolist(), store.poem[starts].tolist()
+                )
+            ]
+        else:
+            row_keys = [Anthology(a) for a in store.anthology[starts].tolist()]
+
+        records = store.token_record[mask]
+        if mode == "decomposition":
+            weights = 1 / np.diff(store.record_segments)[records]
+        else:
+            weights = np.ones(len(records), dtype=np.int64)
+        values, first, inverse = np.unique(
+            keys[mask], return_index=True, return_inverse=True
+        )
+        # Number the columns in order of first occurrence.
+        order = np.argsort(first, kind="stable")
+        columns = np.empty(len(order), dtype=np.int64)
+        columns[order] = np.arange(len(order))
+
+        csr_matrix = _csr_matrix("document_term_matrix()")
+        matrix = csr_matrix(
+            (weights, (record_rows[records], columns[inverse.ravel()])),
+            shape=(len(row_keys), len(values)),
+        )
+        matrix.sum_duplicates()
+        return DocumentTermMatrix(matrix, row_keys, decode(values[order]))
+
+    def ngram_engine(self, feature="lemma"):
+        """Return the NgramEngine over `feature`, building it on first use."""
+        if getattr(self, "_ngram_engines", None) is None:
+            self._ngram_engines = {}
+        if feature not in self._ngram_engines:
+            self._ngram_engines[feature] = NgramEngine(self.columnar(), feature)
+        return self._ngram_engines[feature]
+
+    def similarity_index(
+        self,
+        feature="lemma",
+        shingle=2,
+        characters=False,
+        num_perm=128,
+        bands=32,
+        seed=0,
+    ):
+        """Return the SimilarityIndex of poems with these parameters, building
+        it on first use. For example, to find Shinkokinshu poems alluding to
+        Kokinshu poems by the kana text they share:
+
+            index = db.similarity_index("kanji_reading", shingle=4, characters=True)
+            index.pairs(0.3, anthology="Shinkokinshu", source="Kokinshu")"""
+        if getattr(self, "_similarity_indexes", None) is None:
+            self._similarity_indexes = {}
+        key = (feature, shingle, characters, num_perm, bands, seed)
+        if key not in self._similarity_indexes:
+            self._similarity_indexes[key] = SimilarityIndex(self.columnar(), *key)
+        return self._similarity_indexes[key]
+
+    def ngrams(
+        self, n=2, feature="lemma", min_count=1, anthology=None, by_anthology=False
+    ):
+        """Return an NgramTable of the n-grams of canonical tokens' `feature`
+        with their PMI, log-likelihood and t-score association scores.
+
+        N-grams never span two poems. Only n-grams seen at least `min_count`
+        times are kept. With `anthology` the counts are restricted to that
+        anthology; with `by_anthology=True` a dict mapping each Anthology to
+        its own table is returned instead."""
+        engine = self.ngram_engine(feature)
+        if by_anthology:
+            return {
+                Anthology(a): engine.table(n, min_count, a)
+                for a in np.unique(engine.anthology).tolist()
+            }
+        return engine.table(n, min_count, anthology)
+
+    def write_jsonl(
+        self, filename, decompositions=False, shard_poems=None, workers=None, merge=True
+    ):
+        """Write the database as JSON lines, one record per line.
+
+        Each line is the JSON of record.to_json(); with `decompositions=True`
+        all decomposition segments of the record are included as well, under
+        "decompositions". Records are serialised straight from their field
+        values rather than through dataclasses.asdict().
+
+        The records are split into shards, one per anthology or, if
+        `shard_poems` is given, per that many poems, which are written to
+        numbered files next to `filename` (e.g. hachidaishu-00000.jsonl) by a
+        pool of `workers` processes. With `merge=True` the shards are then
+        concatenated into `filename` in database order and removed.
+
+        A manifest, `filename + ".manifest.json"`, records the record count,
+        size and SHA-256 checksum of every shard and of the merged file, as
+        well as the byte offset of each shard in the merged file; use
+        verify_jsonl() to check an export against it. The manifest is also
+        returned."""
+        root, ext = os.path.splitext(os.fspath(filename))
+        if shard_poems is None:
+            groups = (
+                records for _, records in groupby(self, key=lambda r: r.anthology)
+            )
+        else:
+            poems = (
+                list(records)
+                for _, records in groupby(self, key=lambda r: (r.anthology, r.poem))
+            )
+            groups = (
+                chain.from_iterable(chunk)
+                for chunk in iter(lambda: list(islice(poems, shard_poems)), [])
+            )
+
+        shards = []
+        executor = ProcessPoolExecutor(workers) if workers and workers > 1 else None
+        try:
+            for k, records in enumerate(groups):
+                rows = [_record_to_tuple(r) for r in records]
+                path = f"{root}-{k:05d}{ext}"
+                shard = {
+                    "file": os.path.basename(path),
+                    "first": {
+                        "anthology": Anthology(rows[0][0]).name,
+                        "poem": rows[0][1],
+                    },
+                    "last": {
+                        "anthology": Anthology(rows[-1][0]).name,
+                        "poem": rows[-1][1],
+                    },
+                }
+                if executor is None:
+                    result = _write_jsonl_shard(path, rows, decompositions)
+                else:
+                    result = executor.submit(
+                        _write_jsonl_shard, path, rows, decompositions
+                    )
+                shards.append((path, shard, result))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        manifest = {"decompositions": decompositions, "shards": []}
+        for path, shard, result in shards:
+            if executor is not None:
+                result = result.result()
+            shard["records"], shard["bytes"], shard["sha256"] = result
+            manifest["shards"].append(shard)
+
+        if merge:
+            h = hashlib.sha256()
+            offset = 0
+            with open(filename, "wb") as out:
+                for path, shard, _ in shards:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    out.write(data)
+                    h.update(data)
+                    os.remove(path)
+                    del shard["file"]
+                    shard["offset"] = offset
+                    offset += len(data)
+            manifest["file"] = os.path.basename(os.fspath(filename))
+            manifest["records"] = sum(shard["records"] for _, shard, _ in shards)
+            manifest["bytes"] = offset
+            manifest["sha256"] = h.hexdigest()
+        with open(os.fspath(filename) + ".manifest.json", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        return manifest
+
+    @staticmethod
+    def verify_jsonl(manifest):
+        """Check a write_jsonl() export against its manifest file, returning
+        the shard entries whose records do not match their checksum (an empty
+        list if the export is intact)."""
+        with open(manifest, encoding="utf-8") as f:
+            m = json.load(f)
+        directory = os.path.dirname(manifest)
+        failed = []
+        if "file" in m:
+            with open(os.path.join(directory, m["file"]), "rb") as f:
+                data = f.read()
+            if hashlib.sha256(data).hexdigest() != m["sha256"]:
+                for shard in m["shards"]:
+                    chunk = data[shard["offset"] : shard["offset"] + shard["bytes"]]
+                    if hashlib.sha256(chunk).hexdigest() != shard["sha256"]:
+                        failed.append(shard)
+                failed = failed or m["shards"]
+        else:
+            for shard in m["shards"]:
+                try:
+                    with open(os.path.join(directory, shard["file"]), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    data = None
+                if data is None or hashlib.sha256(data).hexdigest() != shard["sha256"]:
+                    failed.append(shard)
+        return failed
+
+    def write_tei(self, f, date=None):
+        """Write the database as TEI XML to the text file object `f`.
+
+        The output has the structure of hachidaishu.xml as generated by
+        Hachidaishu_WLSP_TEI_Conversion.ipynb: the same teiHeader, then one
+        <div type="anthology"> per anthology, one <lg type="waka"><l> per
+        poem, and a <w> element per token carrying its IPAdic POS, lemma and
+        UD/IPAdic/UniDic POS tags, readings and WLSP number in `msd`. Records
+        with alternative decompositions become <app> elements with one <rdg>
+        per decomposition. WLSP2 numbers and descriptions, which the notebook
+        maps from external resources, are left out.
+
+        Elements are written poem by poem instead of being built into a tree
+        first. `date` (an ISO 8601 string) defaults to today."""
+        if date is None:
+            date = datetime.date.today().isoformat()
+        _write_tei(self, f, _tei_counts(self), date)
+
+
+# Shared memory blocks published by SharedCorpus start with a control area of
+# SHARED_SLOTS process ids (int64, 0 for a free slot), followed by the contents
+# of a corpus file. Unless named otherwise, blocks are named SHARED_PREFIX
+# followed by the publisher's process id and a random suffix.
+SHARED_PREFIX = "hachidaishu_"
+SHARED_SLOTS = 1024
+_SHARED_CONTROL = 8 * SHARED_SLOTS
+
+# The SharedCorpus of each block the process is attached to, by name.
+_attached = {}
+
+
+def _alive(pid):
+    if os.name != "posix":  # os.kill() would terminate the process.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def _shared_lock(name):
+    """Hold an exclusive lock on the control area of the block `name`."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _attached_pids(buffer, add=None, remove=None):
+    """Add and/or remove a process id in the control area in `buffer`,
+    dropping those of processes that have exited, and return the ids left.
+    The caller must hold the block's lock."""
+    pids = [
+        pid
+        for pid in struct.unpack_from(f"<{SHARED_SLOTS}q", buffer)
+        if pid and _alive(pid)
+    ]
+    if remove in pids:
+        pids.remove(remove)
+    if add is not None:
+        if len(pids) == SHARED_SLOTS:
+            raise ValueError(
+                f"At most {SHARED_SLOTS} processes can attach to a shared corpus."
+            )
+        pids.append(add)
+    struct.pack_into(
+        f"<{SHARED_SLOTS}q", buffer, 0, *pids, *repeat(0, SHARED_SLOTS - len(pids))
+    )
+    return pids
+
+
+def _open_shared_memory(name):
+    """Open the existing shared memory block `name`, and return it with whether
+    it was taken off this process's resource tracker.
+
+    Opening a block registers it with the resource tracker, which unlinks it
+    when the process exits. A process started by multiprocessing shares the
+    tracker of its parent, where the publisher has registered the block
+    already; any other process has its own tracker and must unregister it."""
+    shm = shared_memory.SharedMemory(name)
+    if os.name == "posix" and parent_process() is None:
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm, True
+    return shm, False
+
+
+def _unlink_shared_memory(shm, untracked):
+    """Unlink the block `shm` and remove its lock file, which is removed even
+    if the block was unlinked already (FileNotFoundError)."""
+    try:
+        if untracked:  # unlink() unregisters the block again.
+            resource_tracker.register(shm._name, "shared_memory")
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            if untracked:
+                resource_tracker.unregister(shm._name, "shared_memory")
+            raise
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(tempfile.gettempdir(), f"{shm.name}.lock"))
+
+
+class SharedCorpus:
+    """A retokenized database in a shared memory block, which processes attach
+    to by name without copying or unpickling it:
+
+        def work(name, poem):
+            db = HachidaishuDB.attach_shared(name)
+            ...
+
+        with HachidaishuDB().publish_shared() as shared:
+            with ProcessPoolExecutor() as pool:
+                pool.map(work, repeat(shared.name), poems)
+
+    The block holds the binary corpus format (see ColumnarStore.save()), which
+    `db` views read-only like a database opened with open_binary(). A
+    SharedCorpus pickles as its name and attaches when unpickled, so it can
+    also be passed to workers directly.
+
+    The block keeps the ids of the processes attached to it, the publisher
+    included. close() detaches the calling process, and unlinks the block once
+    no other process is attached; ids of processes that exited without
+    detaching are dropped, so a crashed worker does not keep the block alive.
+    If the publisher crashes, the multiprocessing resource tracker unlinks the
+    block once the publisher and its children have exited, and cleanup()
+    removes any blocks left behind when the tracker was killed too. Processes
+    detach at exit."""
+
+    def __init__(self, shm, publisher=False, untracked=False):
+        # Use publish() or attach().
+        self._shm = shm
+        self.publisher = publisher
+        self._untracked = untracked
+        self._pid = os.getpid()
+        self.closed = False
+        store = ColumnarStore.from_buffer(
+            shm.buf[_SHARED_CONTROL:].toreadonly(), shm.name
+        )
+        self.db = HachidaishuDB._from_store(store)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def publish(cls, db, name=None):
+        """Copy the HachidaishuDB `db` into a new shared memory block named
+        `name` and return its SharedCorpus, with the calling process attached."""
+        chunks = db.columnar()._chunks()
+        if name is None:
+            name = f"{SHARED_PREFIX}{os.getpid()}_{secrets.token_hex(4)}"
+        size = _SHARED_CONTROL + sum(len(chunk) for chunk in chunks)
+        # Locked until attached, so that cleanup() does not take the new block
+        # for an abandoned one.
+        with _shared_lock(name.lstrip("/")):
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+            _attached_pids(shm.buf, add=os.getpid())
+        try:
+            offset = _SHARED_CONTROL
+            for chunk in chunks:
+                shm.buf[offset : offset + len(chunk)] = chunk
+                offset += len(chunk)
+            shared = cls(shm, publisher=True)
+        except BaseException:
+            shm.close()
+            _unlink_shared_memory(shm, False)
+            raise
+        return shared._register()
+
+    @classmethod
+    def attach(cls, name):
+        """Attach the calling process to the block `name` and return its
+        SharedCorpus, or the one the process is already attached with."""
+        shared = _attached.get(name)
+        if shared is not None and shared._pid == os.getpid():
+            return shared
+        shm, untracked = _open_shared_memory(name)
+        try:
+            with _shared_lock(shm.name):
+                _attached_pids(shm.buf, add=os.getpid())
+            shared = cls(shm, untracked=untracked)
+        except BaseException:
+            shm.close()
+            raise
+        return shared._register()
+
+    def _register(self):
+        _attached[self.name] = self
+        atexit.register(self.close)
+        return self
+
+    @property
+    def processes(self):
+        """The ids of the live processes attached to the block."""
+        with _shared_lock(self.name):
+            return _attached_pids(self._shm.buf)
+
+    def close(self):
+        """Detach the calling process, unlinking the block if no other process
+        is attached. `db` must not be used afterwards, and arrays taken from it
+        must have been dropped, as the block cannot be unmapped while they view
+        it (BufferError); the process is detached either way."""
+        if self.closed or self._pid != os.getpid():
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        if _attached.get(self.name) is self:
+            del _attached[self.name]
+        self.db = None
+        with _shared_lock(self.name):
+            pids = _attached_pids(self._shm.buf, remove=self._pid)
+            if not pids:
+                with contextlib.suppress(FileNotFoundError):
+                    _unlink_shared_memory(self._shm, self._untracked)
+            elif (
+                self.publisher
+                and os.name == "posix"
+                and not set(pids) & {p.pid for p in active_children()}
+            ):
+                # Left to processes with resource trackers of their own, one of
+                # which will unlink it.
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+        try:
+            self._shm.close()
+        except BufferError:
+            # The views of the block may only be kept alive by reference cycles.
+            gc.collect()
+            try:
+                self._shm.close()
+            except BufferError:
+                raise BufferError(
+                    "Arrays of the shared corpus are still in use; drop them "
+                    "before close()."
+                ) from None
+
+    def unlink(self):
+        """Unlink the block now, whether or not other processes are attached.
+        They keep their view of it, but no process can attach any more."""
+        with contextlib.suppress(FileNotFoundError):
+            _unlink_shared_memory(self._shm, self._untracked)
+
+    @staticmethod
+    def cleanup(directory="/dev/shm"):
+        """Unlink the blocks in `directory` (where Linux keeps shared memory)
+        named with SHARED_PREFIX that no live process is attached to, such as
+        those of a publisher killed along with its resource tracker, and stale
+        lock files. Returns the names of the blocks unlinked."""
+        if not os.path.isdir(directory):
+            return []
+        unlinked = []
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith(SHARED_PREFIX):
+                continue
+            try:
+                shm, untracked = _open_shared_memory(name)
+            except (FileNotFoundError, ValueError):  # Unlinked meanwhile, or empty.
+                continue
+            with _shared_lock(name):
+                if shm.size < _SHARED_CONTROL or not _attached_pids(shm.buf):
+                    with contextlib.suppress(FileNotFoundError):
+                        _unlink_shared_memory(shm, untracked)
+                        unlinked.append(name)
+            shm.close()
+        # Lock files of blocks unlinked by a resource tracker.
+        blocks = set(os.listdir(directory))
+        for lock in os.listdir(tempfile.gettempdir()):
+            if (
+                lock.startswith(SHARED_PREFIX)
+                and lock.endswith(".lock")
+                and lock[:-5] not in blocks
+            ):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(tempfile.gettempdir(), lock))
+        return unlinked
+
+    def __reduce__(self):
+        return SharedCorpus.attach, (self.name,)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _anthology_arg(value):
+    """Parse an anthology given by number or (case-insensitive) name."""
+    if value.isdigit() and int(value) in {a.value for a in Anthology}:
+        return Anthology(int(value))
+    for anthology in Anthology:
+        if anthology.name.casefold() == value.casefold():
+            return anthology
+    names = ", ".join(a.name for a in Anthology)
+    raise argparse.ArgumentTypeError(f"expected a number from 1 to 8 or one of {names}")
+
+
+def _cli_records(args):
+    """Yield the records selected by the command line `args`. Unless --cache or
+    --workers are given, they are retokenized from the database as a stream
+    instead of loading it."""
+    if args.cache or (args.workers or 0) > 1:
+        db = HachidaishuDB(
+            args.database, cache=args.cache, workers=args.workers, lazy=args.lazy
+        )
+        yield from db.query(args.anthology, args.poem)
+        return
+    for record in HachidaishuDB.stream(args.database, lazy=args.lazy):
+        if (args.anthology is None or record.anthology == args.anthology) and (
+            args.poem is None or record.poem == args.poem
+        ):
+            yield record
+
+
+def _cli_poems(args):
+    """Yield the ((anthology, poem), records) of the selected poems."""
+    for key, records in groupby(
+        _cli_records(args), key=lambda r: (r.anthology, r.poem)
+    ):
+        yield key, list(records)
+
+
+def _cli_validate(args, out):
+    problems = poems = records = 0
+    for (anthology, poem), rs in _cli_poems(args):
+        poems += 1
+        records += len(rs)
+        messages = [
+            f"token {token.surface} of record {record.serial} has no UD POS"
+            for record in rs
+            for decomposition in record.segments
+            for token in decomposition.tokens
+            if token.ud_pos is None
+        ]
+        if len(rs) < args.min_tokens:
+            messages.append(f"poem has {len(rs)} tokens")
+        for message in messages:
+            out.write(f"{anthology.name}:{poem}\t{message}\n")
+        problems += len(messages)
+    print(
+        f"Validated {records} records in {poems} poems: {problems} problems.",
+        file=sys.stderr,
+    )
+    return 1 if problems else 0
+
+
+def _cli_stats(args, out):
+    if args.top:
+        counts = Counter(
+            getattr(token, args.feature)
+            for _, rs in _cli_poems(args)
+            for record in rs
+            for token in (
+                [record.token()]
+                if args.mode == "default"
+                else chain.from_iterable(d.tokens for d in record.segments)
+            )
+        )
+        for value, count in counts.most_common(args.top):
+            out.write(f"{'' if value is None else value}\t{count}\n")
+        return 0
+    columns = ("poems", "records", "tokens", "characters")
+    totals = dict.fromkeys(columns, 0)
+    out.write("\t".join(("anthology",) + columns) + "\n")
+
+    def write(name, counts):
+        out.write(
+            "\t".join([name] + [str(counts[column]) for column in columns]) + "\n"
         )
 
+    for anthology, poems in groupby(_cli_poems(args), key=lambda x: x[0][0]):
+        counts = dict.fromkeys(columns, 0)
+        for _, rs in poems:
+            counts["poems"] += 1
+            counts["records"] += len(rs)
+            counts["tokens"] += sum(
+                len(d.tokens) for record in rs for d in record.segments
+            )
+            counts["characters"] += sum(len(record.token().surface) for record in rs)
+        write(anthology.name, counts)
+        for column in columns:
+            totals[column] += counts[column]
+    write("total", totals)
+    return 0
+
+
+def _cli_text(args, out):
+    for key, rs in _cli_poems(args):
+        surfaces = (record.token().surface for record in rs)
+        out.write(_poem_text(key, surfaces, args.delimiter, args.metadata) + "\n")
+    return 0
+
+
+def _cli_tokens(args, out):
+    fields = args.fields.split(",")
+    unknown = set(fields) - set(TOKEN_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown token fields: {', '.join(sorted(unknown))}")
+    if args.header:
+        out.write("\t".join(["anthology", "poem", "serial"] + fields) + "\n")
+    values = (
+        attrgetter(*fields) if len(fields) > 1 else lambda t: (getattr(t, fields[0]),)
+    )
+    for (anthology, poem), rs in _cli_poems(args):
+        lines = []
+        for record in rs:
+            tokens = (
+                [record.token()]
+                if args.mode == "default"
+                else chain.from_iterable(d.tokens for d in record.segments)
+            )
+            prefix = f"{anthology.name}\t{poem}\t{record.serial}\t"
+            for token in tokens:
+                lines.append(
+                    prefix
+                    + "\t".join("" if v is None else v for v in values(token))
+                    + "\n"
+                )
+        out.write("".join(lines))
+    return 0
+
+
+def _cli_export(args, out):
+    if args.format == "jsonl":
+        for _, rs in _cli_poems(args):
+            out.write(
+                "".join(_jsonl_lines(map(_record_to_tuple, rs), args.decompositions))
+            )
+    elif args.format == "csv":
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(("anthology", "poem", "serial") + TOKEN_FIELDS)
+        for _, rs in _cli_poems(args):
+            writer.writerows(
+                (record.anthology.name, record.poem, record.serial)
+                + _token_values(record.token())
+                for record in rs
+            )
+    else:
+        # The header counts need a first pass over the records, which are
+        # retokenized again for the second unless they come from stdin.
+        if args.database == "-":
+            records = list(_cli_records(args))
+            counts = _tei_counts(records)
+        else:
+            counts = _tei_counts(_cli_records(args))
+            records = _cli_records(args)
+        _write_tei(records, out, counts, args.date or datetime.date.today().isoformat())
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Retokenize a hachidai.db database and stream it poem by poem."
+    )
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "database",
+        nargs="?",
+        default="hachidai.db",
+        help="database file, or - for stdin",
+    )
+    common.add_argument("-o", "--output", help="output file (default: stdout)")
+    common.add_argument(
+        "--anthology", type=_anthology_arg, help="only this anthology (number or name)"
+    )
+    common.add_argument("--poem", type=int, help="only poems with this number")
+    common.add_argument(
+        "--workers", type=int, help="load the database with this many processes first"
+    )
+    common.add_argument(
+        "--cache",
+        nargs="?",
+        const=True,
+        metavar="SNAPSHOT",
+        help="load the database through a snapshot cache first",
+    )
+    common.add_argument("--lazy", action="store_true", help="use lazy tokens")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    validate = commands.add_parser(
+        "validate",
+        parents=[common],
+        help="check every token has a UD POS and poem lengths",
+    )
+    validate.add_argument(
+        "--min-tokens", type=int, default=6, help="minimum tokens per poem (default: 6)"
+    )
+    validate.set_defaults(run=_cli_validate)
+
+    stats = commands.add_parser(
+        "stats", parents=[common], help="count poems, records, tokens and characters"
+    )
+    stats.add_argument(
+        "--top", type=int, help="list the N most frequent values instead"
+    )
+    stats.add_argument("--feature", choices=TOKEN_FIELDS, default="surface")
+    stats.add_argument(
+        "--mode", choices=("default", "decomposition"), default="default"
+    )
+    stats.set_defaults(run=_cli_stats)
+
+    text = commands.add_parser("text", parents=[common], help="one poem per line")
+    text.add_argument("--delimiter", default=" ")
+    text.add_argument(
+        "--metadata",
+        action="store_true",
+        help="start lines with the anthology and poem",
+    )
+    text.set_defaults(run=_cli_text)
+
+    tokens = commands.add_parser("tokens", parents=[common], help="one token per line")
+    tokens.add_argument(
+        "--fields",
+        default="surface,lemma,ud_pos",
+        help="comma-separated token fields (default: %(default)s)",
+    )
+    tokens.add_argument(
+        "--mode", choices=("default", "decomposition"), default="default"
+    )
+    tokens.add_argument("--header", action="store_true")
+    tokens.set_defaults(run=_cli_tokens)
+
+    export = commands.add_parser(
+        "export", parents=[common], help="write JSONL, TEI or CSV"
+    )
+    export.add_argument("--format", choices=("jsonl", "tei", "csv"), default="jsonl")
+    export.add_argument(
+        "--decompositions",
+        action="store_true",
+        help="JSONL: include all decompositions",
+    )
+    export.add_argument("--date", help="TEI: publication date (default: today)")
+    export.set_defaults(run=_cli_export)
+
+    args = parser.parse_args(argv)
+    try:
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as out:
+                return args.run(args, out)
+        return args.run(args, sys.stdout)
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`); silence the flush at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except (OSError, ValueError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+
 
 if __name__ == "__main__":
-    db = HachidaishuDB()
-    for e in db:
-        for ts in e.segments:
-            for t in ts.tokens:
-                assert t.ud_pos is not None
-    for poem in db.text(embed_metadata=True).split("\n"):
-        assert len(poem.split()) > 3, poem
-    for meta, poem in groupby(db.query(), key=lambda r: (r.anthology, r.poem)):
-        tokens = [r.token() for r in poem]
-        assert len(tokens) > 5, meta
-
-    print("Validation complete. Printing the top 20 and bottom 20 tokens.")
-    c = Counter((t.surface, t.ud_pos) for t in db.tokens())
-    for token, freq in c.most_common(20):
-        print(f"{token}: {freq}")
-    print()
-    for token, freq in c.most_common()[:-21:-1]:
-        print(f"{token}: {freq}")
-
-    print("Printing space-delimited corpus.")
-    print(db.text())
+    sys.exit(main())
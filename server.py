@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""Serve one loaded HachidaishuDB to local clients.
+
+The server loads the corpus once and answers query, poem, tokens, text,
+concordance and frequencies requests over a Unix socket or a localhost TCP
+port. Client mirrors the corresponding HachidaishuDB methods:
+
+    python server.py --socket /tmp/hachidaishu.sock hachidai.db
+
+    >>> from server import Client
+    >>> client = Client("/tmp/hachidaishu.sock")
+    >>> client.frequencies("lemma").most_common(3)
+
+The protocol is JSON lines. A request is {"id": ..., "method": ...,
+"params": {...}}; it is answered by any number of {"id": ..., "items":
+[...]} chunks, ended by {"id": ..., "done": true} or {"id": ..., "error":
+"..."}. Requests arriving together, from any number of connections, are
+collected into a batch, and identical requests within a batch are only
+computed once. Results are produced in a worker thread CHUNK_SIZE items at a
+time and each chunk is sent as soon as it is ready, so that neither side
+holds a whole result in memory."""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from hachidaishu import (
+    Anthology,
+    ConcordanceLine,
+    FrequencyTable,
+    HachidaishuDB,
+    _record_from_tuple,
+    _record_to_tuple,
+    _token_from_tuple,
+    _token_values,
+    np,
+)
+
+# Items per response line.
+CHUNK_SIZE = 1000
+
+
+def _concordance_line(line):
+    return [
+        line.anthology.value,
+        line.poem,
+        line.serial,
+        line.record,
+        line.decomposition,
+        line.position,
+        [_token_values(token) for token in line.left],
+        _token_values(line.token),
+        [_token_values(token) for token in line.right],
+    ]
+
+
+def _label(label):
+    return tuple(label) if isinstance(label, list) else label
+
+
+# Request handlers, returning an iterable of JSON-serialisable items. Items
+# are pulled from it CHUNK_SIZE at a time, as they are sent.
+METHODS = {
+    "query": lambda db, anthology=None, poem=None, serial=None: (
+        _record_to_tuple(record) for record in db.query(anthology, poem, serial)
+    ),
+    "poem": lambda db, anthology, poem: (
+        _record_to_tuple(record) for record in db.poem(anthology, poem)
+    ),
+    "tokens": lambda db, mode="default", anthology=None, poem=None, serial=None: (
+        _token_values(token) for token in db.tokens(mode, anthology, poem, serial)
+    ),
+    "text": lambda db, **params: db.text_lines(**params),
+    "concordance": lambda db, value, **params: (
+        _concordance_line(line) for line in db.concordance(value, **params)
+    ),
+    "frequencies": lambda db, **params: iter(db.frequencies(**params).most_common()),
+}
+
+
+class QueryServer:
+    """Answers requests against `db`. Requests are collected for up to
+    `batch_window` seconds after the first one arrives; each distinct request
+    of the batch is then executed once, and its items are streamed to all
+    the clients that sent it as they are produced."""
+
+    def __init__(self, db, batch_window=0.002):
+        self.db = db
+        self.batch_window = batch_window
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._batcher = None
+        self._connections = set()
+        self._streams = set()
+
+    async def _send(self, subscribers, message):
+        """Send `message` to every (id, writer, lock, done) subscriber that is
+        still listening and return those that are."""
+
+        async def send(subscriber):
+            id, writer, lock, done = subscriber
+            line = (
+                json.dumps({"id": id, **message}, ensure_ascii=False).encode() + b"\n"
+            )
+            try:
+                async with lock:
+                    writer.write(line)
+                    await writer.drain()
+            except ConnectionError:
+                if not done.done():
+                    done.set_result(None)
+
+        subscribers = [
+            subscriber
+            for subscriber in subscribers
+            if not subscriber[3].done() and not subscriber[1].is_closing()
+        ]
+        await asyncio.gather(*map(send, subscribers))
+        return [subscriber for subscriber in subscribers if not subscriber[3].done()]
+
+    async def _stream(self, key, subscribers):
+        """Execute the request `key` in the worker thread, sending its items
+        to `subscribers` one chunk at a time."""
+        loop = asyncio.get_running_loop()
+        method, params = key[0], json.loads(key[1])
+        try:
+            items = await loop.run_in_executor(
+                self._executor, lambda: iter(METHODS[method](self.db, **params))
+            )
+            while subscribers:
+                chunk = await loop.run_in_executor(
+                    self._executor, lambda: list(islice(items, CHUNK_SIZE))
+                )
+                if not chunk:
+                    break
+                subscribers = await self._send(subscribers, {"items": chunk})
+            message = {"done": True}
+        except Exception as e:  # Reported to the client.
+            message = {"error": f"{type(e).__name__}: {e}"}
+        for subscriber in await self._send(subscribers, message):
+            subscriber[3].set_result(None)
+
+    async def _batch(self):
+        while True:
+            pending = [await self._queue.get()]
+            await asyncio.sleep(self.batch_window)
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            batch = {}
+            for key, subscriber in pending:
+                batch.setdefault(key, []).append(subscriber)
+            for key, subscribers in batch.items():
+                task = asyncio.create_task(self._stream(key, subscribers))
+                self._streams.add(task)
+                task.add_done_callback(self._streams.discard)
+
+    async def _respond(self, request, writer, lock):
+        id = request.get("id")
+        method, params = request.get("method"), request.get("params") or {}
+        done = asyncio.get_running_loop().create_future()
+        if method not in METHODS:
+            await self._send(
+                [(id, writer, lock, done)], {"error": f"Unknown method: {method}"}
+            )
+            return
+        key = (method, json.dumps(params, sort_keys=True))
+        await self._queue.put((key, (id, writer, lock, done)))
+        await done
+
+    async def _handle(self, reader, writer):
+        connection = asyncio.current_task()
+        self._connections.add(connection)
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = {"method": None}
+                task = asyncio.create_task(self._respond(request, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by stop(). Ending normally keeps the stream protocol's
+            # done callback from logging the cancellation as an error.
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            self._connections.discard(connection)
+
+    async def start(self, address):
+        """Start serving on `address`, a Unix socket path or a (host, port)
+        pair, and return the asyncio.Server."""
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch())
+        if isinstance(address, str):
+            return await asyncio.start_unix_server(self._handle, address)
+        return await asyncio.start_server(self._handle, *address)
+
+    async def stop(self):
+        """Cancel the open connections and the batcher, wait for them to
+        finish and shut down the worker thread. The server cannot be started
+        again."""
+        tasks = list(self._connections) + list(self._streams)
+        if self._batcher is not None:
+            tasks.append(self._batcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(self._executor.shutdown, cancel_futures=True)
+
+    async def serve_forever(self, address):
+        server = await self.start(address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.stop()
+
+
+class ServerThread:
+    """Run a QueryServer for `db` on `address` in a background thread, e.g.
+    to share a corpus within a notebook or to test clients:
+
+        with ServerThread(db, ("127.0.0.1", 0)) as address:
+            client = Client(address)
+
+    A TCP port of 0 picks a free port; the address actually served is
+    returned on entering the context."""
+
+    def __init__(self, db, address, batch_window=0.002):
+        self.server = QueryServer(db, batch_window)
+        self.address = address
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._asyncio_server = None
+
+    def __enter__(self):
+        self._thread.start()
+        self._asyncio_server = asyncio.run_coroutine_threadsafe(
+            self.server.start(self.address), self._loop
+        ).result()
+        if not isinstance(self.address, str):
+            self.address = self._asyncio_server.sockets[0].getsockname()[:2]
+        return self.address
+
+    def __exit__(self, *exc_info):
+        async def stop():
+            self._asyncio_server.close()
+            await self.server.stop()
+            await self._asyncio_server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+class ServerError(Exception):
+    """An error raised by the server while executing a request."""
+
+
+def _anthology(anthology):
+    return anthology.value if isinstance(anthology, Anthology) else anthology
+
+
+class Client:
+    """Blocking client for a QueryServer on `address`, a Unix socket path or
+    a (host, port) pair. Its methods mirror those of HachidaishuDB; query()
+    and tokens() yield their results as they arrive. A client is meant to be
+    used by one thread at a time."""
+
+    def __init__(self, address):
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.connect(address if isinstance(address, str) else tuple(address))
+        self._file = self._socket.makefile("rwb")
+        self._next_id = 0
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, **params):
+        """Send a request and yield the items of its response."""
+        self._next_id += 1
+        id = self._next_id
+        request = {"id": id, "method": method, "params": params}
+        self._file.write(json.dumps(request, ensure_ascii=False).encode() + b"\n")
+        self._file.flush()
+        while line := self._file.readline():
+            message = json.loads(line)
+            if message.get("id") != id:  # Rest of an abandoned response.
+                continue
+            if "error" in message:
+                raise ServerError(message["error"])
+            if message.get("done"):
+                return
+            yield from message["items"]
+        raise ConnectionError("The server closed the connection.")
+
+    def query(self, anthology=None, poem=None, serial=None):
+        for row in self._request(
+            "query", anthology=_anthology(anthology), poem=poem, serial=serial
+        ):
+            yield _record_from_tuple(row)
+
+    def poem(self, anthology, poem):
+        return [
+            _record_from_tuple(row)
+            for row in self._request("poem", anthology=_anthology(anthology), poem=poem)
+        ]
+
+    def tokens(self, mode="default", anthology=None, poem=None, serial=None):
+        for values in self._request(
+            "tokens",
+            mode=mode,
+            anthology=_anthology(anthology),
+            poem=poem,
+            serial=serial,
+        ):
+            yield _token_from_tuple(values)
+
+    def text(
+        self,
+        delimiter=" ",
+        anthology=None,
+        poem=None,
+        serial=None,
+        embed_metadata=False,
+    ):
+        return "\n".join(
+            self._request(
+                "text",
+                delimiter=delimiter,
+                anthology=_anthology(anthology),
+                poem=poem,
+                serial=serial,
+                embed_metadata=embed_metadata,
+            )
+        )
+
+    def concordance(
+        self, value, field="lemma", width=5, mode="default", anthology=None
+    ):
+        return [
+            ConcordanceLine(
+                Anthology(a),
+                poem,
+                serial,
+                record,
+                decomposition,
+                position,
+                [_token_from_tuple(values) for values in left],
+                _token_from_tuple(token),
+                [_token_from_tuple(values) for values in right],
+            )
+            for (
+                a,
+                poem,
+                serial,
+                record,
+                decomposition,
+                position,
+                left,
+                token,
+                right,
+            ) in self._request(
+                "concordance",
+                value=value,
+                field=field,
+                width=width,
+                mode=mode,
+                anthology=_anthology(anthology),
+            )
+        ]
+
+    def frequencies(
+        self, feature="surface", mode="default", anthology=None, level="division"
+    ):
+        pairs = list(
+            self._request(
+                "frequencies",
+                feature=feature,
+                mode=mode,
+                anthology=_anthology(anthology),
+                level=level,
+            )
+        )
+        return FrequencyTable(
+            np.array([count for _, count in pairs], dtype=np.int64),
+            [_label(label) for label, _ in pairs],
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("database", nargs="?", default="hachidai.db")
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket", help="Unix socket path to listen on")
+    address.add_argument("--port", type=int, help="localhost TCP port to listen on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--cache", action="store_true", help="use a snapshot cache")
+    parser.add_argument("--backend", choices=("objects", "columnar"), default="objects")
+    args = parser.parse_args(argv)
+
+    db = HachidaishuDB(args.database, cache=args.cache or None, backend=args.backend)
+    server = QueryServer(db)
+    try:
+        asyncio.run(server.serve_forever(args.socket or (args.host, args.port)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
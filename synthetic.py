@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""Generate synthetic databases in hachidai.db format for scale testing.
+
+Poems are assembled from the records of a real database: their lengths and
+the rows of each record (all rows sharing a serial) are sampled from it, so
+the token distribution follows the source. To exercise every path of the
+retokenization, some records are rewritten into the shapes HachidaishuDB
+handles specially:
+
+- multi-sense rows (A00 followed by A10, A20, ...),
+- B00 compounds with their C00, C01, ... breakdown,
+- alternative readings sharing a serial (an A00 row followed by a B00/C
+  group),
+- ＊/イ variant markers, with both the three-marker (＊ originals イN
+  variants ＊) and the two-marker (＊ originals イN variants) patterns,
+- 〈〉 markup around surfaces.
+
+For example, to write a corpus ten times the size of hachidai.db:
+
+    python synthetic.py --scale 10 hachidai-x10.db"""
+
+import argparse
+import random
+import sys
+from collections import Counter
+from dataclasses import dataclass
+
+from hachidaishu import Anthology, open_db
+
+# Markers are ordinary rows whose surface starts with ＊ or イ.
+MARKER_ROW = "A00 CH-JP-0000-00-0000 77 {surface} {lemma} {lemma} {lemma} {lemma}"
+FULLWIDTH_DIGITS = str.maketrans("0123456789", "０１２３４５６７８９")
+
+MAX_POEM = 999999
+MAX_SERIAL = 9999
+
+
+def _fields(row):
+    # TYPE BG_ID CHASEN_ID surface lemma lemma_reading kanji kanji_reading
+    return row.split(" ")
+
+
+def _retype(row, token_type):
+    return f"{token_type} {row.split(' ', 1)[1]}"
+
+
+@dataclass
+class CorpusModel:
+    """The distributions sampled from a source database."""
+
+    records: list  # distinct records, each a tuple of "TYPE rest-of-row" rows
+    record_weights: list
+    lengths: list  # distinct numbers of records per poem
+    length_weights: list
+    poems: int  # number of poems in the source
+    variant_rate: float  # fraction of poems with variant markers
+
+    @classmethod
+    def from_db(cls, filename="hachidai.db"):
+        records = Counter()
+        lengths = Counter()
+        variant_poems = set()
+        # Rows by (poem, serial) key, in order; markers are left out, as they
+        # are placed separately.
+        keyed = {}
+        with open_db(filename) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                id, row = line.rstrip().split(" ", 1)
+                poem, serial = id.rsplit(":", 1)
+                if _fields(row)[3].startswith(("＊", "イ")):
+                    variant_poems.add(poem)
+                else:
+                    keyed.setdefault((poem, serial), []).append(row)
+        for (poem, _), rows in keyed.items():
+            records[tuple(rows)] += 1
+            lengths[poem] += 1
+        lengths = Counter(lengths.values())
+        if not records:
+            raise ValueError(f"{filename} contains no records.")
+        poems = sum(lengths.values())
+        return cls(
+            list(records),
+            list(records.values()),
+            list(lengths),
+            list(lengths.values()),
+            poems,
+            len(variant_poems) / poems,
+        )
+
+
+class Generator:
+    """Samples synthetic poems from a CorpusModel.
+
+    `sense_rate`, `compound_rate`, `alternative_rate` and `markup_rate` are
+    the probabilities of rewriting a sampled single-row record into the
+    corresponding shape; `variant_rate` is the fraction of poems with variant
+    markers, by default that of the source (or 5% if it has none), of which
+    `two_marker_rate` use the two-marker pattern."""
+
+    def __init__(
+        self,
+        model,
+        seed=None,
+        sense_rate=0.05,
+        compound_rate=0.03,
+        alternative_rate=0.01,
+        markup_rate=0.005,
+        variant_rate=None,
+        two_marker_rate=0.2,
+    ):
+        self.model = model
+        self.random = random.Random(seed)
+        self.sense_rate = sense_rate
+        self.compound_rate = compound_rate
+        self.alternative_rate = alternative_rate
+        self.markup_rate = markup_rate
+        if variant_rate is None:
+            variant_rate = model.variant_rate or 0.05
+        self.variant_rate = variant_rate
+        self.two_marker_rate = two_marker_rate
+        # Plain single-token records to build the rewritten shapes from.
+        self.singles = [
+            rows[0] for rows in model.records if len(rows) == 1 and rows[0][0] == "A"
+        ] or [rows[0] for rows in model.records]
+
+    def record(self):
+        """Return the rows (without ids) of one sampled record."""
+        rows = self.random.choices(self.model.records, self.model.record_weights)[0]
+        if len(rows) > 1 or rows[0][0] != "A":
+            return list(rows)
+        p = self.random.random()
+        if p < self.sense_rate:
+            senses = self.random.randint(1, 2)
+            return [rows[0]] + [
+                _retype(rows[0], f"A{k}0") for k in range(1, senses + 1)
+            ]
+        p -= self.sense_rate
+        if p < self.compound_rate:
+            return self.compound()
+        p -= self.compound_rate
+        if p < self.alternative_rate:
+            return [rows[0]] + self.compound()
+        p -= self.alternative_rate
+        if p < self.markup_rate:
+            fields = _fields(rows[0])
+            fields[3] = f"〈{fields[3]}〉"
+            return [" ".join(fields)]
+        return list(rows)
+
+    def compound(self):
+        """Return a B00 compound of two or three sampled tokens followed by
+        its C00, C01, ... breakdown."""
+        parts = [
+            _fields(self.random.choice(self.singles))
+            for _ in range(self.random.randint(2, 3))
+        ]
+        head = list(parts[-1])
+        head[0] = "B00"
+        for k in (3, 4, 5, 6, 7):
+            head[k] = "".join(part[k] for part in parts)
+        return [" ".join(head)] + [
+            " ".join([f"C{k:02d}"] + part[1:]) for k, part in enumerate(parts)
+        ]
+
+    def poem(self):
+        """Return the records of one poem, each a list of rows without ids."""
+        length = self.random.choices(self.model.lengths, self.model.length_weights)[0]
+        records = [self.record() for _ in range(max(length, 1))]
+        if self.random.random() < self.variant_rate:
+            records = self.add_variants(records)
+        return records[:MAX_SERIAL]
+
+    def add_variants(self, records):
+        """Mark up to three records of `records` as having variants: ＊, the
+        original records, イN, N variant records and, unless the two-marker
+        pattern is chosen, a closing ＊."""
+        count = self.random.randint(1, min(3, len(records)))
+        start = self.random.randint(0, len(records) - count)
+        variants = [self.record() for _ in range(count)]
+        marked = (
+            [[MARKER_ROW.format(surface="＊", lemma="＊")]]
+            + records[start : start + count]
+            + [
+                [
+                    MARKER_ROW.format(
+                        surface="イ" + str(count).translate(FULLWIDTH_DIGITS),
+                        lemma="イ",
+                    )
+                ]
+            ]
+            + variants
+        )
+        if self.random.random() >= self.two_marker_rate:
+            marked.append([MARKER_ROW.format(surface="＊", lemma="＊")])
+        return records[:start] + marked + records[start + count :]
+
+    def lines(self, poems):
+        """Yield the database lines of `poems` poems, spread evenly over the
+        anthologies."""
+        anthologies = len(Anthology)
+        per_anthology = -(-poems // anthologies)
+        if per_anthology > MAX_POEM:
+            raise ValueError(
+                f"At most {MAX_POEM * anthologies} poems can be generated."
+            )
+        for k in range(poems):
+            anthology, poem = k // per_anthology + 1, k % per_anthology + 1
+            for serial, rows in enumerate(self.poem(), 1):
+                for row in rows:
+                    yield f"{anthology:02d}:{poem:06d}:{serial:04d} {row} \n"
+
+
+def generate(filename, source="hachidai.db", scale=1.0, poems=None, seed=None, **rates):
+    """Write a synthetic database of `poems` poems (by default `scale` times
+    the number of poems in `source`) to `filename`, sampled from `source`.
+    `rates` are passed on to Generator. Returns the number of lines written."""
+    model = CorpusModel.from_db(source)
+    generator = Generator(model, seed, **rates)
+    if poems is None:
+        poems = max(1, round(model.poems * scale))
+    count = 0
+    with open(filename, "w", encoding="utf-8") as f:
+        for line in generator.lines(poems):
+            f.write(line)
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output")
+    parser.add_argument(
+        "--source", default="hachidai.db", help="database to sample from"
+    )
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument(
+        "--scale", type=float, default=1.0, help="size relative to the source"
+    )
+    size.add_argument("--poems", type=int, help="number of poems")
+    parser.add_argument("--seed", type=int)
+    for rate in ("sense", "compound", "alternative", "markup", "variant", "two_marker"):
+        parser.add_argument(f"--{rate.replace('_', '-')}-rate", type=float)
+    args = parser.parse_args(argv)
+
+    rates = {
+        name: value
+        for name, value in vars(args).items()
+        if name.endswith("_rate") and value is not None
+    }
+    count = generate(
+        args.output, args.source, args.scale, args.poems, args.seed, **rates
+    )
+    print(f"Wrote {count} lines to {args.output}.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Fixtures shared by the tests: a small synthetic database sampled with
+synthetic.py from Kokinshu 1 (as listed in README.md) and a few other
+records, which exercises every row shape HachidaishuDB handles."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from hachidaishu import HachidaishuDB  # noqa: E402
+
+SOURCE = """\
+01:000001:0001 A00 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+01:000001:0001 A10 BG-01-1911-03-1800 02 年 年 とし 年 とし 
+01:000001:0002 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000001:0003 A00 BG-01-1770-01-0300 02 内 内 うち 内 うち 
+01:000001:0004 A00 BG-08-0061-05-0100 61 に に に に に 
+01:000001:0005 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+01:000001:0006 A00 BG-08-0065-07-0100 65 は は は は は 
+01:000001:0007 A00 BG-02-1527-01-0102 47 き 来 く 来 き 
+01:000001:0008 A00 BG-03-1200-02-0900 74 に ぬ ぬ に に 
+01:000001:0008 A10 BG-09-0010-01-0101 74 に ぬ ぬ に に 
+01:000001:0008 A20 BG-09-0010-03-0200 74 に ぬ ぬ に に 
+01:000001:0009 A00 BG-09-0010-04-0300 74 けり けり けり けり けり 
+01:000001:0010 B00 BG-01-1950-14-0100 02 一とせ 一年 ひととせ 一年 ひととせ 
+01:000001:0010 C00 BG-01-1950-01-0300 19 一 一 いち 一 いち 
+01:000001:0010 C01 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+01:000001:0011 A00 BG-08-0061-10-0100 61 を を を を を 
+01:000001:0012 A00 BG-01-1642-02-0100 02 こそ 去年 こぞ 去年 こぞ 
+01:000001:0013 A00 BG-08-0061-04-0100 61 と と と と と 
+01:000001:0014 A00 BG-08-0065-14-0100 65 や や や や や 
+01:000001:0015 A00 BG-02-3120-01-0100 47 いは 言ふ いふ 言は いは 
+01:000001:0016 A00 BG-03-3012-03-2600 74 ん む む む む 
+01:000001:0016 A10 BG-09-0010-02-0102 74 ん む む む む 
+01:000001:0017 B00 BG-01-1641-02-0100 02 ことし 今年 ことし 今年 ことし 
+01:000001:0017 C00 BG-03-1000-01-0100 57 この この この この この 
+01:000001:0017 C01 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+01:000001:0018 A00 BG-08-0061-04-0100 61 と と と と と 
+01:000001:0019 A00 BG-08-0065-14-0100 65 や や や や や 
+01:000001:0020 A00 BG-02-3120-01-0100 47 いは 言ふ いふ 言は いは 
+01:000001:0021 A00 BG-03-3012-03-2600 74 ん む む む む 
+01:000001:0021 A10 BG-09-0010-02-0102 74 ん む む む む 
+01:000002:0001 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+01:000002:0002 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000002:0003 A00 BG-01-2000-01-0100 14 わが 我 われ 我 わ 
+01:000002:0003 A10 BG-01-2000-01-0200 14 わが 我 われ 我 わ 
+01:000002:0004 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+01:000002:0005 A00 BG-02-3390-01-0100 47 ちる 散る ちる 散る ちる 
+01:000002:0006 B00 BG-02-3050-01-0100 17 恋し 恋す こひす 恋し こひし 
+01:000002:0006 C00 BG-02-3050-01-0100 17 恋 恋 こひ 恋 こひ 
+01:000002:0006 C01 BG-02-3050-01-0100 48 し す す し し 
+01:000002:0007 A00 BG-08-0066-01-0100 66 ばかり ばかり ばかり ばかり ばかり 
+"""
+
+
+@pytest.fixture(scope="session")
+def database(tmp_path_factory):
+    """Path of a database of 240 synthetic poems spread over the anthologies."""
+    directory = tmp_path_factory.mktemp("hachidai")
+    source = directory / "source.db"
+    source.write_text(SOURCE, encoding="utf-8")
+    filename = directory / "hachidai.db"
+    synthetic.generate(filename, source, poems=240, seed=0, variant_rate=0.3)
+    return filename
+
+
+@pytest.fixture(scope="session")
+def db(database):
+    """The database loaded once for the whole session; tests must not modify it."""
+    return HachidaishuDB(database)
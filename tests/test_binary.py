@@ -0,0 +1,38 @@
+import pytest
+
+from hachidaishu import ColumnarStore, HachidaishuDB, _record_to_tuple, _token_values
+
+
+def _rows(records):
+    return [_record_to_tuple(record) for record in records]
+
+
+def test_columnar_store_matches_objects(db):
+    store = ColumnarStore.from_records(db.db)
+    assert len(store) == len(db.db)
+    assert _rows(store) == _rows(db)
+
+
+def test_binary_round_trip(db, tmp_path):
+    filename = tmp_path / "hachidai.corpus"
+    db.save_binary(filename)
+    opened = HachidaishuDB.open_binary(filename)
+    assert isinstance(opened.db, ColumnarStore)
+    assert _rows(opened) == _rows(db)
+    assert opened.text(embed_metadata=True) == db.text(embed_metadata=True)
+    for mode in ("default", "decomposition"):
+        assert list(map(_token_values, opened.tokens(mode))) == list(
+            map(_token_values, db.tokens(mode))
+        )
+    assert _rows(opened.query(4, 2)) == _rows(db.query(4, 2))
+    assert (
+        opened.frequencies("lemma").most_common()
+        == db.frequencies("lemma").most_common()
+    )
+    with pytest.raises(ValueError):
+        opened.update([])
+
+
+def test_open_rejects_other_files(database):
+    with pytest.raises(ValueError):
+        ColumnarStore.open(database)
@@ -0,0 +1,199 @@
+import csv
+import io
+import json
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+import pytest
+
+from hachidaishu import TOKEN_FIELDS, Anthology, _token_values, main
+
+
+@pytest.fixture
+def run(database, capsys):
+    """Run the command line with `args` on the test database, returning the
+    exit status and output."""
+
+    def run(*args, database=database):
+        status = main([args[0], str(database), *args[1:]])
+        out, err = capsys.readouterr()
+        return status, out, err
+
+    return run
+
+
+@pytest.mark.parametrize("anthology", ["3", "shuishu", "SHUISHU"])
+def test_anthology(db, run, anthology):
+    assert run("text", "--anthology", anthology) == (
+        0,
+        db.text(anthology=3) + "\n",
+        "",
+    )
+
+
+@pytest.mark.parametrize("anthology", ["0", "9", "Manyoshu", ""])
+def test_bad_anthology(run, capsys, anthology):
+    with pytest.raises(SystemExit) as exit:
+        run("text", "--anthology", anthology)
+    assert exit.value.code == 2
+    assert "expected a number from 1 to 8" in capsys.readouterr().err
+
+
+def test_text(db, run):
+    assert run("text")[1] == db.text() + "\n"
+    assert run("text", "--poem", "2", "--delimiter", "/", "--metadata")[1] == (
+        db.text("/", poem=2, embed_metadata=True) + "\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "options", [["--workers", "2"], ["--cache", "{tmp}/snapshot"], ["--lazy"]]
+)
+def test_loading(db, run, tmp_path, options):
+    options = [option.format(tmp=tmp_path) for option in options]
+    assert run("text", "--anthology", "2", *options)[1] == db.text(anthology=2) + "\n"
+
+
+def test_stdin(db, run, database, monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO(database.read_text(encoding="utf-8")))
+    assert run("text", "--poem", "3", database="-")[1] == db.text(poem=3) + "\n"
+
+
+def test_output_file(db, run, tmp_path):
+    output = tmp_path / "text.txt"
+    assert run("text", "-o", str(output)) == (0, "", "")
+    assert output.read_text(encoding="utf-8") == db.text() + "\n"
+
+
+def test_stats(db, run):
+    status, out, _ = run("stats")
+    assert status == 0
+    rows = [line.split("\t") for line in out.splitlines()]
+    assert rows[0] == ["anthology", "poems", "records", "tokens", "characters"]
+    assert [row[0] for row in rows[1:]] == [
+        a.name for a in dict.fromkeys(r.anthology for r in db)
+    ] + ["total"]
+    poems = {(r.anthology, r.poem) for r in db}
+    records = list(db)
+    assert rows[-1][1:] == [
+        str(len(poems)),
+        str(len(records)),
+        str(sum(1 for _ in db.tokens(mode="decomposition"))),
+        str(sum(len(r.token().surface) for r in records)),
+    ]
+    assert [sum(int(row[k]) for row in rows[1:-1]) for k in range(1, 5)] == [
+        int(n) for n in rows[-1][1:]
+    ]
+
+
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_stats_top(db, run, mode):
+    status, out, _ = run(
+        "stats", "--anthology", "1", "--top", "5", "--feature", "lemma", "--mode", mode
+    )
+    counts = Counter(token.lemma for token in db.tokens(mode=mode, anthology=1))
+    assert status == 0
+    lines = [line.split("\t") for line in out.splitlines()]
+    assert len(lines) == 5
+    assert all(counts[lemma] == int(n) for lemma, n in lines)
+    assert [int(n) for _, n in lines] == [n for _, n in counts.most_common(5)]
+
+
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_tokens(db, run, mode):
+    status, out, _ = run(
+        "tokens",
+        "--poem",
+        "4",
+        "--fields",
+        "surface,ud_pos",
+        "--header",
+        "--mode",
+        mode,
+    )
+    assert status == 0
+    lines = out.splitlines()
+    assert lines[0] == "anthology\tpoem\tserial\tsurface\tud_pos"
+    expected = [
+        f"{record.anthology.name}\t4\t{record.serial}\t{token.surface}\t"
+        f"{token.ud_pos or ''}"
+        for record in db.query(poem=4)
+        for token in (
+            [record.token()]
+            if mode == "default"
+            else [t for d in record.segments for t in d.tokens]
+        )
+    ]
+    assert lines[1:] == expected
+
+
+def test_unknown_fields(run, capsys):
+    with pytest.raises(SystemExit) as exit:
+        run("tokens", "--fields", "surface,colour")
+    assert exit.value.code == 1
+    assert "Unknown token fields: colour" in capsys.readouterr().err
+
+
+def test_missing_database(run, capsys, tmp_path):
+    with pytest.raises(SystemExit) as exit:
+        run("text", database=tmp_path / "missing.db")
+    assert exit.value.code == 1
+    assert "missing.db" in capsys.readouterr().err
+
+
+def test_validate(db, run):
+    status, out, err = run("validate")
+    assert (status, out) == (0, "")
+    assert err.startswith(f"Validated {len(list(db))} records")
+    # Every poem is shorter than 1000 tokens.
+    status, out, err = run(
+        "validate", "--anthology", "Kokinshu", "--min-tokens", "1000"
+    )
+    poems = list(dict.fromkeys(r.poem for r in db.query(Anthology.Kokinshu)))
+    assert status == 1
+    assert [line.split("\t")[0] for line in out.splitlines()] == [
+        f"Kokinshu:{poem}" for poem in poems
+    ]
+    assert err.endswith(f"{len(poems)} problems.\n")
+
+
+@pytest.mark.parametrize("decompositions", [False, True])
+def test_export_jsonl(db, run, decompositions):
+    options = ["--decompositions"] if decompositions else []
+    status, out, _ = run("export", "--anthology", "5", *options)
+    records = list(db.query(5))
+    assert status == 0
+    lines = [json.loads(line) for line in out.splitlines()]
+    assert len(lines) == len(records)
+    for line, record in zip(lines, records):
+        segments = line.pop("decompositions", None)
+        assert line == record.to_json()
+        if decompositions:
+            assert [
+                [tuple(token[k] for k in TOKEN_FIELDS) for token in s["tokens"]]
+                for s in segments
+            ] == [[_token_values(t) for t in d.tokens] for d in record.segments]
+        else:
+            assert segments is None
+
+
+def test_export_csv(db, run):
+    status, out, _ = run("export", "--format", "csv", "--poem", "6")
+    rows = list(csv.reader(io.StringIO(out)))
+    assert status == 0
+    assert rows[0] == ["anthology", "poem", "serial", *TOKEN_FIELDS]
+    assert rows[1:] == [
+        [record.anthology.name, "6", str(record.serial)]
+        + ["" if v is None else v for v in _token_values(record.token())]
+        for record in db.query(poem=6)
+    ]
+
+
+def test_export_tei(db, run):
+    status, out, _ = run("export", "--format", "tei", "--date", "2024-01-02")
+    root = ET.fromstring(out)
+    ns = {"tei": "http://www.tei-c.org/ns/1.0"}
+    assert status == 0
+    assert root.find(".//tei:publicationStmt/tei:date", ns).get("when") == "2024-01-02"
+    poems = {(r.anthology, r.poem) for r in db}
+    assert len(root.findall(".//tei:lg", ns)) == len(poems)
@@ -0,0 +1,88 @@
+import sys
+from collections import Counter
+
+import pytest
+
+from hachidaishu import HachidaishuDB, build_document_term_matrix, np
+
+pytest.importorskip("scipy")
+
+
+def _column_sums(matrix):
+    sums = np.asarray(matrix.matrix.sum(axis=0)).ravel()
+    return dict(zip(matrix.columns, sums.tolist()))
+
+
+@pytest.mark.parametrize(
+    "feature", ["lemma", "surface", "bg_category", ("lemma", "ud_pos")]
+)
+def test_column_sums_match_frequencies(db, feature):
+    matrix = db.document_term_matrix(feature)
+    assert matrix.matrix.dtype == np.int64
+    assert matrix.matrix.shape == (len(matrix.rows), len(matrix.columns))
+    assert _column_sums(matrix) == dict(db.frequencies(feature).most_common())
+    assert matrix.rows == list(dict.fromkeys((r.anthology, r.poem) for r in db))
+
+
+def test_rows_match_tokens(db):
+    matrix = db.document_term_matrix("lemma", ud_pos=("NOUN", "VERB"))
+    for i, (anthology, poem) in enumerate(matrix.rows[:40]):
+        row = matrix.matrix.getrow(i)
+        expected = Counter(
+            token.lemma
+            for token in db.tokens(anthology=anthology, poem=poem)
+            if token.ud_pos in ("NOUN", "VERB")
+        )
+        assert {matrix.columns[j]: n for j, n in zip(row.indices, row.data)} == expected
+
+
+def test_anthology_rows_match_crosstab(db):
+    matrix = db.document_term_matrix("lemma", rows="anthology")
+    table = db.crosstab("lemma")
+    assert matrix.rows == table.rows
+    order = [matrix.columns.index(column) for column in table.columns]
+    assert (matrix.matrix.toarray()[:, order] == table.counts).all()
+
+
+def test_decomposition_weights(db):
+    matrix = db.document_term_matrix("lemma", mode="decomposition")
+    # Each record adds the tokens of every decomposition, weighted by one
+    # over the number of decompositions.
+    rows, columns = Counter(), Counter()
+    for record in db:
+        weight = 1 / len(record.segments)
+        for decomposition in record.segments:
+            for token in decomposition.tokens:
+                rows[record.anthology, record.poem] += weight
+                columns[token.lemma] += weight
+    row_sums = np.asarray(matrix.matrix.sum(axis=1)).ravel()
+    assert np.allclose(row_sums, [rows[row] for row in matrix.rows])
+    column_sums = _column_sums(matrix)
+    assert column_sums.keys() == columns.keys()
+    assert all(np.isclose(column_sums[key], columns[key]) for key in columns)
+    frequencies = db.frequencies("lemma", mode="decomposition").most_common()
+    assert set(column_sums) == {label for label, _ in frequencies}
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {},
+        {"feature": "bg_category", "level": "item"},
+        {"mode": "decomposition", "ud_pos": "NOUN"},
+        {"rows": "anthology", "mode": "decomposition"},
+    ],
+)
+def test_stream_matches_loaded(db, database, params):
+    loaded = db.document_term_matrix(**params)
+    streamed = build_document_term_matrix(HachidaishuDB.stream(database), **params)
+    assert streamed.rows == loaded.rows
+    assert streamed.columns == loaded.columns
+    assert streamed.matrix.dtype == loaded.matrix.dtype
+    assert abs(streamed.matrix - loaded.matrix).max() < 1e-9
+
+
+def test_missing_scipy(db, monkeypatch):
+    monkeypatch.setitem(sys.modules, "scipy.sparse", None)
+    with pytest.raises(ImportError, match="document_term_matrix"):
+        db.document_term_matrix()
@@ -0,0 +1,92 @@
+import pytest
+
+from hachidaishu import Anthology, HachidaishuDB, InvertedIndex
+
+
+def _scan(db, field, value, mode="default", anthology=None):
+    """The occurrences of `value` in `field`, by a linear scan."""
+    return [
+        (r, d, p)
+        for r, record in enumerate(db.db)
+        if anthology is None or record.anthology == anthology
+        for d, decomposition in enumerate(record.segments)
+        for p, token in enumerate(decomposition.tokens)
+        if getattr(token, field) == value and (mode == "decomposition" or d == p == 0)
+    ]
+
+
+def _values(db, field, n=15):
+    """The `n` most and least frequent values of `field`."""
+    counts = {}
+    for record in db:
+        for decomposition in record.segments:
+            for token in decomposition.tokens:
+                counts[getattr(token, field)] = counts.get(getattr(token, field), 0) + 1
+    ranked = sorted(counts, key=lambda v: (-counts[v], v))
+    return ranked[:n] + ranked[-n:]
+
+
+@pytest.mark.parametrize("field", InvertedIndex.FIELDS)
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_occurrences(db, field, mode):
+    for value in _values(db, field):
+        assert db.occurrences(value, field, mode) == _scan(db, field, value, mode)
+    assert db.occurrences("not a value", field, mode) == []
+
+
+def test_columnar(db, database):
+    objects = db.inverted_index()
+    columns = HachidaishuDB(database, backend="columnar").inverted_index()
+    for field in InvertedIndex.FIELDS:
+        assert columns.postings[field] == objects.postings[field]
+    assert columns.token_record == objects.token_record
+    assert columns.token_decomposition == objects.token_decomposition
+    assert columns.token_position == objects.token_position
+
+
+@pytest.mark.parametrize("anthology", list(Anthology))
+def test_anthology(db, anthology):
+    for value in _values(db, "lemma", 5):
+        assert db.occurrences(value, anthology=anthology) == _scan(
+            db, "lemma", value, anthology=anthology
+        )
+
+
+def _context(db, r, width):
+    """The canonical tokens of up to `width` records before and after record
+    `r` in its poem, walking outwards from it."""
+    records = db.db
+    key = (records[r].anthology, records[r].poem)
+
+    def walk(step):
+        tokens, i = [], r + step
+        while (
+            len(tokens) < width
+            and 0 <= i < len(records)
+            and (records[i].anthology, records[i].poem) == key
+        ):
+            tokens.append(records[i].token())
+            i += step
+        return tokens
+
+    return walk(-1)[::-1], walk(1)
+
+
+@pytest.mark.parametrize("width", [0, 1, 3, 50])
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_concordance(db, width, mode):
+    for value in _values(db, "lemma", 5):
+        lines = db.concordance(value, width=width, mode=mode)
+        hits = _scan(db, "lemma", value, mode)
+        assert [
+            (line.record, line.decomposition, line.position) for line in lines
+        ] == hits
+        for line, (r, d, p) in zip(lines, hits):
+            record = db.db[r]
+            assert (line.anthology, line.poem, line.serial) == (
+                record.anthology,
+                record.poem,
+                record.serial,
+            )
+            assert line.token == record.segments[d].tokens[p]
+            assert (line.left, line.right) == _context(db, r, width)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+from itertools import groupby
+
+import pytest
+
+from hachidaishu import TOKEN_FIELDS, HachidaishuDB, _token_values
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _check_lines(db, lines, decompositions):
+    records = list(db)
+    assert len(lines) == len(records)
+    for line, record in zip(lines, records):
+        values = json.loads(line)
+        segments = values.pop("decompositions", None)
+        assert values == record.to_json()
+        if decompositions:
+            assert [
+                (s["decomposition_type"], [tuple(t.values()) for t in s["tokens"]])
+                for s in segments
+            ] == [
+                (d.decomposition_type, [_token_values(t) for t in d.tokens])
+                for d in record.segments
+            ]
+            assert all(
+                list(t) == list(TOKEN_FIELDS) for s in segments for t in s["tokens"]
+            )
+        else:
+            assert segments is None
+
+
+@pytest.mark.parametrize("decompositions", [False, True])
+def test_merged(db, tmp_path, decompositions):
+    filename = tmp_path / "hachidaishu.jsonl"
+    manifest = db.write_jsonl(filename, decompositions=decompositions)
+    data = filename.read_bytes()
+    _check_lines(db, data.decode("utf-8").splitlines(), decompositions)
+    assert sorted(os.listdir(tmp_path)) == [
+        "hachidaishu.jsonl",
+        "hachidaishu.jsonl.manifest.json",
+    ]
+    with open(f"{filename}.manifest.json", encoding="utf-8") as f:
+        assert json.load(f) == manifest
+    assert manifest["decompositions"] == decompositions
+    assert (manifest["records"], manifest["bytes"]) == (len(list(db)), len(data))
+    assert manifest["sha256"] == _sha256(data)
+    # One shard per anthology, in order and back to back.
+    anthologies = [
+        (anthology, list(records))
+        for anthology, records in groupby(db, key=lambda r: r.anthology)
+    ]
+    assert len(manifest["shards"]) == len(anthologies)
+    offset = 0
+    for shard, (anthology, records) in zip(manifest["shards"], anthologies):
+        assert shard["records"] == len(records)
+        assert shard["first"] == {"anthology": anthology.name, "poem": records[0].poem}
+        assert shard["last"] == {"anthology": anthology.name, "poem": records[-1].poem}
+        assert shard["offset"] == offset
+        chunk = data[offset : offset + shard["bytes"]]
+        assert chunk.count(b"\n") == len(records)
+        assert shard["sha256"] == _sha256(chunk)
+        offset += shard["bytes"]
+    assert offset == len(data)
+    assert HachidaishuDB.verify_jsonl(f"{filename}.manifest.json") == []
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_shards(db, tmp_path, workers):
+    filename = tmp_path / "hachidaishu.jsonl"
+    manifest = db.write_jsonl(filename, shard_poems=7, workers=workers, merge=False)
+    assert not filename.exists()
+    poems = list(dict.fromkeys((r.anthology, r.poem) for r in db))
+    assert len(manifest["shards"]) == -(-len(poems) // 7)
+    lines = []
+    for k, shard in enumerate(manifest["shards"]):
+        assert shard["file"] == f"hachidaishu-{k:05d}.jsonl"
+        data = (tmp_path / shard["file"]).read_bytes()
+        assert (shard["bytes"], shard["sha256"]) == (len(data), _sha256(data))
+        shard_lines = data.decode("utf-8").splitlines()
+        assert shard["records"] == len(shard_lines)
+        first, last = poems[7 * k], poems[min(7 * k + 6, len(poems) - 1)]
+        assert shard["first"] == {"anthology": first[0].name, "poem": first[1]}
+        assert shard["last"] == {"anthology": last[0].name, "poem": last[1]}
+        lines += shard_lines
+    _check_lines(db, lines, False)
+    assert HachidaishuDB.verify_jsonl(f"{filename}.manifest.json") == []
+
+
+def _tamper(path, offset):
+    data = bytearray(path.read_bytes())
+    data[offset] ^= 1
+    path.write_bytes(bytes(data))
+
+
+def test_verify_merged(db, tmp_path):
+    filename = tmp_path / "hachidaishu.jsonl"
+    manifest = db.write_jsonl(filename)
+    shard = manifest["shards"][2]
+    _tamper(filename, shard["offset"] + shard["bytes"] // 2)
+    assert HachidaishuDB.verify_jsonl(f"{filename}.manifest.json") == [shard]
+
+
+def test_verify_shards(db, tmp_path):
+    filename = tmp_path / "hachidaishu.jsonl"
+    manifest = db.write_jsonl(filename, merge=False)
+    tampered, missing = manifest["shards"][1], manifest["shards"][3]
+    _tamper(tmp_path / tampered["file"], 10)
+    os.remove(tmp_path / missing["file"])
+    assert HachidaishuDB.verify_jsonl(f"{filename}.manifest.json") == [
+        tampered,
+        missing,
+    ]
@@ -0,0 +1,53 @@
+from conftest import SOURCE
+from hachidaishu import HachidaishuDB, LazyToken, _record_to_tuple
+
+
+def _tokens(db):
+    for record in db:
+        for decomposition in record.segments:
+            yield from decomposition.tokens
+
+
+def test_lazy_load_matches_eager(db, database):
+    lazy = HachidaishuDB(database, lazy=True)
+    assert all(isinstance(token, LazyToken) for token in _tokens(lazy))
+    # Loading, including the merging of variants, leaves the readings unsplit.
+    assert all("_readings" in token.__dict__ for token in _tokens(lazy))
+    assert list(map(_record_to_tuple, lazy)) == list(map(_record_to_tuple, db))
+    assert list(lazy) == list(db)
+
+
+def test_stream_lazy_matches_eager(db, database):
+    records = list(HachidaishuDB.stream(database, lazy=True))
+    assert list(map(_record_to_tuple, records)) == list(map(_record_to_tuple, db))
+
+
+def test_deferred_until_accessed(database):
+    lazy = HachidaishuDB(database, lazy=True)
+    tokens = list(_tokens(lazy))
+    # POS attributes are never stored, readings only once one is accessed.
+    deferred = ("ipa_pos", "ipa_en_pos", "unidic_pos", "lemma_reading", "kanji")
+    assert not any(name in token.__dict__ for token in tokens for name in deferred)
+    token = tokens[0]
+    readings = token.__dict__["_readings"]
+    assert token.unidic_pos and "_readings" in token.__dict__
+    assert token.kanji == readings.split(" ")[1]
+    assert "_readings" not in token.__dict__
+    assert (
+        " ".join(
+            token.__dict__[name] for name in ("lemma_reading", "kanji", "kanji_reading")
+        )
+        == readings
+    )
+    assert all("_readings" in t.__dict__ for t in tokens[1:])
+
+
+def test_bracketed_surfaces(tmp_path):
+    filename = tmp_path / "brackets.db"
+    filename.write_text(
+        SOURCE.replace(" 一とせ ", " 〈一〉とせ ").replace(" 春 春 ", " 〈春〉 春 "),
+        encoding="utf-8",
+    )
+    eager, lazy = HachidaishuDB(filename), HachidaishuDB(filename, lazy=True)
+    assert [r.token().surface for r in lazy.query(1, 1)][4] == "春"
+    assert list(map(_record_to_tuple, lazy)) == list(map(_record_to_tuple, eager))
@@ -0,0 +1,74 @@
+import pytest
+
+import dictionaryconverter
+from dictionaryconverter import (
+    CHASEN_POS,
+    TAG_BIGRAM_MAP,
+    TAG_ORTH_MAP,
+    UNIDIC_TAGS,
+    chasenid2pos,
+    chasenid2pos_en,
+    ipadic2unidic,
+    mapping_digest,
+    unidic2ud_map,
+    unidic2ud_map_batch,
+)
+
+# Every known tag, plus unknown and missing ones.
+TAGS = [*UNIDIC_TAGS, "未定義", "", None]
+ORTHS = [orth for orth_map in TAG_ORTH_MAP.values() for orth in orth_map] + [""]
+
+
+def _outcome(mapper, *args):
+    try:
+        return mapper(*args)
+    except KeyError as e:
+        return KeyError, e.args
+
+
+@pytest.mark.parametrize("orth", ORTHS)
+def test_compiled_tables(orth):
+    # The compiled tables give the result of the rules for every combination
+    # of tags, one token at a time and in a single batch.
+    pairs = [(tag, next_tag) for tag in TAGS for next_tag in TAGS]
+    expected = [_outcome(unidic2ud_map, orth, tag, next_tag) for tag, next_tag in pairs]
+    assert [
+        _outcome(lambda *args: unidic2ud_map_batch(*args)[0], [orth], [tag], [next_tag])
+        for tag, next_tag in pairs
+    ] == expected
+    known = [
+        (pair, result) for pair, result in zip(pairs, expected) if result[0] != KeyError
+    ]
+    rules = []
+    assert unidic2ud_map_batch(
+        [orth] * len(known),
+        [tag for (tag, _), _ in known],
+        [next_tag for (_, next_tag), _ in known],
+        rules,
+    ) == [result for _, result in known]
+    assert rules == [
+        (
+            pair
+            if pair in TAG_BIGRAM_MAP and orth not in TAG_ORTH_MAP.get(pair[0], {})
+            else None
+        )
+        for pair, _ in known
+    ]
+
+
+def test_chasen_pos():
+    assert CHASEN_POS == {
+        chasen_id: (ipa_pos, chasenid2pos_en[chasen_id], ipadic2unidic[ipa_pos])
+        for chasen_id, ipa_pos in chasenid2pos.items()
+        if chasen_id in chasenid2pos_en and ipa_pos in ipadic2unidic
+    }
+
+
+def test_mapping_digest(monkeypatch):
+    digest = mapping_digest()
+    assert mapping_digest() == digest
+    tag, next_tag = next(iter(TAG_BIGRAM_MAP))
+    monkeypatch.setitem(
+        dictionaryconverter.TAG_BIGRAM_MAP, (tag, next_tag), ("X", None)
+    )
+    assert mapping_digest() != digest
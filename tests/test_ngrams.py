@@ -0,0 +1,106 @@
+import math
+from collections import Counter
+from itertools import groupby
+
+import numpy as np
+import pytest
+
+from hachidaishu import Anthology, NgramEngine
+
+
+def _poems(db, feature, anthology=None):
+    """The canonical token values of each poem."""
+    return [
+        [getattr(record.token(), feature) for record in records]
+        for (a, _), records in groupby(db, key=lambda r: (r.anthology, r.poem))
+        if anthology is None or a.value == anthology
+    ]
+
+
+def _ngrams(poems, n):
+    return [tuple(poem[k : k + n]) for poem in poems for k in range(len(poem) - n + 1)]
+
+
+def _scores(o11, r1, c1, n):
+    """PMI, G² and t-score from the 2x2 contingency table of an n-gram."""
+    e11 = r1 * c1 / n
+    cells = [
+        (o11, e11),
+        (r1 - o11, r1 * (n - c1) / n),
+        (c1 - o11, (n - r1) * c1 / n),
+        (n - r1 - c1 + o11, (n - r1) * (n - c1) / n),
+    ]
+    return {
+        "pmi": math.log2(o11 / e11),
+        "log_likelihood": 2 * sum(o * math.log(o / e) for o, e in cells if o > 0),
+        "t_score": (o11 - e11) / math.sqrt(o11),
+    }
+
+
+def _check(table, ngrams, min_count=1):
+    counts = Counter(ngrams)
+    prefixes = Counter(ngram[:-1] for ngram in ngrams)
+    lasts = Counter(ngram[-1] for ngram in ngrams)
+    expected = {ngram: n for ngram, n in counts.items() if n >= min_count}
+    assert dict(zip(table.labels, table.counts.tolist())) == expected
+    assert len(table.labels) == len(expected)
+    for i, ngram in enumerate(table.labels):
+        scores = _scores(
+            counts[ngram], prefixes[ngram[:-1]], lasts[ngram[-1]], len(ngrams)
+        )
+        for measure, score in scores.items():
+            assert table.scores[measure][i] == pytest.approx(score, abs=1e-9), measure
+
+
+@pytest.mark.parametrize("n", [2, 3, 4, 8])
+@pytest.mark.parametrize("feature", ["lemma", "surface", "ud_pos"])
+def test_counts_and_scores(db, n, feature):
+    _check(db.ngrams(n, feature), _ngrams(_poems(db, feature), n))
+
+
+@pytest.mark.parametrize("anthology", [1, 4])
+def test_anthology(db, anthology):
+    ngrams = _ngrams(_poems(db, "lemma", anthology), 3)
+    _check(db.ngrams(3, anthology=anthology), ngrams)
+    by_anthology = db.ngrams(3, by_anthology=True)[Anthology(anthology)]
+    assert by_anthology.labels == db.ngrams(3, anthology=anthology).labels
+
+
+def test_min_count(db):
+    _check(db.ngrams(2, min_count=3), _ngrams(_poems(db, "lemma"), 2), 3)
+
+
+def test_ranked(db):
+    table = db.ngrams(2)
+    ranked = table.ranked("pmi", 10)
+    assert [score for _, _, score in ranked] == sorted(
+        table.scores["pmi"], reverse=True
+    )[:10]
+    assert [count for _, count, _ in table.ranked()] == sorted(
+        table.counts, reverse=True
+    )
+
+
+def _engine(codes, poems, vocabulary):
+    """An NgramEngine over the given code sequence, bypassing the store."""
+    engine = NgramEngine.__new__(NgramEngine)
+    engine.feature = "lemma"
+    engine.vocabulary = vocabulary
+    engine.codes = np.array(codes, dtype=np.int64)
+    engine.anthology = np.ones(len(codes), dtype=np.int64)
+    engine.poem = np.array(poems, dtype=np.int64)
+    return engine
+
+
+@pytest.mark.parametrize("size", [1, 2, 255, 2**16, 2**20])
+@pytest.mark.parametrize("n", [2, 3, 4, 7, 8])
+def test_radix_boundaries(size, n):
+    # Codes at both ends of the vocabulary, so that the packed keys reach the
+    # limit of int64 and are compacted at different depths.
+    vocabulary = range(size)
+    rng = np.random.default_rng(size)
+    codes = rng.choice([0, size - 1, size // 2], 400).tolist()
+    poems = np.repeat(np.arange(40), 10).tolist()
+    engine = _engine(codes, poems, vocabulary)
+    poem_codes = [codes[k : k + 10] for k in range(0, 400, 10)]
+    _check(engine.table(n), _ngrams(poem_codes, n))
@@ -0,0 +1,51 @@
+import pytest
+
+from hachidaishu import HachidaishuDB, _record_to_tuple
+
+# One poem per anthology, all numbered 1, each starting with a 動詞-非自立可能
+# token and ending with a 副詞 one. As the poem numbers match, the last token
+# of a poem presets the UD POS of the next poem's first token (see
+# HachidaishuDB._map_records_ud()), so every shard seam takes the redo path.
+SEAM_POEM = """\
+{a:02d}:000001:0001 A00 BG-02-1500-01-0100 48 し す す し し 
+{a:02d}:000001:0002 A00 BG-08-0061-05-0100 61 に に に に に 
+{a:02d}:000001:0003 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+{a:02d}:000001:0004 A00 BG-08-0065-07-0100 65 は は は は は 
+{a:02d}:000001:0005 A00 BG-03-1920-01-0100 55 また 又 また 又 また 
+"""
+
+
+def _load(filename, workers):
+    db = HachidaishuDB(filename, workers=workers)
+    return [_record_to_tuple(record) for record in db.db], db._noisy
+
+
+@pytest.fixture(scope="module")
+def seams(tmp_path_factory):
+    filename = tmp_path_factory.mktemp("parallel") / "seams.db"
+    filename.write_text(
+        "".join(SEAM_POEM.format(a=a) for a in range(1, 9)), encoding="utf-8"
+    )
+    return filename
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_parallel_matches_serial(database, workers):
+    assert _load(database, workers) == _load(database, 1)
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_preset_seams(seams, workers):
+    serial = HachidaishuDB(seams)
+    # The bigram rule marks the first token of every later poem a VERB.
+    assert [serial.poem(a, 1)[0].token().ud_pos for a in range(1, 9)] == ["AUX"] + [
+        "VERB"
+    ] * 7
+    assert _load(seams, workers) == _load(seams, 1)
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4])
+def test_empty(tmp_path, workers):
+    filename = tmp_path / "empty.db"
+    filename.write_text("", encoding="utf-8")
+    assert _load(filename, workers) == ([], set())
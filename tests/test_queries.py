@@ -0,0 +1,56 @@
+import pytest
+
+from hachidaishu import Anthology, HachidaishuDB, _token_values
+
+
+def _values(tokens):
+    return [_token_values(token) for token in tokens]
+
+
+def test_tokens_decomposition_yields_tokens(db, database):
+    """mode="decomposition" yields the tokens of every decomposition, on both
+    backends."""
+    expected = [
+        token
+        for record in db
+        for decomposition in record.segments
+        for token in decomposition.tokens
+    ]
+    tokens = list(db.tokens("decomposition"))
+    assert tokens == expected
+    assert all(type(token).__name__ == "Token" for token in tokens)
+    assert len(tokens) > len(list(db.tokens()))
+    columnar = HachidaishuDB(database, backend="columnar")
+    assert _values(columnar.tokens("decomposition")) == _values(tokens)
+
+
+@pytest.mark.parametrize("anthology", [Anthology.Shuishu, 3, "Shuishu"])
+def test_anthology_arguments(db, anthology):
+    """Every entry point accepts an Anthology, its number or its name."""
+    member = Anthology.Shuishu
+    lemma = db.poem(member, 1)[0].token().lemma
+    assert list(db.query(anthology)) == list(db.query(member))
+    assert db.poem(anthology, 1) == db.poem(member, 1)
+    assert list(db.tokens(anthology=anthology)) == list(db.tokens(anthology=member))
+    assert db.text(anthology=anthology) == db.text(anthology=member)
+    assert db.occurrences(lemma, anthology=anthology) == db.occurrences(
+        lemma, anthology=member
+    )
+    assert db.concordance(lemma, anthology=anthology) == db.concordance(
+        lemma, anthology=member
+    )
+    assert db.semantic_counts(anthology=anthology) == db.semantic_counts(
+        anthology=member
+    )
+    assert (
+        db.frequencies("lemma", anthology=anthology).most_common()
+        == db.frequencies("lemma", anthology=member).most_common()
+    )
+    assert db.ngrams(anthology=anthology).labels == db.ngrams(anthology=member).labels
+    assert (
+        db.document_term_matrix(anthology=anthology).rows
+        == db.document_term_matrix(anthology=member).rows
+    )
+    assert db.similarity_index().pairs(0.2, anthology=anthology).pairs() == (
+        db.similarity_index().pairs(0.2, anthology=member).pairs()
+    )
@@ -0,0 +1,181 @@
+from collections import Counter
+
+import pytest
+
+from hachidaishu import HachidaishuDB, SemanticIndex, decode_bg_id
+
+# Categories on either side of the boundaries of the classification levels.
+BOUNDARY_IDS = [
+    "BG-01-4999-99-9999",
+    "BG-01-5000-00-0000",
+    "BG-01-5000-01-0100",
+    "BG-01-5099-01-0100",
+    "BG-01-5100-01-0100",
+    "BG-01-5270-01-0100",
+    "BG-01-5270-01-0101",
+    "BG-01-5270-02-0100",
+    "BG-01-5271-01-0100",
+    "BG-01-5999-99-9999",
+    "BG-01-6000-01-0100",
+    "BG-02-0000-00-0000",
+    "BG-02-1000-01-0100",
+    "BG-05-9999-99-9999",
+    "CH-JP-0000-00-0000",
+]
+
+PREFIXES = [
+    "1",
+    "2",
+    "3",
+    "5",
+    "1.4",
+    "1.5",
+    "1.6",
+    "1.50",
+    "1.51",
+    "1.52",
+    "1.59",
+    "1.527",
+    "1.5270",
+    "1.5271",
+    "1.5999",
+    "1.5270-01",
+    "1.5270-02",
+    "1.5270-01-0101",
+    "2.0",
+]
+
+RANGES = [
+    ("1", "2"),
+    ("1.4", "1.5"),
+    ("1.50", "1.52"),
+    ("1.5270", "1.5271"),
+    ("1.5270-01", "1.5270-02"),
+    ("1.527", "2.0"),
+]
+
+
+def _digits(category):
+    """The classification number of `category` as (word class, item digits,
+    paragraph, subparagraph), or None for non-numeric ones."""
+    if category.word_class < 0 or category.item < 0:
+        return None
+    return (
+        category.word_class,
+        f"{category.item:04}",
+        category.paragraph,
+        category.subparagraph,
+    )
+
+
+def _parse(prefix):
+    word_class, _, rest = prefix.partition(".")
+    digits, *parts = rest.split("-") if rest else ("",)
+    return int(word_class), digits, [int(part) for part in parts]
+
+
+def _under(bg_id, prefix):
+    digits = _digits(decode_bg_id(bg_id))
+    if digits is None:
+        return False
+    word_class, item, paragraph, subparagraph = digits
+    wc, prefix_digits, parts = _parse(prefix)
+    return (
+        word_class == wc
+        and item.startswith(prefix_digits)
+        and [paragraph, subparagraph][: len(parts)] == parts
+    )
+
+
+def _within(bg_id, start, stop):
+    """Whether `bg_id` is under `start`, under `stop` or in between, comparing
+    classification numbers digit by digit."""
+    digits = _digits(decode_bg_id(bg_id))
+    if digits is None:
+        return False
+
+    def truncated(prefix):
+        word_class, prefix_digits, parts = _parse(prefix)
+        key = (digits[0], digits[1][: len(prefix_digits)], *digits[2 : 2 + len(parts)])
+        return key, (word_class, prefix_digits, *parts)
+
+    low, start_key = truncated(start)
+    high, stop_key = truncated(stop)
+    return start_key <= low and high <= stop_key
+
+
+def _scan(db, match, mode="default", anthology=None):
+    return [
+        (r, d, p)
+        for r, record in enumerate(db.db)
+        if anthology is None or record.anthology == anthology
+        for d, decomposition in enumerate(record.segments)
+        for p, token in enumerate(decomposition.tokens)
+        if match(token.bg_id) and (mode == "decomposition" or d == p == 0)
+    ]
+
+
+@pytest.fixture(scope="module")
+def boundaries(tmp_path_factory):
+    """A database with one poem per anthology whose tokens cycle through
+    BOUNDARY_IDS."""
+    rows = []
+    for anthology in range(1, 4):
+        for serial, bg_id in enumerate(BOUNDARY_IDS[anthology - 1 :] * 2, 1):
+            rows.append(
+                f"{anthology:02d}:000001:{serial:04d} A00 {bg_id} 02 年 年 とし 年 とし \n"
+            )
+    filename = tmp_path_factory.mktemp("semantic") / "boundaries.db"
+    filename.write_text("".join(rows), encoding="utf-8")
+    return HachidaishuDB(filename)
+
+
+@pytest.fixture(params=["db", "boundaries"])
+def any_db(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_prefixes(any_db, mode):
+    for prefix in PREFIXES:
+        expected = _scan(any_db, lambda bg_id: _under(bg_id, prefix), mode)
+        assert any_db.semantic_occurrences(prefix, mode=mode) == expected, prefix
+        assert set(any_db.semantic_index().bg_ids_under(prefix)) == {
+            bg_id
+            for bg_id in any_db.inverted_index().postings["bg_id"]
+            if _under(bg_id, prefix)
+        }
+
+
+@pytest.mark.parametrize("mode", ["default", "decomposition"])
+def test_ranges(any_db, mode):
+    for start, stop in RANGES:
+        expected = _scan(any_db, lambda bg_id: _within(bg_id, start, stop), mode)
+        assert any_db.semantic_occurrences(start, stop, mode=mode) == expected
+
+
+def test_boundaries(boundaries):
+    index = boundaries.semantic_index()
+    assert index.bg_ids_under("1.5") == BOUNDARY_IDS[1:10]
+    assert index.bg_ids_under("1.50") == BOUNDARY_IDS[1:4]
+    assert index.bg_ids_under("1.5270") == BOUNDARY_IDS[5:8]
+    assert index.bg_ids_under("1.5270-01") == BOUNDARY_IDS[5:7]
+    assert index.bg_ids_under("1") == BOUNDARY_IDS[:11]
+    assert index.bg_ids_under("5") == BOUNDARY_IDS[13:14]
+    assert index.bg_ids_under("1.4", "1.5") == BOUNDARY_IDS[:10]
+    assert index.bg_ids_under("1.5270-01", "1.5270-02") == BOUNDARY_IDS[5:8]
+    assert index.bg_ids_under("1.527", "2.0") == BOUNDARY_IDS[5:12]
+    assert index.bg_ids_under("3") == []
+
+
+@pytest.mark.parametrize("level", SemanticIndex.LEVELS)
+@pytest.mark.parametrize("prefix", [None, "1", "1.5", "1.5270"])
+def test_counts(any_db, level, prefix):
+    for mode in ("default", "decomposition"):
+        for anthology in (None, 2):
+            expected = Counter(
+                decode_bg_id(token.bg_id).label(level)
+                for token in any_db.tokens(mode=mode, anthology=anthology)
+                if prefix is None or _under(token.bg_id, prefix)
+            )
+            assert any_db.semantic_counts(level, prefix, mode, anthology) == expected
@@ -0,0 +1,102 @@
+import gc
+import logging
+import threading
+
+import pytest
+
+import server
+from hachidaishu import Anthology, _token_values
+from server import Client, ServerError, ServerThread
+
+
+@pytest.fixture
+def address(db):
+    with ServerThread(db, ("127.0.0.1", 0)) as address:
+        yield address
+
+
+def test_methods_match_database(db, address):
+    with Client(address) as client:
+        assert list(client.query(Anthology.Gosenshu)) == list(
+            db.query(Anthology.Gosenshu)
+        )
+        assert client.poem(1, 3) == db.poem(1, 3)
+        for mode in ("default", "decomposition"):
+            assert [_token_values(token) for token in client.tokens(mode)] == [
+                _token_values(token) for token in db.tokens(mode)
+            ]
+        assert client.text() == db.text()
+        assert client.text("/", anthology=3, embed_metadata=True) == db.text(
+            "/", anthology=3, embed_metadata=True
+        )
+        assert client.text(anthology=1, poem=999999) == db.text(
+            anthology=1, poem=999999
+        )
+        lemma = db.poem(2, 1)[0].token().lemma
+        assert client.concordance(lemma, width=3) == db.concordance(lemma, width=3)
+        assert (
+            client.frequencies("lemma").most_common()
+            == db.frequencies("lemma").most_common()
+        )
+
+
+def test_results_are_streamed_in_chunks(db, address):
+    with Client(address) as client:
+        tokens = client.tokens()
+        next(tokens)  # Abandon the rest of the response.
+        assert client.poem(1, 1) == db.poem(1, 1)
+    assert sum(1 for _ in db.tokens()) > server.CHUNK_SIZE
+
+
+def test_concurrent_clients_are_batched(db, monkeypatch):
+    calls = []
+    tokens = server.METHODS["tokens"]
+
+    def counted(*args, **params):
+        calls.append(params)
+        return tokens(*args, **params)
+
+    monkeypatch.setitem(server.METHODS, "tokens", counted)
+    expected = [_token_values(token) for token in db.tokens(anthology=4)]
+    barrier = threading.Barrier(6)
+    results = []
+
+    def work(address):
+        with Client(address) as client:
+            barrier.wait()
+            results.append(
+                [_token_values(token) for token in client.tokens(anthology=4)]
+            )
+
+    with ServerThread(db, ("127.0.0.1", 0), batch_window=0.5) as address:
+        threads = [threading.Thread(target=work, args=(address,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert results == [expected] * 6
+    assert len(calls) == 1
+
+
+def test_unknown_method(address):
+    with Client(address) as client:
+        with pytest.raises(ServerError, match="Unknown method: nope"):
+            list(client._request("nope"))
+        with pytest.raises(ServerError, match="TypeError"):
+            list(client._request("poem", anthology=1))
+        assert client.poem(1, 1)
+
+
+def test_shutdown_with_connected_client(db, caplog):
+    caplog.set_level(logging.ERROR, logger="asyncio")
+    with ServerThread(db, ("127.0.0.1", 0)) as address:
+        idle = Client(address)
+        streaming = Client(address)
+        tokens = streaming.tokens()
+        next(tokens)
+    gc.collect()
+    assert not caplog.records
+    with pytest.raises(ConnectionError):
+        list(idle.query(1, 1))
+    idle.close()
+    streaming.close()
@@ -0,0 +1,111 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pytest
+
+from hachidaishu import SHARED_PREFIX, HachidaishuDB, SharedCorpus
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isdir("/dev/shm"), reason="needs POSIX shared memory in /dev/shm"
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _blocks():
+    return {name for name in os.listdir("/dev/shm") if name.startswith(SHARED_PREFIX)}
+
+
+def _gone(name):
+    return name not in _blocks() and not os.path.exists(
+        os.path.join(tempfile.gettempdir(), f"{name}.lock")
+    )
+
+
+def _text(name, anthology, poem):
+    db = HachidaishuDB.attach_shared(name)
+    return db.text(anthology=anthology, poem=poem), os.getpid()
+
+
+def _processes(shared):
+    return os.getpid(), shared.processes
+
+
+def test_workers(db):
+    poems = list(dict.fromkeys((r.anthology, r.poem) for r in db))[::10]
+    with db.publish_shared() as shared:
+        assert shared.name in _blocks()
+        assert shared.db.text() == db.text()
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            results = list(
+                pool.map(
+                    _text,
+                    repeat(shared.name),
+                    [anthology for anthology, _ in poems],
+                    [poem for _, poem in poems],
+                )
+            )
+            # A SharedCorpus passed to a worker attaches there.
+            attached = list(pool.map(_processes, repeat(shared, 4)))
+        assert [text for text, _ in results] == [
+            db.text(anthology=a, poem=p) for a, p in poems
+        ]
+        assert all(pid in processes for pid, processes in attached)
+        assert os.getpid() in shared.processes
+    assert shared.closed
+    assert _gone(shared.name)
+
+
+def test_unlink(db):
+    shared = db.publish_shared()
+    shared.unlink()
+    assert shared.name not in _blocks()
+    # Views stay usable until closed.
+    assert shared.db.text(anthology=1) == db.text(anthology=1)
+    shared.close()
+    assert _gone(shared.name)
+
+
+def test_close_with_views(db):
+    shared = db.publish_shared()
+    poem_numbers = shared.db.db.poem
+    with pytest.raises(BufferError, match="still in use"):
+        shared.close()
+    assert shared.closed
+    assert shared.name not in _blocks()
+    del poem_numbers
+
+
+def test_cleanup(database):
+    with HachidaishuDB(database).publish_shared() as live:
+        # Publish from a process in a session of its own, and kill it together
+        # with its resource tracker, so that nothing unlinks its block.
+        publisher = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, time\n"
+                f"sys.path.insert(0, {ROOT!r})\n"
+                "from hachidaishu import HachidaishuDB\n"
+                f"shared = HachidaishuDB({str(database)!r}).publish_shared()\n"
+                "print(shared.name, flush=True)\n"
+                "time.sleep(60)\n",
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+            start_new_session=True,
+        )
+        name = publisher.stdout.readline().strip()
+        os.killpg(publisher.pid, signal.SIGKILL)
+        publisher.wait()
+        publisher.stdout.close()
+        assert name in _blocks()
+        assert SharedCorpus.cleanup() == [name]
+        assert _gone(name)
+        assert live.name in _blocks()
+    assert _gone(live.name)
@@ -0,0 +1,84 @@
+from itertools import combinations, groupby
+
+import pytest
+
+from hachidaishu import HachidaishuDB
+
+
+def _shingles(db, feature="lemma", shingle=2):
+    """Return the exact shingle set of every poem with at least one shingle."""
+    sets = {}
+    for key, records in groupby(db, key=lambda r: (r.anthology, r.poem)):
+        values = [getattr(record.token(), feature) for record in records]
+        shingles = {
+            tuple(values[k : k + shingle]) for k in range(len(values) - shingle + 1)
+        }
+        if shingles:
+            sets[key] = shingles
+    return sets
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+@pytest.fixture(scope="module")
+def db(database, tmp_path_factory):
+    """The test database with near-duplicates of ten Kokinshu poems added to
+    the Shinkokinshu, each with the lemma of one of the first k rows changed
+    (k = 0 to 9)."""
+    lines = database.read_text(encoding="utf-8").splitlines(keepends=True)
+    copies = []
+    for k in range(10):
+        rows = [line for line in lines if line.startswith(f"01:{k + 1:06d}:")]
+        for i, line in enumerate(rows):
+            fields = line.split(" ")
+            fields[0] = f"08:{900001 + k:06d}" + fields[0][9:]
+            if i == k:
+                fields[5] = "変"
+            copies.append(" ".join(fields))
+    filename = tmp_path_factory.mktemp("similar") / "hachidai.db"
+    filename.write_text("".join(lines + copies), encoding="utf-8")
+    return HachidaishuDB(filename)
+
+
+@pytest.fixture(scope="module")
+def exact(db):
+    sets = _shingles(db)
+    return {
+        (q, p): _jaccard(sets[p], sets[q])
+        for p, q in combinations(sorted(sets, key=_key), 2)
+    }
+
+
+def _key(poem):
+    return poem[0].value, poem[1]
+
+
+def test_pairs_against_exact_jaccard(db, exact):
+    index = db.similarity_index()
+    found = {
+        (a, b): score for a, b, score in index.pairs(0.0, same_anthology=True).pairs()
+    }
+    # Pairs this similar are candidates with probability 1 - 1e-10 or more.
+    similar = {pair for pair, score in exact.items() if score >= 0.75}
+    assert len(similar) >= 5
+    assert similar <= found.keys()
+    assert found.keys() <= exact.keys()
+    for pair, score in found.items():
+        assert abs(score - exact[pair]) < 0.2
+    selected = index.pairs(0.5)
+    assert list(selected.scores) == sorted(selected.scores, reverse=True)
+    assert all(score >= 0.5 for score in selected.scores)
+    assert all(a[0] != b[0] for a, b, _ in selected.pairs())
+
+
+def test_source_and_similar(db, exact):
+    index = db.similarity_index()
+    pairs = index.pairs(0.3, anthology="Shinkokinshu", source="Kokinshu").pairs()
+    assert pairs
+    for a, b, _ in pairs:
+        assert a[0].name == "Shinkokinshu" and b[0].name == "Kokinshu"
+    (a, b), score = max(exact.items(), key=lambda item: item[1])
+    similar = {pair[1] for pair in index.similar(*a, threshold=0.0).pairs()}
+    assert b in similar and a not in similar
@@ -0,0 +1,83 @@
+import random
+import shutil
+
+import pytest
+
+import hachidaishu
+from hachidaishu import HachidaishuDB, _record_to_tuple
+
+
+def _rows(db):
+    return [_record_to_tuple(record) for record in db.db]
+
+
+def _load(filename, snapshot):
+    """Return the records loaded through `snapshot` and whether it was reused."""
+    db = HachidaishuDB(filename, cache=snapshot, instrument=True)
+    return _rows(db), db.stats.snapshot
+
+
+@pytest.fixture
+def source(database, tmp_path):
+    filename = tmp_path / "hachidai.db"
+    shutil.copy(database, filename)
+    return filename
+
+
+def test_reuse(db, source):
+    snapshot = f"{source}.snapshot"
+    assert _load(source, True) == (_rows(db), False)
+    assert _load(source, True) == (_rows(db), True)
+    # A path may be given instead.
+    other = source.parent / "other.snapshot"
+    assert _load(source, other) == (_rows(db), False)
+    assert other.read_bytes() == open(snapshot, "rb").read()
+
+
+def test_source_changed(source):
+    _load(source, True)
+    lines = source.read_text(encoding="utf-8").splitlines(keepends=True)
+    source.write_text("".join(lines[: len(lines) // 2]), encoding="utf-8")
+    assert _load(source, True) == (_rows(HachidaishuDB(source)), False)
+    assert _load(source, True)[1]
+
+
+def test_mappings_changed(db, source, monkeypatch):
+    _load(source, True)
+    monkeypatch.setattr(hachidaishu, "mapping_digest", lambda: "changed")
+    assert _load(source, True) == (_rows(db), False)
+    assert _load(source, True) == (_rows(db), True)
+
+
+def _damaged(source, damage):
+    """Yield the snapshot of `source` with each of `damage` applied to its
+    bytes in turn."""
+    snapshot = source.parent / "hachidai.db.snapshot"
+    _load(source, snapshot)
+    data = snapshot.read_bytes()
+    for function in damage:
+        snapshot.write_bytes(function(data))
+        yield snapshot
+
+
+def test_truncated(db, source):
+    cuts = [0, 10, 100, -1000, -1]
+    for snapshot in _damaged(source, [lambda data, n=n: data[:n] for n in cuts]):
+        assert _load(source, snapshot) == (_rows(db), False)
+        assert _load(source, snapshot) == (_rows(db), True)
+
+
+def test_corrupt(db, source):
+    rng = random.Random(0)
+
+    def flip(data, position):
+        position = position % len(data)
+        return data[:position] + bytes([data[position] ^ 0xFF]) + data[position + 1 :]
+
+    # The header and key, then anywhere in the records.
+    positions = list(range(0, 200, 20)) + [rng.randrange(1 << 30) for _ in range(10)]
+    expected = _rows(db)
+    damage = [lambda data, p=p: flip(data, p) for p in positions]
+    for snapshot in _damaged(source, damage):
+        assert _load(source, snapshot) == (expected, False)
+    assert _load(source, snapshot) == (expected, True)
@@ -0,0 +1,42 @@
+from hachidaishu import HachidaishuDB, LoadStats, StageStats
+
+
+def _count_lines(filename):
+    with open(filename, encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+
+def test_instrumented_load(db, database):
+    calls = []
+    instrumented = HachidaishuDB(
+        database, instrument=True, hooks=[lambda *args: calls.append(args)]
+    )
+    assert instrumented.db == db.db
+    stats = instrumented.stats
+    assert db.stats is None
+    assert isinstance(stats, LoadStats)
+    assert stats.lines == _count_lines(database)
+    assert stats.records == len(db.db)
+    assert not stats.snapshot
+    assert stats.variant_groups_merged > 0
+    # Each stage reports once as it ends, and the whole load last.
+    assert [stage for stage, _ in calls] == [*stats.stages, "load"]
+    assert all(isinstance(stage, StageStats) for _, stage in calls[:-1])
+    assert calls[-1][1] is stats
+    assert stats.stages["index"].records == len(db.db)
+    assert stats.seconds == sum(stage.seconds for stage in stats.stages.values())
+    assert stats.to_json()["lines"] == stats.lines
+
+
+def test_parallel_counters(database):
+    serial = HachidaishuDB(database, instrument=True).stats
+    parallel = HachidaishuDB(database, workers=2, instrument=True).stats
+    for counter in (
+        "lines",
+        "decompositions_merged",
+        "ud_bigram_rules",
+        "variant_markers",
+        "records_dropped",
+        "records",
+    ):
+        assert getattr(parallel, counter) == getattr(serial, counter), counter
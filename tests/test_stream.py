@@ -0,0 +1,47 @@
+import bz2
+import gzip
+import io
+import lzma
+import pytest
+
+from hachidaishu import HachidaishuDB, LoadStats, _record_to_tuple
+
+
+def _rows(records):
+    return [_record_to_tuple(record) for record in records]
+
+
+@pytest.fixture(params=[(".gz", gzip.open), (".xz", lzma.open), (".bz2", bz2.open)])
+def compressed(database, tmp_path, request):
+    ext, opener = request.param
+    filename = tmp_path / f"hachidai.db{ext}"
+    with opener(filename, "wb") as f:
+        f.write(database.read_bytes())
+    return filename
+
+
+def test_compressed(db, compressed):
+    assert _rows(HachidaishuDB(compressed).db) == _rows(db.db)
+    assert _rows(HachidaishuDB.stream(compressed)) == _rows(db.db)
+
+
+def test_stdin(db, database, monkeypatch):
+    text = database.read_text(encoding="utf-8")
+    monkeypatch.setattr("sys.stdin", io.StringIO(text))
+    assert _rows(HachidaishuDB("-").db) == _rows(db.db)
+    monkeypatch.setattr("sys.stdin", io.StringIO(text))
+    assert _rows(HachidaishuDB.stream("-")) == _rows(db.db)
+    # An open file object is read, but not closed.
+    with open(database, encoding="utf-8") as f:
+        assert _rows(HachidaishuDB.stream(f)) == _rows(db.db)
+        assert not f.closed
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_stream(db, database, lazy):
+    stats = LoadStats()
+    records = HachidaishuDB.stream(database, stats=stats, lazy=lazy)
+    first = next(records)
+    # Records are produced before the whole file has been read.
+    assert 0 < stats.lines < database.read_text(encoding="utf-8").count("\n") // 2
+    assert _rows([first, *records]) == _rows(db.db)
@@ -0,0 +1,88 @@
+import random
+from bisect import bisect_right
+from itertools import groupby
+
+import pytest
+
+from hachidaishu import SubstringIndex, _suffix_array, np
+
+
+def _poems(db, field):
+    """Return (anthology, poem, records, values) of every poem, with the
+    record indices and `field` values of its canonical tokens."""
+    poems = []
+    by_poem = groupby(enumerate(db), key=lambda item: (item[1].anthology, item[1].poem))
+    for (anthology, poem), items in by_poem:
+        records, values = [], []
+        for i, record in items:
+            records.append(i)
+            values.append(getattr(record.token(), field) or "")
+        poems.append((anthology, poem, records, values))
+    return poems
+
+
+def _find_all(poems, pattern, match):
+    """The matches of `pattern` found by str.find() in the text of each poem."""
+    matches = []
+    for anthology, poem, records, values in poems:
+        starts = np.cumsum([0] + [len(value) for value in values]).tolist()
+        text = "".join(values)
+        i = text.find(pattern)
+        while i >= 0:
+            first = bisect_right(starts, i) - 1
+            last = bisect_right(starts, i + len(pattern) - 1) - 1
+            offset = i - starts[first]
+            end = i + len(pattern) == starts[last] + len(values[last])
+            if match == "substring" or offset == 0 and (match == "prefix" or end):
+                matches.append(
+                    (anthology, poem, records[first], first, last + 1, offset)
+                )
+            i = text.find(pattern, i + 1)
+    return matches
+
+
+def test_suffix_array():
+    rng = random.Random(0)
+    for n in (0, 1, 2, 7, 100, 1000):
+        text = [rng.choice("ab\0") for _ in range(n)]
+        expected = sorted(range(n), key=lambda i: text[i:])
+        codes = np.array([ord(c) for c in text], dtype=np.int32)
+        assert _suffix_array(codes).tolist() == expected
+
+
+@pytest.mark.parametrize("field", ["surface", "lemma", "kanji_reading"])
+def test_search_against_find(db, field, tmp_path):
+    poems = _poems(db, field)
+    index = db.substring_index(field)
+    rng = random.Random(0)
+    patterns = set()
+    for _ in range(100):
+        values = rng.choice(poems)[3]
+        text = "".join(values)
+        start = rng.randrange(len(text))
+        patterns.add(text[start : start + rng.randint(1, 6)])
+        patterns.add(rng.choice(values) or "年")
+    patterns.add("存在しない")
+    for pattern in patterns:
+        for match in ("substring", "prefix", "exact"):
+            found = [
+                (m.anthology, m.poem, m.record, m.position, m.stop, m.offset)
+                for m in index.search(pattern, match)
+            ]
+            assert found == _find_all(poems, pattern, match)
+        assert index.count(pattern) == len(_find_all(poems, pattern, "substring"))
+
+    filename = tmp_path / "substrings.idx"
+    index.save(filename)
+    opened = SubstringIndex.open(filename)
+    assert opened.field == field
+    for pattern in sorted(patterns)[:20]:
+        assert opened.search(pattern) == index.search(pattern)
+
+
+def test_invalid_patterns(db):
+    for pattern in ("", "a\0b"):
+        with pytest.raises(ValueError):
+            db.search(pattern)
+    with pytest.raises(ValueError):
+        db.search("年", match="suffix")
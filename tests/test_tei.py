@@ -0,0 +1,98 @@
+import io
+import xml.etree.ElementTree as ET
+
+from conftest import SOURCE
+from hachidaishu import HachidaishuDB
+
+NS = {"tei": "http://www.tei-c.org/ns/1.0"}
+
+
+def _tei(db):
+    f = io.StringIO()
+    db.write_tei(f, date="2024-01-02")
+    return ET.fromstring(f.getvalue())
+
+
+def _check_w(w, token):
+    assert w.tag == f"{{{NS['tei']}}}w"
+    assert w.text == token.surface
+    assert w.get("lemma") == token.lemma
+    assert w.get("pos") == token.ipa_en_pos
+    msd = dict(field.split("=", 1) for field in w.get("msd").split("|"))
+    assert msd["UPosTag"] == str(token.ud_pos)
+    assert msd["UniDicPosTag"] == token.unidic_pos
+    assert msd["KanjiReading"] == token.kanji_reading
+
+
+def _check_poems(db, root):
+    poems = anthologies = 0
+    divs = root.findall("tei:text/tei:body/tei:div", NS)
+    for div in divs:
+        assert div.get("type") == "anthology"
+        for lg in div.findall("tei:lg", NS):
+            poems += 1
+            assert lg.get("type") == "waka"
+            (line,) = lg.findall("tei:l", NS)
+            records = db.poem(div.get("n"), int(lg.get("n")))
+            assert len(line) == len(records)
+            for element, record in zip(line, records):
+                decompositions = record.decompositions()
+                if len(decompositions) == 1:
+                    _check_w(element, decompositions[0][0])
+                    continue
+                assert element.tag == f"{{{NS['tei']}}}app"
+                rdgs = element.findall("tei:rdg", NS)
+                assert len(rdgs) == len(decompositions)
+                for rdg, decomposition in zip(rdgs, decompositions):
+                    assert len(rdg) == len(decomposition.tokens)
+                    for w, token in zip(rdg, decomposition.tokens):
+                        _check_w(w, token)
+        anthologies += 1
+    return poems, anthologies
+
+
+def test_structure(db):
+    root = _tei(db)
+    records = list(db)
+    keys = list(dict.fromkeys((r.anthology, r.poem) for r in records))
+    assert _check_poems(db, root) == (len(keys), len({a for a, _ in keys}))
+    assert len(root.findall(".//tei:app", NS)) == sum(
+        len(r.decompositions()) > 1 for r in records
+    )
+    measures = {
+        m.get("unit"): int(m.get("quantity"))
+        for m in root.findall(".//tei:extent/tei:measure", NS)
+    }
+    assert measures == {
+        "characters": sum(len(r.token().surface) for r in records),
+        "morphemes": len(records),
+        "poems": len(keys),
+        "anthologies": len({a for a, _ in keys}),
+    }
+    assert root.find(".//tei:publicationStmt/tei:date", NS).get("when") == "2024-01-02"
+
+
+def test_escaping(tmp_path):
+    # Markup in the surfaces and lemmas of a plain record and of one with
+    # alternative decompositions (一とせ / 一 年).
+    lines = SOURCE.splitlines(keepends=True)
+    for k, (surface, lemma) in {
+        2: ("]]>", "&"),
+        12: ("<年>", 'a"b'),
+        13: ("&amp;", "<l/>"),
+        14: ("\"'", "'"),
+    }.items():
+        fields = lines[k].split(" ")
+        fields[4], fields[5] = surface, lemma
+        lines[k] = " ".join(fields)
+    filename = tmp_path / "markup.db"
+    filename.write_text("".join(lines), encoding="utf-8")
+    db = HachidaishuDB(filename)
+    root = _tei(db)
+    assert _check_poems(db, root) == (2, 1)
+    app = root.find(".//tei:app", NS)
+    words = list(app.iter(f"{{{NS['tei']}}}w"))
+    assert [w.text for w in words] == ["<年>", "&amp;", "\"'"]
+    assert [w.get("lemma") for w in words] == ['a"b', "<l/>", "'"]
+    w = root.find(".//tei:l/tei:w[2]", NS)
+    assert (w.text, w.get("lemma")) == ("]]>", "&")
@@ -0,0 +1,57 @@
+import shutil
+
+from hachidaishu import HachidaishuDB, _record_to_tuple
+
+
+def _rows(db):
+    return [_record_to_tuple(record) for record in db]
+
+
+def _edit(lines):
+    """Return the rows to change or add and `lines` with them applied: a
+    changed lemma, a row appended to a poem and a new poem."""
+    lines = list(lines)
+    i = next(k for k, line in enumerate(lines) if line.startswith("02:000003:0002 A00"))
+    fields = lines[i].split(" ")
+    fields[5] = "変"
+    changed = " ".join(fields)
+    last = max(k for k, line in enumerate(lines) if line.startswith("03:000005:"))
+    serial = int(lines[last][10:14]) + 1
+    first = next(line for line in lines if line.startswith("03:000005:0001 A00"))
+    appended = f"03:000005:{serial:04d} {first.split(' ', 1)[1]}"
+    poem = [f"05:999999{line[9:]}" for line in lines if line.startswith("01:000001:")]
+    rows = [changed, appended] + poem
+    lines[i] = changed
+    lines.insert(last + 1, appended)
+    lines.extend(poem)
+    lines.sort(key=lambda line: line[:9])  # By anthology and poem, keeping row order.
+    return rows, lines
+
+
+def test_update_matches_fresh_load(database, tmp_path):
+    filename = tmp_path / "hachidai.db"
+    shutil.copy(database, filename)
+    lines = filename.read_text(encoding="utf-8").splitlines(keepends=True)
+    rows, edited = _edit(lines)
+    db = HachidaishuDB(filename)
+    db.update(rows)
+    expected = tmp_path / "expected.db"
+    expected.write_text("".join(edited), encoding="utf-8")
+    assert _rows(db) == _rows(HachidaishuDB(expected))
+    assert db.text() == HachidaishuDB(expected).text()
+
+
+def test_update_from_matches_fresh_load(database, tmp_path):
+    filename = tmp_path / "hachidai.db"
+    shutil.copy(database, filename)
+    db = HachidaishuDB(filename)
+    lines = filename.read_text(encoding="utf-8").splitlines(keepends=True)
+    _, edited = _edit(lines)
+    edited = [line for line in edited if not line.startswith("06:000002:")]
+    changed = tmp_path / "changed.db"
+    changed.write_text("".join(edited), encoding="utf-8")
+    db.update_from(changed)
+    fresh = HachidaishuDB(changed)
+    assert _rows(db) == _rows(fresh)
+    assert list(db.query(6, 2)) == []
+    assert db.poem(5, 999999) == fresh.poem(5, 999999)
@@ -0,0 +1,178 @@
+"""Checks HachidaishuDB._process_variants() against the original
+implementation it replaced, which deleted from the list of records as it
+went and compared tokens with list scans."""
+
+import os
+
+import pytest
+
+from hachidaishu import HachidaishuDB, _record_to_tuple
+
+# The full corpus, if it has been placed next to hachidaishu.py.
+CORPUS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "hachidai.db"
+)
+
+# Poems in hachidai.db format with every ＊/イ marker layout the merging has to
+# reproduce: three markers (＊ originals イN variants ＊) with a differing, an
+# identical and an alternatively decomposed variant; two markers (＊ originals
+# イN variants), which are left as they are; poems with other marker counts,
+# including two anthologies' poems with the same number, which are taken for
+# one poem; markers among the records following a processed poem, which are
+# not scanned; and markers in the last poem, which is never processed.
+EXCERPT = """\
+01:000001:0001 A00 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+01:000001:0001 A10 BG-01-1911-03-1800 02 年 年 とし 年 とし 
+01:000001:0002 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000001:0003 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000001:0004 B00 BG-01-1950-14-0100 02 一とせ 一年 ひととせ 一年 ひととせ 
+01:000001:0004 C00 BG-01-1950-01-0300 19 一 一 いち 一 いち 
+01:000001:0004 C01 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+01:000001:0005 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+01:000001:0006 B00 BG-01-1950-14-0100 02 ひととせ 一年 ひととせ 一年 ひととせ 
+01:000001:0006 C00 BG-01-1950-01-0300 19 ひと 一 ひと 一 ひと 
+01:000001:0006 C01 BG-01-1630-01-0100 02 とせ 年 とし 年 とせ 
+01:000001:0007 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000001:0008 A00 BG-08-0061-10-0100 61 を を を を を 
+01:000001:0009 A00 BG-01-1642-02-0100 02 こそ 去年 こぞ 去年 こぞ 
+01:000002:0001 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+01:000002:0002 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000002:0003 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+01:000002:0004 A00 BG-08-0065-07-0100 65 は は は は は 
+01:000002:0005 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+01:000002:0006 A00 BG-02-3390-01-0100 47 ちる 散る ちる 散る ちる 
+01:000003:0001 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+01:000003:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000003:0003 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+01:000003:0004 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+01:000003:0005 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+01:000003:0006 A00 BG-02-3390-01-0100 47 ちる 散る ちる 散る ちる 
+01:000004:0001 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+01:000004:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000004:0003 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000004:0004 A00 BG-01-2000-01-0100 14 わが 我 われ 我 わ 
+01:000004:0005 A00 CH-JP-0000-00-0000 77 イ２ イ イ イ イ 
+01:000004:0006 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000004:0007 A00 BG-01-2000-01-0100 14 わが 我 われ 我 わ 
+01:000004:0007 A10 BG-01-2000-01-0200 14 わが 我 われ 我 わ 
+01:000004:0008 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000004:0009 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+01:000004:0010 A00 BG-02-3390-01-0100 47 ちる 散る ちる 散る ちる 
+01:000005:0001 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+01:000005:0002 A00 BG-08-0061-07-0100 61 の の の の の 
+01:000005:0003 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+01:000005:0004 A00 BG-08-0065-07-0100 65 は は は は は 
+01:000005:0005 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+01:000005:0006 A00 BG-02-3390-01-0100 47 ちる 散る ちる 散る ちる 
+01:000006:0001 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+01:000006:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+01:000006:0003 A00 BG-08-0065-07-0100 65 は は は は は 
+02:000006:0001 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000006:0002 A00 BG-01-5152-01-0100 02 雪 雪 ゆき 雪 ゆき 
+02:000006:0003 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+02:000006:0004 A00 BG-01-5010-01-0100 02 花 花 はな 花 はな 
+02:000006:0005 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000007:0001 A00 BG-01-1630-01-0100 02 年 年 とし 年 とし 
+02:000007:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000007:0003 A00 BG-08-0061-04-0100 61 と と と と と 
+02:000007:0004 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+02:000007:0005 A00 BG-08-0061-05-0100 61 に に に に に 
+02:000007:0006 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000007:0007 A00 BG-08-0065-14-0100 65 や や や や や 
+02:000008:0001 A00 BG-01-1641-02-0100 02 ことし 今年 ことし 今年 ことし 
+02:000008:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000008:0003 A00 BG-08-0061-04-0100 61 と と と と と 
+02:000008:0004 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+02:000008:0005 A00 BG-08-0061-05-0100 61 に に に に に 
+02:000008:0006 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+02:000008:0007 A00 BG-02-3120-01-0100 47 いは 言ふ いふ 言は いは 
+03:000001:0001 A00 BG-01-1624-02-0100 02 春 春 はる 春 はる 
+03:000001:0002 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+03:000001:0003 A00 BG-08-0065-07-0100 65 は は は は は 
+03:000001:0004 A00 CH-JP-0000-00-0000 77 イ１ イ イ イ イ 
+03:000001:0005 A00 BG-08-0065-14-0100 65 や や や や や 
+03:000001:0006 A00 CH-JP-0000-00-0000 77 ＊ ＊ ＊ ＊ ＊ 
+"""
+
+
+def _process_variants_reference(records, variant_indices):
+    """The original implementation of HachidaishuDB._process_variants()."""
+    for k in range(len(variant_indices) - 3, -1, -3):
+        begin_original, begin_variant, end_variant = variant_indices[k : k + 3]
+
+        variant_count = end_variant[0] - begin_variant[0] - 1
+
+        original_start_index = begin_original[0] + 1
+        variant_tokens = records[
+            begin_variant[0] + 1 : begin_variant[0] + 1 + variant_count
+        ]
+
+        for original_record, variant_record in zip(
+            records[original_start_index : original_start_index + variant_count],
+            variant_tokens,
+        ):
+            if original_record.segments and variant_record.segments:
+                for original_segment, variant_segment in zip(
+                    original_record.segments, variant_record.segments
+                ):
+                    if (
+                        original_segment.decomposition_type
+                        == variant_segment.decomposition_type
+                    ):
+                        original_segment.tokens.extend(
+                            token
+                            for token in variant_segment.tokens
+                            if token not in original_segment.tokens
+                        )
+
+        # Remove the ＊ and variant tokens at the end
+        del records[begin_variant[0] : begin_variant[0] + 2 + variant_count]
+        del records[begin_original[0]]
+
+    records[:] = [
+        record
+        for record in records
+        if all(segment.tokens for segment in record.segments)
+    ]
+
+
+def _merged(filename, process_variants=None, lazy=False):
+    db = HachidaishuDB.__new__(HachidaishuDB)
+    records = db._read_db(filename, lazy=lazy)
+    records = db._map_ud(db._merge_decompositions(records))
+    return [
+        _record_to_tuple(record)
+        for record in db._merge_variants(records, process_variants=process_variants)
+    ]
+
+
+@pytest.fixture(scope="module")
+def excerpt(tmp_path_factory):
+    path = tmp_path_factory.mktemp("excerpt") / "excerpt.db"
+    path.write_text(EXCERPT, encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture(params=["synthetic", "excerpt", "corpus"])
+def filename(request, database, excerpt):
+    if request.param == "synthetic":
+        return database
+    if request.param == "excerpt":
+        return excerpt
+    if not os.path.exists(CORPUS):
+        pytest.skip("hachidai.db is not available")
+    return CORPUS
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_process_variants_matches_reference(filename, lazy):
+    merged = _merged(filename, lazy=lazy)
+    assert merged == _merged(filename, _process_variants_reference, lazy)
+    assert merged == [_record_to_tuple(record) for record in HachidaishuDB(filename)]
+
+
+def test_excerpt_layouts(excerpt):
+    # Two markers, three markers, four markers across anthologies, and the
+    # marker left unprocessed after the skip window.
+    stats = HachidaishuDB(excerpt, instrument=True).stats
+    assert stats.variant_markers == {1: 1, 2: 1, 3: 3, 4: 1}